@@ -0,0 +1,377 @@
+from bluetrum.cipher import *
+from bluetrum.cipher import AB_MULTI_MIN_STREAMS
+from bluetrum.crc import *
+from bluetrum.fwimage import verify_image
+from bluetrum.utils import *
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+###############################################################################
+
+def size_arg(s):
+    mult = {'K': 1 << 10, 'M': 1 << 20}.get(s[-1:].upper())
+    if mult is not None:
+        return int(s[:-1], 0) * mult
+    return int(s, 0)
+
+ap = argparse.ArgumentParser(description='Benchmark the cipher/CRC primitives and the image pack/unpack pipeline',
+                             epilog='Sizes may have a K/M (KiB/MiB) suffix.')
+
+ap.add_argument('--sizes', type=size_arg, nargs='+', default=[256 << 10, 1 << 20, 4 << 20, 16 << 20], metavar='SIZE',
+                help='Image sizes to run the pipeline with (default: 256K 1M 4M 16M)')
+
+ap.add_argument('--repeat', type=int, default=3,
+                help='How many times to run each benchmark, the best run counts (default: %(default)d)')
+
+ap.add_argument('--micro-size', type=size_arg, default=1 << 20, metavar='SIZE',
+                help='Amount of data to feed through the primitives (default: 1M)')
+
+ap.add_argument('--no-micro', action='store_false', dest='micro',
+                help='Skip the micro-benchmarks of the primitives')
+
+ap.add_argument('--no-pipeline', action='store_false', dest='pipeline',
+                help='Skip the pack/unpack pipeline benchmarks')
+
+ap.add_argument('--no-layouts', action='store_false', dest='layouts',
+                help='Skip the check of the images made with the region sizes at the edges of the block CRC table layout')
+
+ap.add_argument('--workdir', type=Path,
+                help='Where to put the generated inputs and outputs (default: a temporary directory)')
+
+ap.add_argument('-o', '--output', type=Path, default=Path('bench_results.json'),
+                help='Results file to write (default: %(default)s)')
+
+ap.add_argument('--compare', type=Path, metavar='FILE',
+                help='Results file of a previous run (e.g. of another commit) to compare against')
+
+args = ap.parse_args()
+
+###############################################################################
+
+here = Path(__file__).resolve().parent
+
+def human_size(size):
+    if size >= (1 << 20) and size % (1 << 20) == 0:
+        return f'{size >> 20}M'
+    return f'{size >> 10}K'
+
+def best_of(func):
+    """ Run the function `args.repeat` times, returns the best time """
+    best = None
+    for _ in range(args.repeat):
+        t = time.perf_counter()
+        func()
+        t = time.perf_counter() - t
+        if best is None or t < best: best = t
+    return best
+
+#------------------------------------------------------------------------------
+
+def run_micro():
+    """ Throughput of the primitives """
+    rnd = random.Random(1)
+    size = args.micro_size
+    data = bytearray(rnd.randbytes(size))
+    keys = [rnd.getrandbits(32) for _ in range(size // 512)]
+
+    benches = {
+        'ab_lfsr_cipher_in':        lambda: ab_lfsr_cipher_in(data, 0, size, 0x12345678),
+        'ab_lfsr_cipher_in/512':    lambda: [ab_lfsr_cipher_in(data, i * 512, 512, key) for i, key in enumerate(keys)],
+        'ab_lfsr_cipher_multi':     lambda: ab_lfsr_cipher_multi(data, 0, keys),
+        'ab_lfsr_scramble_blocks':  lambda: ab_lfsr_scramble_blocks(data, 0, size // 512, 0x12345678),
+        'ab_crc16':                 lambda: ab_crc16(data),
+        'ab_crc16_blocks':          lambda: ab_crc16_blocks(data, 0, size // 512),
+        'ab_crc16/512':             lambda: [ab_crc16(data[i * 512 : i * 512 + 512], i + 1) for i in range(size // 512)],
+    }
+
+    results = {}
+
+    for name, func in benches.items():
+        seconds = best_of(func)
+        results[name] = {'seconds': seconds, 'mb_per_sec': size / seconds / 1e6}
+        print(f'  {name:<24} {size / seconds / 1e6:10.2f} MB/s')
+
+    return results
+
+#------------------------------------------------------------------------------
+
+def make_inputs(wdir, size):
+    """ Make the synthetic boot code, app.bin and resource directory, which add up to about `size` bytes of an image """
+    rnd = random.Random(size)
+
+    (wdir/'boot.bin').write_bytes(rnd.randbytes(3072))
+
+    # the code is a mix of random and repetitive stuff
+    app = bytearray()
+    while len(app) < size // 2:
+        if rnd.random() < 0.7:
+            app += rnd.randbytes(rnd.randrange(64, 4096))
+        else:
+            app += bytes([rnd.randrange(256)]) * rnd.randrange(64, 4096)
+    (wdir/'app.bin').write_bytes(app[:size // 2])
+
+    # resources: various files, some of them blank, some of them appearing more than once
+    resdir = wdir/'res'
+    resdir.mkdir(exist_ok=True)
+
+    total, i = 0, 0
+    prev = None
+    while total < size // 2 - 8192:
+        fsize = min(rnd.randrange(256, 65536), size // 2 - 8192 - total)
+
+        r = rnd.random()
+        if r < 0.1 and prev is not None:
+            fdata = prev
+        elif r < 0.2:
+            fdata = b'\xff' * fsize
+        else:
+            fdata = rnd.randbytes(fsize)
+
+        (resdir/f'res{i:04d}.bin').write_bytes(fdata)
+        prev = fdata
+        total += len(fdata)
+        i += 1
+
+# runs a tool, reporting its peak RSS at the end (the rusage of a child process is no good for that,
+# as on Linux it also accounts what the parent had at the moment it has been forked)
+TOOL_RUNNER = """
+import atexit, os, runpy, sys
+
+def report_peak():
+    try:
+        with open('/proc/self/status') as f:
+            for ln in f:
+                if ln.startswith('VmHWM:'):
+                    sys.stderr.write(f'\\n@peak {ln.split()[1]}\\n')
+    except OSError:
+        pass
+
+atexit.register(report_peak)
+
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+def run_tool(argv):
+    """ Run one of the tools, returns the time it took and its peak RSS (in KiB, if that can be known) """
+    t = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', TOOL_RUNNER, str(here/argv[0])] + [str(a) for a in argv[1:]],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    t = time.perf_counter() - t
+
+    if proc.returncode != 0:
+        raise RuntimeError(f'{argv[0]} failed with code {proc.returncode}: {proc.stderr}')
+
+    peak = None
+    for ln in proc.stderr.splitlines():
+        if ln.startswith('@peak '):
+            peak = int(ln.split()[1])
+
+    return t, peak
+
+def run_pipeline(wdir, size):
+    """ mkheader -> mkresblob -> fwmake1 -> fwunpack round trip """
+    make_inputs(wdir, size)
+
+    image = wdir/'fw.bin'
+
+    steps = [
+        ('mkheader',  ['mkheader.py', '--chipid', '5052414F01000000', wdir/'boot.bin', wdir/'header.bin']),
+        ('mkresblob', ['mkresblob.py', '--no-cache', wdir/'res', wdir/'res.bin']),
+        ('fwmake1',   ['fwmake1.py', '-u', '0x12345678', image, wdir/'header.bin', wdir/'app.bin', wdir/'res.bin']),
+        ('fwunpack',  ['fwunpack.py', '-u', '0x12345678', image]),
+    ]
+
+    results = {}
+
+    for name, argv in steps:
+        best, peak = None, None
+
+        for _ in range(args.repeat):
+            if name == 'fwunpack':
+                # (so that it doesn't find out that everything has been unpacked already)
+                (wdir/'fw.bin_unpack'/'.unpack-manifest.json').unlink(missing_ok=True)
+
+            t, p = run_tool(argv)
+            if best is None or t < best: best = t
+            if p is not None: peak = max(peak or 0, p)
+
+        results[name] = {'seconds': best, 'mb_per_sec': size / best / 1e6, 'peak_rss_kb': peak}
+        print(f'  {name:<12} {best:8.3f} s {size / best / 1e6:8.2f} MB/s   peak RSS {peak or 0:8d} KiB')
+
+    # check that it all came out as it went in (the region data gets padded to a block boundary)
+    for fname in ('app.bin', 'res.bin'):
+        orig = (wdir/fname).read_bytes()
+        orig += bytes(align_by(len(orig), 512))
+
+        if orig != (wdir/'fw.bin_unpack'/fname).read_bytes():
+            raise RuntimeError(f'Round trip mismatch in {fname}')
+
+    return results
+
+#------------------------------------------------------------------------------
+
+def run_cipher_check():
+    """ Check that ab_lfsr_cipher_multi() gives the same as ab_lfsr_cipher_in() on each stream,
+        on both sides of its numpy cutoff and with the negative keys (which mkheader's block -1 makes) """
+    rnd = random.Random(2)
+    failed = 0
+
+    for nstreams in (1, AB_MULTI_MIN_STREAMS - 1, AB_MULTI_MIN_STREAMS, 200):
+        for size in (512, 511, 100):
+            data = bytearray(rnd.randbytes(nstreams * 512 + 33))
+            keys = [rnd.getrandbits(32) for _ in range(nstreams)]
+            keys[:4] = [-1, -12345, -(1 << 40), (1 << 32) - 12345][:nstreams]
+
+            multi, single = bytearray(data), bytearray(data)
+            mkeys = ab_lfsr_cipher_multi(multi, 0, keys, 512, size)
+            skeys = [ab_lfsr_cipher_in(single, i * 512, size, key) for i, key in enumerate(keys)]
+
+            ok = multi == single and mkeys == skeys
+            print(f'  {nstreams:3d} streams of {size} bytes {"OK" if ok else "FAIL"}')
+
+            failed += not ok
+
+    return failed
+
+#------------------------------------------------------------------------------
+
+# block counts around where the block CRC table fills up the space before the data (16 + 2*n bytes vs. the next 512 byte boundary),
+# with 248 the CRCs of the padding blocks after the last region spill into the first data block
+LAYOUT_BLOCKS = [247, 248, 249, 255, 256, 504]
+
+def run_layouts(wdir):
+    """ Make the images with the regions of the sizes above, both as the last region, for a single key and several at once,
+        and check that all of them verify """
+    make_inputs(wdir, 64 << 10)
+    run_tool(['mkheader.py', '--chipid', '5052414F01000000', wdir/'boot.bin', wdir/'header.bin'])
+
+    # the scrambled bootable header has negative block keys, and with this much code they go through numpy
+    (wdir/'boot_b.bin').write_bytes(random.Random(0).randbytes(16 << 10))
+    run_tool(['mkheader.py', '-b', '--offset', 0x100, '--chipid', '5052414F01000000', wdir/'boot_b.bin', wdir/'header_b.bin'])
+
+    small = wdir/'small.bin'
+    small.write_bytes(random.Random(0).randbytes(5000))
+
+    keys = [0x12345678, 0xdeadbeef]
+    failed = 0
+
+    for nblocks in LAYOUT_BLOCKS:
+        for short in (0, 100):
+            data = wdir/'region.bin'
+            data.write_bytes(random.Random(nblocks).randbytes(nblocks * 512 - short))
+
+            # the code region being the last one (then its padding is keyed), and the resource one
+            for what, inputs in (('app', [data]), ('res', [small, data])):
+                images = [(key, wdir/f'{what}_{key:08x}.bin') for key in keys]
+
+                run_tool(['fwmake1.py', '-u', keys[0], images[0][1], wdir/'header.bin'] + inputs)
+                single = images[0][1].read_bytes()
+
+                run_tool(['fwmake1.py', '--userkeys', ','.join(hex(key) for key in keys), wdir/f'{what}_{{key}}.bin', wdir/'header.bin'] + inputs)
+
+                problems = []
+                if images[0][1].read_bytes() != single:
+                    problems.append('the batch image differs from the single one')
+                for key, path in images:
+                    problems += [f'${key:08x}: {p}' for p in verify_image(path.read_bytes(), ab_calcuserkey(key))]
+
+                status = 'OK' if len(problems) == 0 else 'FAIL - ' + '; '.join(problems)
+                print(f'  {what} {nblocks * 512 - short:7d} bytes ({nblocks} blocks) {status}')
+
+                failed += len(problems) > 0
+
+    return failed
+
+#------------------------------------------------------------------------------
+
+def compare(old, new):
+    """ Print the throughput (and peak memory) ratios between the two results """
+    print(f'\nCompared to {args.compare} ({old.get("commit") or "unknown commit"}):')
+
+    for name, n in new.get('micro', {}).items():
+        o = old.get('micro', {}).get(name)
+        if o is not None:
+            print(f'  {name:<24} {n["mb_per_sec"] / o["mb_per_sec"]:6.2f}x speed')
+
+    for size, steps in new.get('pipeline', {}).items():
+        for name, n in steps.items():
+            o = old.get('pipeline', {}).get(size, {}).get(name)
+            if o is None:
+                continue
+
+            line = f'  {size:>4} {name:<19} {n["mb_per_sec"] / o["mb_per_sec"]:6.2f}x speed'
+            if n['peak_rss_kb'] and o['peak_rss_kb']:
+                line += f', {n["peak_rss_kb"] / o["peak_rss_kb"]:5.2f}x memory'
+            print(line)
+
+###############################################################################
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+try:
+    import numpy
+    have_numpy = True
+except ImportError:
+    have_numpy = False
+
+results = {
+    'commit':   git_commit(),
+    'time':     time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'python':   platform.python_version(),
+    'platform': platform.platform(),
+    'numpy':    have_numpy,
+    'repeat':   args.repeat,
+}
+
+print('Cipher streams:')
+if run_cipher_check() > 0:
+    print('The batched cipher is broken, no point in benchmarking')
+    exit(1)
+
+if args.layouts:
+    print('Region layouts:')
+
+    with tempfile.TemporaryDirectory(prefix='bench-') as tmpdir:
+        wdir = (args.workdir or Path(tmpdir)) / 'layouts'
+        wdir.mkdir(parents=True, exist_ok=True)
+
+        if run_layouts(wdir) > 0:
+            print('Some of the images are broken, no point in benchmarking')
+            exit(1)
+
+if args.micro:
+    print(f'Primitives ({human_size(args.micro_size)}):')
+    results['micro'] = run_micro()
+
+if args.pipeline:
+    results['pipeline'] = {}
+
+    with tempfile.TemporaryDirectory(prefix='bench-') as tmpdir:
+        for size in args.sizes:
+            wdir = (args.workdir or Path(tmpdir)) / human_size(size)
+            wdir.mkdir(parents=True, exist_ok=True)
+
+            print(f'Pipeline ({human_size(size)}):')
+            results['pipeline'][human_size(size)] = run_pipeline(wdir, size)
+
+args.output.write_text(json.dumps(results, indent=2) + '\n')
+print(f'\nResults have been written into "{args.output}"')
+
+if args.compare is not None:
+    compare(json.loads(args.compare.read_text()), results)
@@ -1,12 +1,21 @@
 
 __all__ = [
     'ab_lfsr_cipher_in',
+    'ab_lfsr_cipher_multi',
+    'ab_lfsr_scramble_blocks',
+    'ab_lfsr_descramble_blocks',
     'ab_lfsr_cipher',
     'ab_calckey',
     'ab_calcuserkey'
 ]
 
-from .crc import ab_crc16
+import struct
+from .crc import ab_crc16, ab_crc16_blocks
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #---------------------------------------
 #
@@ -20,12 +29,160 @@ for i, reg in enumerate(ab_lfsr_table):
         reg = (reg >> 1) ^ (0xA3000000 if reg & 1 else 0)
     ab_lfsr_table[i] = reg
 
+# The same thing, but advancing two bytes at a time:
+#  the keystream bytes and the next key state only depend on the low 16 bits of the key.
+# (along with their numpy copies for ab_lfsr_cipher_multi, which are made once as well)
+ab_lfsr_table16 = None
+ab_lfsr_out16 = None
+ab_lfsr_table16_np = None
+ab_lfsr_out16_np = None
+
+def ab_lfsr_make_table16():
+    global ab_lfsr_table16, ab_lfsr_out16, ab_lfsr_table16_np, ab_lfsr_out16_np
+
+    table16 = [0] * 0x10000
+    out16 = [0] * 0x10000
+
+    for lo in range(0x10000):
+        b0 = lo & 0xff
+        t0 = ab_lfsr_table[b0]
+        b1 = (lo >> 8) ^ (t0 & 0xff)
+        out16[lo] = b0 | (b1 << 8)
+        table16[lo] = (t0 >> 8) ^ ab_lfsr_table[b1]
+
+    ab_lfsr_table16, ab_lfsr_out16 = table16, out16
+
+    if numpy is not None:
+        ab_lfsr_table16_np = numpy.array(table16, dtype=numpy.int64)
+        ab_lfsr_out16_np = numpy.array(out16, dtype=numpy.uint16)
+
 def ab_lfsr_cipher_in(buff, off, size, key):
-    for i in range(size):
-        buff[off + i] ^= key & 0xff
+    """ Apply the cipher to `size` bytes at `off` in place, returns the resulting key.
+
+        The key is taken as an integer of any sign: it's shifted down as it is, so a negative key
+        keeps shifting ones into the top (which is how e.g. mkheader's key of the block -1 has always worked). """
+    if ab_lfsr_table16 is None:
+        ab_lfsr_make_table16()
+
+    table16, out16 = ab_lfsr_table16, ab_lfsr_out16
+
+    # make the keystream
+    stream = []
+    for i in range(size >> 1):
+        lo = key & 0xffff
+        stream.append(out16[lo])
+        key = (key >> 16) ^ table16[lo]
+
+    stream = struct.pack(f'<{len(stream)}H', *stream)
+
+    if size & 1:
+        stream += bytes([key & 0xff])
         key = (key >> 8) ^ ab_lfsr_table[key & 0xff]
+
+    # and apply it
+    data = int.from_bytes(buff[off : off+size], 'little') ^ int.from_bytes(stream, 'little')
+    buff[off : off+size] = data.to_bytes(size, 'little')
+
     return key
 
+# below that many streams, going through them one by one is faster than setting up the numpy arrays
+AB_MULTI_MIN_STREAMS = 16
+
+def ab_lfsr_cipher_multi(buff, off, keys, stride=512, size=None):
+    """ Apply the cipher to many independent streams at once: stream N starts at `off + N * stride`,
+        is `size` bytes long (the stride by default, the last one gets cut at the buffer end)
+        and uses keys[N] as the key. Returns the list of the resulting keys.
+
+        The result is the same as calling ab_lfsr_cipher_in() on each of them (negative keys included),
+        but when numpy is available and there are enough streams, the registers of all the streams
+        are advanced in lockstep. """
+    if size is None:
+        size = stride
+
+    # how many streams are there in full
+    nfull = min(len(keys), max(0, (len(buff) - off - size) // stride + 1))
+
+    # the registers are signed 64-bit, whose arithmetic shift is the same as ab_lfsr_cipher_in()'s on any key that fits
+    if numpy is None or nfull < AB_MULTI_MIN_STREAMS or size > stride or \
+            not all(-(1 << 63) <= key < (1 << 63) for key in keys[:nfull]):
+        return [ab_lfsr_cipher_in(buff, off + i * stride, max(0, min(size, len(buff) - off - i * stride)), key)
+                for i, key in enumerate(keys)]
+
+    if ab_lfsr_table16 is None:
+        ab_lfsr_make_table16()
+
+    table16, out16 = ab_lfsr_table16_np, ab_lfsr_out16_np
+
+    regs = numpy.array(keys[:nfull], dtype=numpy.int64)
+
+    # make the keystreams, two bytes of every stream at a time
+    stream = numpy.empty((size // 2, nfull), dtype='<u2')
+
+    for i in range(size // 2):
+        lo = regs & 0xffff
+        stream[i] = out16[lo]
+        regs = (regs >> 16) ^ table16[lo]
+
+    # and apply them
+    view = numpy.frombuffer(buff, dtype=numpy.uint8, count=(nfull - 1) * stride + size, offset=off)
+    view = numpy.lib.stride_tricks.as_strided(view, shape=(nfull, size), strides=(stride, 1), writeable=True)
+
+    view[:, : size & ~1] ^= stream.T.copy().view(numpy.uint8)
+
+    result = [int(key) for key in regs]
+
+    if size & 1:
+        result = [ab_lfsr_cipher_in(buff, off + i * stride + size - 1, 1, key) for i, key in enumerate(result)]
+
+    # whatever didn't fit fully
+    result += [ab_lfsr_cipher_in(buff, off + i * stride, max(0, min(size, len(buff) - off - i * stride)), keys[i])
+               for i in range(nfull, len(keys))]
+
+    return result
+
+#
+# The region blocks are CRC'd and then scrambled with the key XORed with that CRC, and the other way around.
+# These do that chunk by chunk, with the block CRCs and the overall CRC coming out of a single CRC pass.
+# The chunks are large, as ab_lfsr_cipher_multi() costs about the same for a few blocks as it does for
+# a few thousands of them, but they still keep its keystream buffer from growing as large as the region is.
+#
+
+AB_BLOCKS_CHUNK = 4096
+
+def ab_lfsr_scramble_blocks(buff, off, count, key, blocksize=512, crc=0xffff):
+    """ CRC each of the `count` blocks starting at `off` (see ab_crc16_blocks), then scramble it with `key` ^ its CRC.
+        Returns the list of the block CRCs and the CRC of all the blocks (before scrambling) continuing from `crc`. """
+    crcs = []
+
+    for start in range(0, count, AB_BLOCKS_CHUNK):
+        n = min(AB_BLOCKS_CHUNK, count - start)
+        coff = off + start * blocksize
+
+        ccrcs, crc = ab_crc16_blocks(buff, coff, n, blocksize, crc, start)
+        if key is not None:
+            ab_lfsr_cipher_multi(buff, coff, [key ^ c for c in ccrcs], blocksize)
+
+        crcs += ccrcs
+
+    return crcs, crc
+
+def ab_lfsr_descramble_blocks(buff, off, blockcrcs, key, blocksize=512, crc=0xffff):
+    """ Descramble the blocks starting at `off` with `key` ^ their CRC from `blockcrcs`, then CRC them (see ab_crc16_blocks).
+        Returns the list of the actual block CRCs and the CRC of all the blocks (after descrambling) continuing from `crc`. """
+    crcs = []
+
+    for start in range(0, len(blockcrcs), AB_BLOCKS_CHUNK):
+        ckeys = blockcrcs[start : start + AB_BLOCKS_CHUNK]
+        coff = off + start * blocksize
+
+        if key is not None:
+            ab_lfsr_cipher_multi(buff, coff, [key ^ c for c in ckeys], blocksize)
+        ccrcs, crc = ab_crc16_blocks(buff, coff, len(ckeys), blocksize, crc, start)
+
+        crcs += ccrcs
+
+    return crcs, crc
+
 def ab_lfsr_cipher(data, key):
     data = bytearray(data)
     ab_lfsr_cipher_in(data, 0, len(data), key)
@@ -1,7 +1,64 @@
 
-__all__ = ['ab_crc16', 'ab_crc32']
+__all__ = ['ab_crc16', 'ab_crc32', 'ab_crc16_shift', 'ab_crc16_combine', 'ab_crc16_blocks']
 
 import crcmod
+from functools import lru_cache
 
 ab_crc16 = crcmod.mkCrcFun(0x11021, xorOut=0, rev=False)
 ab_crc32 = crcmod.mkCrcFun(0x104C11DB7, xorOut=0, rev=True)
+
+#---------------------------------------
+#
+# The CRC16 has no final XOR, so the CRC with some init value is the CRC with a zero init
+# XORed with the CRC of as many zero bytes with that init value, and the latter is linear
+# in the init value, so it can be looked up by each of the init value's bytes.
+#
+
+@lru_cache(maxsize=None)
+def _ab_crc16_zeros_tables(length):
+    zeros = bytes(length)
+    basis = [ab_crc16(zeros, 1 << i) for i in range(16)]
+
+    lo, hi = [0] * 256, [0] * 256
+
+    for val in range(256):
+        for i in range(8):
+            if val & (1 << i):
+                lo[val] ^= basis[i]
+                hi[val] ^= basis[i + 8]
+
+    return lo, hi
+
+def ab_crc16_shift(crc, length):
+    """ Advance the CRC over `length` zero bytes, i.e. the same as ab_crc16(bytes(length), crc) """
+    lo, hi = _ab_crc16_zeros_tables(length)
+    return lo[crc & 0xff] ^ hi[(crc >> 8) & 0xff]
+
+def ab_crc16_combine(crc1, crc2, len2):
+    """ The CRC of A+B, given the CRC of A (with whatever init value) as `crc1`,
+        and the CRC of B (`len2` bytes long) with a zero init value as `crc2` """
+    return ab_crc16_shift(crc1, len2) ^ crc2
+
+def ab_crc16_blocks(buff, off, count, blocksize=512, crc=0xffff, index=0):
+    """ CRC each of the `count` blocks starting at `off`, with the block's index + 1 as the init value
+        (block N is the `index + N`th one), and all of them together continuing from `crc`.
+
+        Each block goes through the CRC only once, returns the list of the block CRCs and the overall CRC. """
+    mv = memoryview(buff)
+    lo, hi = _ab_crc16_zeros_tables(blocksize)
+
+    crcs = []
+
+    for i in range(count):
+        block = mv[off + i * blocksize : off + (i + 1) * blocksize]
+        if len(block) < blocksize:
+            # (a short one at the end)
+            lo, hi = _ab_crc16_zeros_tables(len(block))
+
+        c = ab_crc16(block, 0)
+        init = (index + i + 1) & 0xffff
+
+        crcs.append(c ^ lo[init & 0xff] ^ hi[init >> 8])
+        crc = c ^ lo[crc & 0xff] ^ hi[crc >> 8]
+
+    return crcs, crc
@@ -0,0 +1,197 @@
+""" Job files: a bunch of flash operations done within a single download session.
+
+A job file has one step per line, written just like the download.py actions:
+
+  erase  <address> <size>           -- size 0 means 'up to the end of flash'
+  write  <address> <file>           -- erases the area first, like the write action does
+  read   <address> <size> <file>
+  verify <address> <file>
+  flash  <address> <file>           -- a firmware image, only the areas that carry something
+
+The empty lines and everything after '#' are ignored, the paths are relative to the job file
+(and may be quoted if they contain spaces).
+
+Before running, the steps are planned: each run of erase/write steps (up to a read or verify,
+which need to see what's been done by then) becomes a list of erases, merged and aligned
+to the eraseblocks, followed by the writes, sorted by address and glued together where
+they're adjacent, so that it all takes as few commands (and bus turnarounds) as possible.
+The writes keep each other's data even if they share an eraseblock, and the later ones
+take precedence where they overlap.
+"""
+
+__all__ = ['JobStep', 'JobOp', 'load_job', 'plan_job']
+
+import shlex
+from collections import namedtuple
+from pathlib import Path
+
+from bluetrum.fwimage import image_extents
+
+JobStep = namedtuple('JobStep', 'op addr size path data where')
+JobOp   = namedtuple('JobOp',   'op addr size path data')
+
+ERASE_BLOCK = 0x1000
+GAP_FILL    = 512       # the gaps this small between the writes are filled up with $FF (that doesn't program anything)
+
+_step_args = {
+    'erase':  ('addr', 'size'),
+    'write':  ('addr', 'path'),
+    'read':   ('addr', 'size', 'path'),
+    'verify': ('addr', 'path'),
+    'flash':  ('addr', 'path'),
+}
+
+def load_job(path):
+    """ Parse the job file, and load the files that are going to be written or verified """
+    path = Path(path)
+    steps = []
+
+    for lineno, ln in enumerate(path.read_text().splitlines(), 1):
+        where = f'{path}:{lineno}'
+
+        try:
+            words = shlex.split(ln, comments=True)
+        except ValueError as e:
+            raise ValueError(f'{where}: {e}')
+
+        if len(words) == 0:
+            continue
+
+        op, *words = words
+
+        names = _step_args.get(op)
+        if names is None:
+            raise ValueError(f'{where}: unknown step "{op}"')
+        if len(words) != len(names):
+            raise ValueError(f'{where}: "{op}" takes {len(names)} arguments: {" ".join(names)}')
+
+        fields = dict(zip(names, words))
+
+        try:
+            addr = int(fields['addr'], 0)
+            size = int(fields['size'], 0) if 'size' in fields else None
+        except ValueError as e:
+            raise ValueError(f'{where}: {e}')
+
+        fpath = path.parent / fields['path'] if 'path' in fields else None
+
+        data = None
+        if op in ('write', 'verify', 'flash'):
+            try:
+                data = fpath.read_bytes()
+            except OSError as e:
+                raise ValueError(f'{where}: {e}')
+
+        steps.append(JobStep(op, addr, size, fpath, data, where))
+
+    return steps
+
+#------------------------------------------------------------------------------
+
+class _Batch:
+    """ A run of erase/write steps, what they amount to in the end """
+
+    def __init__(self):
+        self.erases = []    # [start, end)
+        self.writes = []    # (addr, data)
+
+    def _cut(self, start, end):
+        # drop the pending data in the area
+        writes = []
+
+        for addr, data in self.writes:
+            if addr + len(data) <= start or addr >= end:
+                writes.append((addr, data))
+                continue
+
+            if addr < start:
+                writes.append((addr, data[: start - addr]))
+            if addr + len(data) > end:
+                writes.append((end, data[end - addr :]))
+
+        self.writes = writes
+
+    def erase(self, start, end):
+        start &= ~(ERASE_BLOCK - 1)
+        end = (end + ERASE_BLOCK - 1) & ~(ERASE_BLOCK - 1)
+        self._cut(start, end)
+        self.erases.append((start, end))
+
+    def write(self, addr, data):
+        if len(data) == 0:
+            return
+
+        self.erases.append((addr & ~(ERASE_BLOCK - 1), (addr + len(data) + ERASE_BLOCK - 1) & ~(ERASE_BLOCK - 1)))
+        self._cut(addr, addr + len(data))
+        self.writes.append((addr, memoryview(data)))
+
+    def ops(self):
+        ops = []
+
+        erases = []
+        for start, end in sorted(self.erases):
+            if len(erases) > 0 and start <= erases[-1][1]:
+                erases[-1][1] = max(erases[-1][1], end)
+            else:
+                erases.append([start, end])
+
+        for start, end in erases:
+            ops.append(JobOp('erase', start, end - start, None, None))
+
+        writes = []
+        for addr, data in sorted(self.writes, key=lambda w: w[0]):
+            if len(writes) > 0 and addr - writes[-1][2] <= GAP_FILL:
+                prev = writes[-1]
+                prev[1] += b'\xff' * (addr - prev[2]) + data
+                prev[2] = addr + len(data)
+            else:
+                writes.append([addr, bytearray(data), addr + len(data)])
+
+        for addr, data, end in writes:
+            ops.append(JobOp('write', addr, len(data), None, data))
+
+        return ops
+
+def plan_job(steps, fsize=None):
+    """ Turn the job steps into the operations to do, `fsize` is the flash size (if it's known) """
+    ops = []
+    batch = _Batch()
+
+    def area_size(step):
+        if step.size > 0:
+            return step.size
+        if fsize is None:
+            raise ValueError(f'{step.where}: unknown flash size')
+        if step.addr >= fsize:
+            raise ValueError(f'{step.where}: address is out of range')
+        return fsize - step.addr
+
+    for step in steps:
+        if step.op == 'erase':
+            batch.erase(step.addr, step.addr + area_size(step))
+
+        elif step.op == 'write':
+            batch.write(step.addr, step.data)
+
+        elif step.op == 'flash':
+            try:
+                extents = image_extents(step.data)
+            except ValueError as e:
+                raise ValueError(f'{step.where}: {e}')
+
+            for start, end in extents:
+                batch.write(step.addr + start, memoryview(step.data)[start:end])
+
+        else:
+            # these look at the flash, so everything before them has to be done by then
+            ops += batch.ops()
+            batch = _Batch()
+
+            if step.op == 'read':
+                ops.append(JobOp('read', step.addr, area_size(step), step.path, None))
+            else:
+                ops.append(JobOp('verify', step.addr, len(step.data), step.path, step.data))
+
+    ops += batch.ops()
+
+    return ops
@@ -0,0 +1,60 @@
+""" Protocol metrics (counters and latency histograms) for the download interfaces """
+
+__all__ = ['Histogram', 'DlMetrics']
+
+import json
+from collections import Counter, defaultdict
+
+class Histogram:
+    """ Latency histogram with power-of-two microsecond buckets """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = Counter()   # bucket N holds values below 2**N microseconds
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min: self.min = seconds
+        if self.max is None or seconds > self.max: self.max = seconds
+        self.buckets[int(seconds * 1e6).bit_length()] += 1
+
+    def to_dict(self):
+        return {
+            'count':    self.count,
+            'total_us': round(self.total * 1e6),
+            'mean_us':  round(self.total * 1e6 / self.count) if self.count else None,
+            'min_us':   round(self.min * 1e6) if self.min is not None else None,
+            'max_us':   round(self.max * 1e6) if self.max is not None else None,
+            'buckets':  {f'<{1 << n}us': self.buckets[n] for n in sorted(self.buckets)},
+        }
+
+class DlMetrics:
+    """ Collection of named counters and latency histograms.
+
+    The interfaces only touch it when one has been supplied to them,
+    so there is no cost when the metrics are not being collected.
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = defaultdict(Histogram)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def latency(self, name, seconds):
+        self.histograms[name].add(seconds)
+
+    def to_dict(self):
+        return {
+            'counters':   dict(sorted(self.counters.items())),
+            'histograms': {name: self.histograms[name].to_dict() for name in sorted(self.histograms)},
+        }
+
+    def dump(self, f):
+        json.dump(self.to_dict(), f, indent=2)
+        f.write('\n')
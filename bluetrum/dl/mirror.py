@@ -0,0 +1,124 @@
+""" A local copy of what's in the flash of each device (told apart by the flash unique ID),
+kept up to date by every read, erase and write done through the download tool.
+
+It's tracked per 4k sector: a sector is either known (and then the CRC32 of its contents is remembered too),
+or not. Before trusting it, the sectors are supposed to be checked against the device's own checksums
+(see NitDlCmd.DEV_CHECKSUM), as the flash may have been changed by something else in the meantime.
+
+For each device there are two files in the mirror directory: "<uid>.bin", the contents (a sparse file, where
+the unknown sectors are just holes), and "<uid>.json", the flash ID and the CRCs of the known sectors.
+"""
+
+__all__ = ['SECTOR_SIZE', 'FlashMirror', 'default_mirror_dir']
+
+import json
+import os
+import zlib
+from pathlib import Path
+
+SECTOR_SIZE = 0x1000
+
+def default_mirror_dir():
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'bluetrum-dl'
+
+class FlashMirror:
+    def __init__(self, directory, flashid, flashuid):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.data_path = self.directory / f'{flashuid.hex()}.bin'
+        self.state_path = self.directory / f'{flashuid.hex()}.json'
+
+        self.flashid = flashid
+        self.sectors = {}       # index -> CRC32 of the known sectors
+
+        try:
+            state = json.loads(self.state_path.read_text())
+            # (the copies from back when the CRCs were 16-bit ones aren't any good)
+            if state.get('flashid') == flashid and state.get('checksum') == 'crc32' and self.data_path.exists():
+                self.sectors = {int(index): crc for index, crc in state['sectors'].items()}
+        except (OSError, ValueError, KeyError):
+            # nothing (usable) there yet
+            pass
+
+        self.f = open(self.data_path, 'r+b' if self.data_path.exists() else 'w+b')
+
+    def close(self):
+        self.save()
+        self.f.close()
+
+    def save(self):
+        state = {'flashid': self.flashid, 'checksum': 'crc32', 'sectors': {str(index): crc for index, crc in sorted(self.sectors.items())}}
+
+        tmp = self.state_path.with_name(self.state_path.name + '.tmp')
+        tmp.write_text(json.dumps(state) + '\n')
+        tmp.replace(self.state_path)
+
+    @staticmethod
+    def span(addr, size):
+        """ The range of the sectors the area touches """
+        return range(addr // SECTOR_SIZE, (addr + size + SECTOR_SIZE - 1) // SECTOR_SIZE)
+
+    #--------------------------------------------------
+
+    def known(self, index):
+        return index in self.sectors
+
+    def crc(self, index):
+        return self.sectors.get(index)
+
+    def forget(self, index):
+        self.sectors.pop(index, None)
+
+    def sector(self, index):
+        """ Get the contents of a known sector """
+        self.f.seek(index * SECTOR_SIZE)
+        data = self.f.read(SECTOR_SIZE)
+        return data + b'\xff' * (SECTOR_SIZE - len(data))
+
+    def read(self, addr, size):
+        """ Read the area, which has to be all in the known sectors """
+        self.f.seek(addr)
+        return self.f.read(size)
+
+    def _put(self, index, data):
+        self.f.seek(index * SECTOR_SIZE)
+        self.f.write(data)
+        self.sectors[index] = zlib.crc32(data)
+
+    #--------------------------------------------------
+
+    def update(self, addr, data):
+        """ The area has been found to contain `data` (e.g. it has been read from the device) """
+        for index in self.span(addr, len(data)):
+            soff = index * SECTOR_SIZE
+
+            if soff >= addr and soff + SECTOR_SIZE <= addr + len(data):
+                self._put(index, bytes(data[soff - addr : soff - addr + SECTOR_SIZE]))
+
+            elif index in self.sectors:
+                # only a part of it, which only makes sense for the known ones
+                sect = bytearray(self.sector(index))
+                start, end = max(addr, soff), min(addr + len(data), soff + SECTOR_SIZE)
+                sect[start - soff : end - soff] = data[start - addr : end - addr]
+                self._put(index, bytes(sect))
+
+    def erase(self, addr, size):
+        """ The area has been erased (it has to be aligned to the sectors) """
+        for index in self.span(addr, size):
+            self._put(index, b'\xff' * SECTOR_SIZE)
+
+    def program(self, addr, data):
+        """ The data has been programmed into the area (which only clears the bits) """
+        for index in self.span(addr, len(data)):
+            if index not in self.sectors:
+                continue
+
+            soff = index * SECTOR_SIZE
+            start, end = max(addr, soff), min(addr + len(data), soff + SECTOR_SIZE)
+
+            sect = bytearray(self.sector(index))
+            part = int.from_bytes(sect[start - soff : end - soff], 'little') & int.from_bytes(data[start - addr : end - addr], 'little')
+            sect[start - soff : end - soff] = part.to_bytes(end - start, 'little')
+
+            self._put(index, bytes(sect))
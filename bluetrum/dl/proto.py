@@ -0,0 +1,54 @@
+""" Commands of the bootloader and of the download blob (that are common for all the interfaces) """
+
+__all__ = ['BlCmd', 'NitDlCmd', 'NitDlCap', 'NitDlFlag', 'make_cb', 'parse_init_resp']
+
+import struct
+
+class BlCmd:
+    IFACE_PARAM         = 0x50
+    MEM_READ            = 0x52
+    AUTHORIZE           = 0x55
+    MEM_WRITE           = 0x57
+    SET_CMD_HANDLER     = 0x58
+    GET_INFO            = 0x5A
+    REBOOT              = 0x5E
+
+class NitDlCmd:
+    INIT                = 0x00
+    DEV_READ            = 0x01
+    DEV_WRITE           = 0x02
+    DEV_ERASE           = 0x03
+    DEV_CHECKSUM        = 0x04      # arg1: address, arg3: number of 4k sectors (up to 256) -- the CRC32 of each of them (see NitDlCap.CHECKSUM)
+
+class NitDlCap:
+    """ Optional features of the blob, it lists the ones it has in the INIT response """
+    MAGIC               = b'CAPS'   # the capability list is there only if it's preceded by this
+    RLE                 = 0x0001    # DEV_READ/DEV_WRITE data can be run-length encoded (see bluetrum.dl.rle)
+    QUEUED_ERASE        = 0x0002    # DEV_ERASE can be queued, the blob then takes the next commands and buffers
+                                    #  the DEV_WRITE data while the flash is erasing (holding it back with NYET/NAK when it's full)
+    CHECKSUM            = 0x0004    # DEV_CHECKSUM is there
+
+class NitDlFlag:
+    """ Flags in the arg2 of the DEV_READ/DEV_WRITE/DEV_ERASE commands """
+    RLE                 = 0x01      # DEV_READ/DEV_WRITE: the data packets are run-length encoded, arg3 is still the decoded size
+    ERASE_4K            = 0x02      # DEV_ERASE: erase a 4k sector instead of a 64k block
+    ERASE_QUEUED        = 0x04      # DEV_ERASE: queue the erase and take the next command right away (see NitDlCap.QUEUED_ERASE)
+
+
+
+def make_cb(cmd, arg1=0, arg2=0, arg3=0):
+    # just the unscrambled CB is fine for now
+    return struct.pack('>BIBH', cmd, arg1, arg2, arg3)
+
+def parse_init_resp(resp):
+    """ Parse the INIT response, returns the code key, flash ID, flash unique ID and the blob's capabilities.
+
+        The older blobs leave the rest of the response after the flash unique ID alone,
+        so there would be no capability magic, meaning no capabilities. """
+    codekey, flashid, flashuid = struct.unpack_from('<II16s', resp)
+
+    caps = 0
+    if len(resp) >= 32 and resp[24:28] == NitDlCap.MAGIC:
+        caps, = struct.unpack_from('<I', resp, 28)
+
+    return codekey, flashid, flashuid, caps
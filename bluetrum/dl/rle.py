@@ -0,0 +1,98 @@
+""" Run-length encoding of the DEV_READ/DEV_WRITE data packets.
+
+Each packet is encoded on its own (so it can be decoded as soon as it arrives,
+and a retransmitted one doesn't mess anything up), as a sequence of records:
+
+  0x00..0x7F  n-1, <n bytes>                -- n literal bytes (1..128)
+  0x80..0xFF  (n-1) >> 8 | 0x80, (n-1) & 0xFF, <byte>
+                                            -- the byte repeated n times (1..32768)
+"""
+
+__all__ = ['rle_encode_packets', 'rle_decode']
+
+import re
+
+MAX_LITERAL = 128
+MAX_RUN     = 32768
+MIN_RUN     = 5       # shorter runs are not worth breaking the literals for
+
+_runs_re = re.compile(rb'(.)\1{%d,}' % (MIN_RUN - 1), re.S)
+
+def _records(data):
+    """ Yields the literal (bytes) and the run (value, count) records of the data """
+    pos = 0
+
+    for m in _runs_re.finditer(data):
+        if m.start() > pos:
+            yield bytes(data[pos : m.start()])
+
+        count = m.end() - m.start()
+        while count > 0:
+            n = min(count, MAX_RUN)
+            yield (m.group(1)[0], n)
+            count -= n
+
+        pos = m.end()
+
+    if pos < len(data):
+        yield bytes(data[pos:])
+
+def rle_encode_packets(data, max_packet=512):
+    """ Encode the data into packets of at most `max_packet` bytes,
+        yields each packet along with the amount of data bytes it holds """
+    packet = bytearray()
+    size = 0
+
+    for rec in _records(data):
+        if isinstance(rec, tuple):
+            if len(packet) + 3 > max_packet:
+                yield bytes(packet), size
+                packet, size = bytearray(), 0
+
+            value, n = rec
+            packet += bytes([((n - 1) >> 8) | 0x80, (n - 1) & 0xFF, value])
+            size += n
+
+        else:
+            pos = 0
+            while pos < len(rec):
+                room = max_packet - len(packet) - 1
+                if room < 1:
+                    yield bytes(packet), size
+                    packet, size = bytearray(), 0
+                    continue
+
+                chunk = rec[pos : pos + min(room, MAX_LITERAL)]
+                packet.append(len(chunk) - 1)
+                packet += chunk
+                size += len(chunk)
+                pos += len(chunk)
+
+    if len(packet) > 0:
+        yield bytes(packet), size
+
+def rle_decode(packet):
+    """ Decode an encoded packet """
+    out = bytearray()
+    pos = 0
+
+    try:
+        while pos < len(packet):
+            c = packet[pos]
+
+            if c < 0x80:
+                n = c + 1
+                if pos + 1 + n > len(packet):
+                    raise ValueError('RLE literal goes past the end of the packet')
+                out += packet[pos + 1 : pos + 1 + n]
+                pos += 1 + n
+
+            else:
+                n = ((c & 0x7F) << 8 | packet[pos + 1]) + 1
+                out += bytes([packet[pos + 2]]) * n
+                pos += 3
+
+    except IndexError:
+        raise ValueError('RLE run record is cut short')
+
+    return bytes(out)
@@ -0,0 +1,304 @@
+""" A stand-in for a chip sitting in the UART bootloader (running the download blob),
+to try out the download protocol without any hardware around.
+
+It is used in place of a serial port (use the "standin:FILE" port in download.py),
+the flash contents are kept in a file.
+"""
+
+__all__ = ['StandinChip', 'StandinSerial']
+
+import struct
+import time
+import zlib
+from pathlib import Path
+
+from bluetrum.crc import ab_crc16
+from bluetrum.dl.proto import BlCmd, NitDlCmd, NitDlCap, NitDlFlag
+from bluetrum.dl.rle import rle_encode_packets, rle_decode
+from bluetrum.dl.uart import UARTDownload
+
+class StandinChip:
+    """ The chip's side of the protocol: the bootloader commands and the blob commands """
+
+    CHIPID   = b'BLUEPRAO\x01\x00\x00\x00'
+    LOADADDR = 0x12000
+    FLASHID  = 0x856013
+    FLASHUID = bytes(range(16))
+    CODEKEY  = 0xAABBCCDD
+
+    ERASE_QUEUE = 4             # how many erases can be queued up (with NitDlCap.QUEUED_ERASE)
+
+    def __init__(self, flash, caps=NitDlCap.RLE | NitDlCap.QUEUED_ERASE | NitDlCap.CHECKSUM, erase_time=(0.03, 0.15), prog_time=0.0005):
+        self.flash = flash
+        self.caps = caps            # capabilities of the blob, None for the blob that doesn't know about them at all
+        self.erase_time = erase_time
+        self.prog_time = prog_time  # (per data packet)
+
+        # the blob that can queue the erases buffers 8k of data to be programmed, the one that can't has just a single packet
+        self.queued_erase = ((caps or 0) & NitDlCap.QUEUED_ERASE) != 0
+        self.buffers = 16 if self.queued_erase else 1
+
+        self.busy_until = 0
+        self.flash_free = 0         # when the flash will be done with what it has been told to do
+        self.erase_ends = []        # when each of the queued erases will be done
+        self.prog_ends = []         # when each of the buffered data packets will be programmed
+        self.out = []               # the data packets to be sent out
+        self.cmd = None             # the command that's receiving data right now
+        self.blob_running = False
+
+    def busy(self):
+        return time.monotonic() < self.busy_until
+
+    def command(self, cb):
+        """ Process a command block, returns how long it will be processed """
+        cmd, arg1, arg2, arg3 = struct.unpack('>BIBH', cb[:8])
+        now = time.monotonic()
+
+        if cmd in (NitDlCmd.DEV_READ, NitDlCmd.DEV_WRITE, NitDlCmd.DEV_ERASE, NitDlCmd.DEV_CHECKSUM):
+            # the flash address wraps around
+            arg1 %= len(self.flash)
+
+        if cmd == BlCmd.GET_INFO:
+            self.out = [self.CHIPID + struct.pack('>III', self.LOADADDR, 0x11223344, 0)]
+        elif cmd == BlCmd.AUTHORIZE:
+            self.out = [struct.pack('>I', 0x55667788)]
+        elif cmd == BlCmd.IFACE_PARAM:
+            self.out = [bytes(2)]
+        elif cmd == BlCmd.MEM_WRITE:
+            self.cmd, self.expect, self.recvd = cmd, arg3 * 512, bytearray()
+        elif cmd == BlCmd.SET_CMD_HANDLER:
+            self.blob_running = True
+        elif cmd == BlCmd.REBOOT:
+            self.blob_running = False
+
+        elif not self.blob_running:
+            raise RuntimeError(f'Unknown bootloader command {cmd:02X}')
+
+        elif cmd == NitDlCmd.INIT:
+            resp = struct.pack('<II16s', self.CODEKEY, self.FLASHID, self.FLASHUID)
+            if self.caps is not None:
+                resp += NitDlCap.MAGIC + struct.pack('<I', self.caps)
+            self.out = [resp + bytes(48 - len(resp))]
+
+        elif cmd == NitDlCmd.DEV_READ:
+            data = bytes(self.flash[arg1 : arg1 + arg3])
+            if arg2 & NitDlFlag.RLE:
+                self.out = [packet for packet, _ in rle_encode_packets(data)]
+            else:
+                self.out = [data[i : i+512] for i in range(0, len(data), 512)]
+
+            # (it has to wait for the flash to finish whatever it's doing)
+            return max(0, self.flash_free - now)
+
+        elif cmd == NitDlCmd.DEV_CHECKSUM and (self.caps or 0) & NitDlCap.CHECKSUM:
+            crcs = [zlib.crc32(self.flash[addr : addr + 0x1000]) for addr in range(arg1 & ~0xFFF, (arg1 & ~0xFFF) + arg3 * 0x1000, 0x1000)]
+            self.out = [struct.pack(f'<{len(crcs)}I', *crcs)]
+
+            # (reading the flash out goes pretty fast, compared to sending it over)
+            return max(0, self.flash_free - now) + arg3 * 0.0002
+
+        elif cmd == NitDlCmd.DEV_WRITE:
+            self.cmd, self.expect, self.recvd = cmd, arg3, bytearray()
+            self.addr, self.rle = arg1, (arg2 & NitDlFlag.RLE) != 0
+
+        elif cmd == NitDlCmd.DEV_ERASE:
+            size = 0x1000 if arg2 & NitDlFlag.ERASE_4K else 0x10000
+            addr = arg1 & ~(size - 1)
+            self.flash[addr : addr + size] = b'\xff' * size
+
+            self.flash_free = max(now, self.flash_free) + (self.erase_time[0] if size == 0x1000 else self.erase_time[1])
+
+            if not (self.queued_erase and arg2 & NitDlFlag.ERASE_QUEUED):
+                return self.flash_free - now
+
+            # it only waits if the queue is full
+            self.erase_ends = [t for t in self.erase_ends if t > now] + [self.flash_free]
+            if len(self.erase_ends) > self.ERASE_QUEUE:
+                return self.erase_ends[-self.ERASE_QUEUE - 1] - now
+
+        else:
+            raise RuntimeError(f'Unknown blob command {cmd:02X}')
+
+        return 0
+
+    def data_packet(self, data):
+        """ Process a data packet, returns how long it will be processed """
+        if self.cmd is None:
+            return self.command(data)
+
+        cmd = self.cmd
+
+        if self.cmd == NitDlCmd.DEV_WRITE and self.rle:
+            data = rle_decode(data)
+
+        self.recvd += data
+
+        if len(self.recvd) >= self.expect:
+            if self.cmd == NitDlCmd.DEV_WRITE:
+                # (the flash bits can be only cleared by programming)
+                end = self.addr + self.expect
+                self.flash[self.addr : end] = (int.from_bytes(self.flash[self.addr : end], 'little') &
+                                               int.from_bytes(self.recvd[:self.expect], 'little')).to_bytes(self.expect, 'little')
+
+            self.cmd = None
+
+        if cmd == NitDlCmd.DEV_WRITE:
+            # the packet gets programmed once the flash is done with everything before it,
+            # and there's room for the next one as long as not all of the buffers are waiting for that
+            now = time.monotonic()
+            self.flash_free = max(now, self.flash_free) + self.prog_time
+            self.prog_ends = [t for t in self.prog_ends if t > now] + [self.flash_free]
+            if len(self.prog_ends) >= self.buffers:
+                return self.prog_ends[-self.buffers] - now
+            return 0
+
+        return self.prog_time if self.cmd is None else 0
+
+#------------------------------------------------------------------------------
+
+class StandinSerial:
+    """ Pretends to be a serial port with the stand-in chip on the other end (and with the TX looped back to RX).
+
+        The spec is "FILE[,option=value...]", where FILE holds the flash contents (it's created if it doesn't exist),
+        the options are: "size" - the flash size for a new file, "caps" - the blob capabilities ("none" for an old blob),
+        "line" - take as long to transfer the data as a real line at the current baudrate would (e.g. "line=1"). """
+
+    def __init__(self, spec):
+        path, *opts = spec.split(',')
+        opts = dict(opt.split('=', 1) for opt in opts)
+
+        self.path = Path(path)
+
+        if self.path.exists():
+            flash = bytearray(self.path.read_bytes())
+        else:
+            flash = bytearray(b'\xff') * int(opts.get('size', '0x80000'), 0)
+
+        caps = opts.get('caps')
+        if caps is None:
+            self.chip = StandinChip(flash)
+        else:
+            self.chip = StandinChip(flash, None if caps == 'none' else int(caps, 0))
+
+        self.line = 'line' in opts
+
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.reset()
+
+    def reset(self):
+        """ Reset the chip: it's back in the bootloader, waiting for the sync token """
+        self.chip.blob_running = False
+        self.chip.cmd = None
+        self.chip.out = []
+        self.tx.clear()
+        self.synced = False
+        self.last_sent = None   # the counter and the payload of the last data packet sent
+        self.timeout = None
+        self.baudrate = 115200
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.path.write_bytes(self.chip.flash)
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def reset_input_buffer(self):
+        self.rx.clear()
+
+    def read(self, size):
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def write(self, data):
+        if self.line:
+            # 8N1
+            time.sleep(len(data) * 10 / self.baudrate)
+
+        self.rx += data     # the echo
+        self.tx += data
+        self._process()
+
+    def _respond(self, token, counter, payload=None):
+        self.rx += bytes([token, counter])
+        if payload is not None:
+            self.rx += len(payload).to_bytes(2, 'little') + payload + ab_crc16(payload).to_bytes(2, 'little')
+
+    def _process(self):
+        chip, tx = self.chip, self.tx
+
+        while len(tx) > 0:
+            if tx[:4] == UARTDownload.SYNC_TOKEN:
+                del tx[:4]
+                self.rx += UARTDownload.SYNC_RESP
+                self.synced = True
+                continue
+
+            if tx[:2] == UARTDownload.RESET_TOKEN:
+                # communication reset: whatever transfer has been going on is dropped
+                del tx[:2]
+                chip.out = []
+                chip.cmd = None
+                self.last_sent = None
+                continue
+
+            if not self.synced:
+                # nobody's listening yet
+                if len(tx) < 4:
+                    return
+                del tx[:1]
+                continue
+
+            if len(tx) < 2:
+                return
+
+            token, counter = tx[0], tx[1]
+
+            if token == UARTDownload.DATA_TOKEN:
+                if len(tx) < 4:
+                    return
+                size = int.from_bytes(tx[2:4], 'little')
+                if len(tx) < 6 + size:
+                    return
+
+                data, crc = bytes(tx[4 : 4+size]), int.from_bytes(tx[4+size : 6+size], 'little')
+                del tx[:6+size]
+
+                if chip.busy() or len(chip.out) > 0 or ab_crc16(data) != crc:
+                    self._respond(UARTDownload.RESP_NAK, counter)
+                    continue
+
+                self.last_sent = None
+                delay = chip.data_packet(data)
+                if delay > 0:
+                    chip.busy_until = time.monotonic() + delay
+                    self._respond(UARTDownload.RESP_NYET, counter)
+                else:
+                    self._respond(UARTDownload.RESP_ACK, counter)
+
+            elif token == UARTDownload.PING_TOKEN:
+                del tx[:2]
+                self._respond(UARTDownload.RESP_NAK if chip.busy() else UARTDownload.RESP_ACK, counter)
+
+            elif token == UARTDownload.DATA_REQUEST:
+                del tx[:2]
+                if self.last_sent is not None and self.last_sent[0] == counter:
+                    # the host didn't get it right, send it again
+                    self._respond(UARTDownload.DATA_TOKEN, counter, self.last_sent[1])
+                elif chip.busy() or len(chip.out) == 0:
+                    self._respond(UARTDownload.RESP_NAK, counter)
+                else:
+                    self.last_sent = (counter, chip.out.pop(0))
+                    self._respond(UARTDownload.DATA_TOKEN, counter, self.last_sent[1])
+
+            else:
+                # garbage, skip it
+                del tx[:1]
@@ -0,0 +1,203 @@
+""" Recording of the UART sessions, and playing them back.
+
+The trace file starts with the magic and the wall clock time the recording has started at (a double),
+followed by the records, each being:
+
+  <kind:u8> <time since the previous record, in microseconds:u32> <length:u16> <data>
+
+where the kind is one of:
+
+  'W'  the bytes written into the port
+  'R'  the bytes read from the port (as returned by a single read, so an empty one means a timeout)
+  'B'  the baudrate has changed (the new one as an u32)
+  'F'  the input buffer has been flushed
+  'K'  a token exchange (the request token, its counter and the response token, or $FF if there was none)
+
+All the integers are little endian.
+"""
+
+__all__ = ['TraceRecord', 'TraceWriter', 'TracingPort', 'ReplaySerial', 'read_trace']
+
+import struct
+import time
+from collections import namedtuple
+
+TRACE_MAGIC = b'BTDLTRC\x01'
+
+TR_WRITE = ord('W')
+TR_READ  = ord('R')
+TR_BAUD  = ord('B')
+TR_FLUSH = ord('F')
+TR_TOKEN = ord('K')
+
+NO_RESPONSE = 0xFF
+
+TraceRecord = namedtuple('TraceRecord', 'kind time data')
+
+class TraceWriter:
+    """ Writes the trace records into a file """
+
+    def __init__(self, f):
+        self.f = f
+        self.t0 = self.tlast = time.perf_counter()
+        f.write(TRACE_MAGIC + struct.pack('<d', time.time()))
+
+    def record(self, kind, data=b''):
+        now = time.perf_counter()
+        dt = min(round((now - self.tlast) * 1e6), 0xFFFFFFFF)
+        self.tlast = now
+
+        # (a long one gets split up, the parts going right after each other)
+        for off in range(0, max(len(data), 1), 0xFFFF):
+            part = data[off : off + 0xFFFF]
+            self.f.write(struct.pack('<BIH', kind, dt, len(part)) + part)
+            dt = 0
+
+    def token(self, req, counter, resp):
+        self.record(TR_TOKEN, bytes([req, counter, NO_RESPONSE if resp is None else resp]))
+
+    def close(self):
+        self.f.close()
+
+def read_trace(f):
+    """ Read the trace file, returns the wall clock time of its start and the list of the records
+        (with the time being in seconds since the start) """
+    if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+        raise ValueError('Not a trace file')
+
+    start, = struct.unpack('<d', f.read(8))
+
+    records = []
+    t = 0
+
+    while True:
+        hdr = f.read(7)
+        if len(hdr) < 7:
+            break
+
+        kind, dt, size = struct.unpack('<BIH', hdr)
+        data = f.read(size)
+        if len(data) < size:
+            break
+
+        t += dt / 1e6
+        records.append(TraceRecord(kind, t, data))
+
+    return start, records
+
+#------------------------------------------------------------------------------
+
+class TracingPort:
+    """ Wraps a serial port, recording everything that goes through it """
+
+    def __init__(self, port, trace):
+        self.port = port
+        self.trace = trace
+
+    @property
+    def baudrate(self):
+        return self.port.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baud):
+        self.port.baudrate = baud
+        self.trace.record(TR_BAUD, struct.pack('<I', baud))
+
+    @property
+    def timeout(self):
+        return self.port.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.port.timeout = timeout
+
+    @property
+    def in_waiting(self):
+        return self.port.in_waiting
+
+    def reset_input_buffer(self):
+        self.port.reset_input_buffer()
+        self.trace.record(TR_FLUSH)
+
+    def write(self, data):
+        self.trace.record(TR_WRITE, bytes(data))
+        return self.port.write(data)
+
+    def read(self, size):
+        data = self.port.read(size)
+        self.trace.record(TR_READ, data)
+        return data
+
+#------------------------------------------------------------------------------
+
+class ReplaySerial:
+    """ Pretends to be a serial port, with the chip's side of a recorded session on the other end.
+
+        Each read returns what the recorded one did, no earlier than it did (relative to the last write)
+        unless the speed is zero, and each write has to be the same as the recorded one, otherwise the
+        host has done something else than it did back then, and the replay can't go on.
+
+        The spec is "FILE[,speed=N]", where the speed scales the time (e.g. 2 goes twice as fast, 0 doesn't wait at all). """
+
+    def __init__(self, spec):
+        path, *opts = spec.split(',')
+        opts = dict(opt.split('=', 1) for opt in opts)
+
+        self.speed = float(opts.get('speed', '1'))
+
+        with open(path, 'rb') as f:
+            _, records = read_trace(f)
+
+        self.records = [rec for rec in records if rec.kind in (TR_WRITE, TR_READ)]
+        self.pos = 0
+        self.anchor = None      # when the last write happened, (real time, recorded time)
+        self.baudrate = 115200
+        self.timeout = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _next(self, kind):
+        if self.pos >= len(self.records):
+            raise RuntimeError(f'Replay: the trace is over, yet the host wants to {"write" if kind == TR_WRITE else "read"} more')
+
+        rec = self.records[self.pos]
+        if rec.kind != kind:
+            raise RuntimeError(f'Replay: the host went off the trace at {rec.time:.6f}s (record #{self.pos}),'
+                               f' it {"writes" if kind == TR_WRITE else "reads"} instead')
+
+        self.pos += 1
+        return rec
+
+    @property
+    def in_waiting(self):
+        # (the reads are replayed whole anyway)
+        return 0
+
+    def reset_input_buffer(self):
+        pass
+
+    def write(self, data):
+        rec = self._next(TR_WRITE)
+
+        if bytes(data) != rec.data:
+            raise RuntimeError(f'Replay: the host went off the trace at {rec.time:.6f}s (record #{self.pos - 1}),'
+                               f' it writes {bytes(data[:16]).hex()} instead of {rec.data[:16].hex()}')
+
+        self.anchor = (time.monotonic(), rec.time)
+
+    def read(self, size):
+        rec = self._next(TR_READ)
+
+        if self.speed > 0 and self.anchor is not None:
+            delay = self.anchor[0] + (rec.time - self.anchor[1]) / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        return rec.data
@@ -1,6 +1,35 @@
 from bluetrum.crc import ab_crc16
+from bluetrum.dl.trace import TracingPort
 import time
 
+class PollPolicy:
+    """ How to poll the chip while it is busy with an operation.
+
+    The chip is polled quickly at first, then the interval between the polls
+    grows exponentially up to a fraction of the time the operation is expected
+    to take, so that short operations are picked up right away while the long
+    ones (e.g. erasing a 64k block) don't flood the line with tokens.
+    Once `deadline` seconds have passed, the chip is given up on.
+    """
+
+    def __init__(self, name, expected, deadline):
+        self.name = name
+        self.expected = expected
+        self.deadline = deadline
+
+        self.max_delay = min(0.05, expected / 4)
+        self.min_delay = self.max_delay / 4
+
+    def delays(self):
+        """ Yields the delays to wait before each next poll, until the deadline is hit """
+        tend = time.monotonic() + self.deadline
+        delay = self.min_delay
+        while time.monotonic() < tend:
+            yield delay
+            delay = min(delay * 2, self.max_delay)
+
+#------------------------------------------
+
 class UARTDownload:
     # special tokens
     SYNC_TOKEN  = b'\xA5\x96\x87\x5A'   # Sync token
@@ -17,22 +46,55 @@ class UARTDownload:
     DATA_REQUEST = 0xB4   # Request for data. DATA: there it is, NAK: not available
     PING_TOKEN   = 0xC3   # Can we send more data? ACK: yes, NAK: no
 
+    TOKEN_NAMES = {
+        RESP_ACK:       'ACK',
+        RESP_NAK:       'NAK',
+        RESP_NYET:      'NYET',
+        DATA_TOKEN:     'DATA',
+        DATA_REQUEST:   'DATA_REQUEST',
+        PING_TOKEN:     'PING',
+    }
+
     #------------------------------------------
 
-    def __init__(self, port):
-        self.port = port
+    def __init__(self, port, metrics=None, poll=None, trace=None):
+        self.metrics = metrics   # a DlMetrics instance to collect the protocol metrics into
+        self.trace = trace       # a TraceWriter to record everything that goes through the port into
+        self.port = port if trace is None else TracingPort(port, trace)
+        self.rxbuf = bytearray()
+        # polling policy of the commands that don't specify anything else
+        self.default_poll = poll or PollPolicy('command', 0.001, 5)
         self.comms_reset()
 
+    def port_fetch(self, size):
+        # fetch everything that has arrived so far (but at least `size` bytes) in one go
+        if len(self.rxbuf) < size:
+            self.rxbuf += self.port.read(max(size - len(self.rxbuf), self.port.in_waiting))
+        return len(self.rxbuf) >= size
+
+    def port_ensure(self, size):
+        if not self.port_fetch(size):
+            # whatever came in is no good anyway
+            have = len(self.rxbuf)
+            self.rxbuf.clear()
+            raise TimeoutError(f'Not enough data has been received from the port (had only {have} bytes)')
+
     def port_read(self, size):
-        data = self.port.read(size)
-        if len(data) < size:
-            raise TimeoutError(f'Not enough data has been received from the port (had only {len(data)} bytes)')
+        self.port_ensure(size)
+        data = bytes(self.rxbuf[:size])
+        del self.rxbuf[:size]
         return data
 
+    def reset_input_buffer(self):
+        self.rxbuf.clear()
+        self.port.reset_input_buffer()
+
     def port_write(self, data):
         self.port.write(data)
         # consume the echo back
-        echo = self.port.read(len(data))
+        self.port_fetch(len(data))
+        echo = self.rxbuf[:len(data)]
+        del self.rxbuf[:len(data)]
         #if len(echo) < len(data):
         #    raise TimeoutError('Did not receive the echo back')
         #if echo != data:
@@ -41,6 +103,23 @@ class UARTDownload:
     def comms_reset(self):
         self.counter = 0
         self.ping_before_send = False
+        self.busy = self.default_poll   # the polling policy of what the chip is busy with right now
+
+    def _wait_busy(self, waits):
+        """ Wait before polling the busy chip again, returns the updated wait state """
+        if waits is None:
+            waits = self.busy.delays()
+
+        delay = next(waits, None)
+        if delay is None:
+            raise TimeoutError(f'The chip did not complete the "{self.busy.name}" operation within {self.busy.deadline} seconds')
+
+        if self.metrics is not None:
+            self.metrics.count(f'wait.{self.busy.name}')
+            self.metrics.latency(f'wait.{self.busy.name}', delay)
+
+        time.sleep(delay)
+        return waits
 
     def send_reset(self, hard=False):
         if not hard:
@@ -71,47 +150,81 @@ class UARTDownload:
     def _make_data_payload(self, data):
         return len(data).to_bytes(2, 'little') + data + ab_crc16(data).to_bytes(2, 'little')
 
-    def _recv_data_payload(self):
+    def _recv_data_payload(self, buff=None):
         # receive data length
         size = int.from_bytes(self.port_read(2), 'little')
-        # receive data payload
-        data = self.port_read(size)
-        # receive data CRC
-        crc = int.from_bytes(self.port_read(2), 'little')
+        # receive data payload along with its CRC
+        self.port_ensure(size + 2)
 
-        # check the received data CRC
-        if ab_crc16(data) != crc:
-            raise ValueError('Received data packet CRC mismatch')
+        data = memoryview(self.rxbuf)[:size]
+        crc = int.from_bytes(self.rxbuf[size:size+2], 'little')
 
-        # return the data payload
-        return data
+        try:
+            # check the received data CRC
+            if ab_crc16(data) != crc:
+                raise ConnectionError('Received data packet CRC mismatch')
+
+            # return the data payload
+            if buff is None:
+                return bytes(data)
+
+            # or put it into the supplied buffer
+            if size > len(buff):
+                raise BufferError(f'Received data packet ({size} bytes) does not fit into the buffer ({len(buff)} bytes)')
+            buff[:size] = data
+            return size
+
+        finally:
+            data.release()
+            del self.rxbuf[:size+2]
+
+    def _count_response(self, req, resp, t0):
+        # account a token round trip in the metrics
+        self.metrics.latency(f'rtt.{req}', time.perf_counter() - t0)
+        self.metrics.count(f'{req}.{UARTDownload.TOKEN_NAMES.get(resp, f"{resp:02X}")}')
+
+    def send_packet(self, data, busy=None):
+        """ Send a data packet; `busy` is the PollPolicy of the operation
+            that the chip would be busy with after receiving it. """
+
+        m = self.metrics
+        if m is not None:
+            tstart = time.perf_counter()
+            m.count('bytes.sent', len(data))
 
-    def send_packet(self, data):
         data = self._make_data_payload(data)
 
         do_ping = self.ping_before_send
+        waits = None
 
-        # TODO: time out, maybe?
         while True:
             if do_ping:
                 # send a PING token
+                req = 'PING'
                 packet = self._make_token_packet(UARTDownload.PING_TOKEN)
             else:
                 # send a DATA packet
+                req = 'DATA'
                 packet = self._make_token_packet(UARTDownload.DATA_TOKEN) + data
 
             tries = 0
             while True:
+                if m is not None: t0 = time.perf_counter()
+
                 self.port_write(packet)
 
                 try:
                     resp = self._recv_token_packet()
                 except TimeoutError:
                     # maybe a reception failure or a CRC error.
+                    if self.trace is not None: self.trace.token(packet[0], packet[1], None)
+                    if m is not None: m.count(f'{req}.timeout')
                     if tries > 10:
                         raise TimeoutError("Could not send a data packet.")
                     tries += 1
                 else:
+                    if self.trace is not None: self.trace.token(packet[0], packet[1], resp)
+                    if m is not None: self._count_response(req, resp, t0)
                     break
 
             if do_ping:
@@ -120,60 +233,85 @@ class UARTDownload:
                     do_ping = False
                 elif resp == UARTDownload.RESP_NAK:
                     # Not yet.
-                    pass
+                    waits = self._wait_busy(waits)
                 else:
                     raise RuntimeError(f'Ping: Unexpected response token {resp:02X}')
             else:
                 if resp == UARTDownload.RESP_ACK:
                     # All fine
                     self.ping_before_send = False
-                    return
+                    break
                 elif resp == UARTDownload.RESP_NYET:
                     # Received fine, but the previous data block hasn't been processed yet.
                     self.ping_before_send = True  # better to ping it next time.
-                    return
+                    break
                 elif resp == UARTDownload.RESP_NAK:
                     # Failed, perhaps the chip is busy.
                     do_ping = True  # start pinging.
+                    waits = self._wait_busy(waits)
                 else:
                     raise RuntimeError(f'Tx: Unexpected response token {resp:02X}')
 
-    def recv_packet(self):
+        # now the chip is busy with this packet
+        self.busy = busy or self.default_poll
+
+        if m is not None:
+            m.latency('packet.send', time.perf_counter() - tstart)
+
+    def recv_packet(self, buff=None):
+        """ Receive a data packet; if `buff` is specified, the data is put into it
+            and the amount of received bytes is returned instead of the data itself. """
+
+        m = self.metrics
+        if m is not None:
+            tstart = time.perf_counter()
+
         # the request packet needs to be sent with the same counter value
         #  in case we need to re-request data in case of a CRC failure etc.
         #  otherwise the chip assumes the data was received ok
         request = self._make_token_packet(UARTDownload.DATA_REQUEST)
 
         tries = 0
+        waits = None
 
-        # TODO: a timeout?
         while True:
+            if m is not None: t0 = time.perf_counter()
+
             self.port_write(request)
 
             try:
                 resp = self._recv_token_packet()
             except TimeoutError:
                 # maybe chip didn't receive the request
+                if self.trace is not None: self.trace.token(request[0], request[1], None)
+                if m is not None: m.count('DATA_REQUEST.timeout')
                 if tries > 10:
                     raise TimeoutError("Could not request a data packet.")
                 tries += 1
                 continue
             else:
                 tries = 0
+                if self.trace is not None: self.trace.token(request[0], request[1], resp)
 
             if resp == UARTDownload.DATA_TOKEN:
                 # Here's the data
                 try:
                     # receive the data packet
-                    data = self._recv_data_payload()
-                except:
+                    data = self._recv_data_payload(buff)
+                except (TimeoutError, ConnectionError) as e:
                     # something failed, ask for data again.
-                    pass
+                    if m is not None: m.count('error.crc' if isinstance(e, ConnectionError) else 'error.payload_timeout')
                 else:
                     # successful reception
+                    if m is not None:
+                        self._count_response('DATA_REQUEST', resp, t0)
+                        m.count('bytes.received', data if buff is not None else len(data))
+                        m.latency('packet.recv', time.perf_counter() - tstart)
                     return data
             elif resp == UARTDownload.RESP_NAK:
                 # Failed, chip does not have any data block yet.
+                if m is not None: self._count_response('DATA_REQUEST', resp, t0)
+                waits = self._wait_busy(waits)
                 continue
             else:
                 raise RuntimeError(f'Rx: Unexpected response token {resp:02X}')
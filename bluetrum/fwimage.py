@@ -0,0 +1,598 @@
+""" Firmware image structures """
+
+__all__ = [
+    'BootHeader',
+    'RegionEntry',
+    'RegionHeader',
+    'parse_boot_header',
+    'parse_region_table',
+    'parse_region_header',
+    'region_data_end',
+    'region_key',
+    'region_block_crcs',
+    'decrypt_boot_code',
+    'decrypt_region',
+    'RegionReader',
+    'FirmwareImage',
+    'ResEntry',
+    'parse_res_table',
+    'image_extents',
+    'verify_image',
+]
+
+import struct
+from collections import namedtuple
+
+from .cipher import ab_lfsr_cipher, ab_lfsr_cipher_in, ab_lfsr_cipher_multi, ab_lfsr_descramble_blocks
+from .crc import ab_crc16, ab_crc16_blocks, ab_crc16_shift
+from .magic import *
+
+#---------------------------------------
+
+BootHeader = namedtuple('BootHeader',
+    'magic chipid bootload bootentry bootoff bootsize bootcrc rest crc crc_ok')
+
+RegionEntry = namedtuple('RegionEntry',
+    'offset size what crc index scrambled')
+
+RegionHeader = namedtuple('RegionHeader',
+    'offset type hsize dsize crcoff crc_ok')
+
+ResEntry = namedtuple('ResEntry',
+    'index name offset size')
+
+def parse_boot_header(data):
+    """ Decrypt and parse the boot header (the first 64 bytes of the image) """
+    hdr = ab_lfsr_cipher(bytes(data[0x00:0x40]), MAGICKEY_LVMG)
+
+    fields = struct.unpack('<4s8sIIIIH32sH', hdr)
+    hmagic = fields[0]
+
+    if hmagic[0] != 0x5A or (sum(hmagic) & 0xFF) != 0x00:
+        raise ValueError(f'Header magic is invalid ({hmagic.hex()})')
+
+    return BootHeader(*fields, ab_crc16(hdr[:0x3E]) == fields[-1])
+
+def parse_region_table(data):
+    """ Decrypt and parse the region table, returns the list of non-empty entries
+        and whether the table CRC is correct """
+    rtcrc, = struct.unpack_from('<H', data, 0x80)
+    table = ab_lfsr_cipher(bytes(data[0x40:0x80]), MAGICKEY_XAPP ^ (0x00010001 * rtcrc))
+
+    regions = []
+
+    for off in range(0x00, 0x20, 0x10):
+        # offset, size, what, CRC16, index, scrambled
+        entry = RegionEntry(*struct.unpack_from('<IIIHBB', table, off))
+        if entry.offset == 0 and entry.size == 0:
+            continue
+        regions.append(entry)
+
+    return regions, ab_crc16(table) == rtcrc
+
+def parse_region_header(data, offset):
+    """ Parse the (unscrambled) region header located at `offset` """
+    rtype, hsize, dsize, crcoff, hcrc = struct.unpack_from('<4sIIHH', data, offset)
+
+    rtype = bytes([v & 0x7F for v in rtype]).decode()
+
+    return RegionHeader(offset, rtype, hsize, dsize, crcoff,
+                        ab_crc16(bytes(data[offset : offset+14])) == hcrc)
+
+def region_data_end(rhdr, last):
+    """ End of the region's data area, as far as the scrambling and the region CRC go """
+    dataend = rhdr.offset + rhdr.hsize + rhdr.dsize
+
+    if last:
+        # the last region spans up to a 4k boundary (despite the headers claiming less)
+        return (dataend + 0xfff) & ~0xfff
+    else:
+        # and everything else up to a 512-byte boundary
+        return (dataend + 0x1ff) & ~0x1ff
+
+def region_key(entry, bootcrc, codekey=0):
+    """ Scrambling key of the region (None if it's not scrambled at all) """
+    if not entry.scrambled:
+        return None
+
+    if entry.index == 0:
+        # the main app region uses the special key
+        return MAGICKEY_XAPP ^ (0x00010001 * bootcrc) ^ codekey
+    else:
+        # everything else (e.g. resources) do not
+        return 0
+
+def region_block_crcs(data, rhdr, dataend):
+    """ Get the CRCs of the region's data blocks (up to `dataend`) from its block CRC table """
+    nblocks = (dataend - (rhdr.offset + rhdr.hsize)) // 512
+    return struct.unpack_from(f'<{nblocks}H', data, rhdr.offset + rhdr.crcoff)
+
+def decrypt_boot_code(data, hdr):
+    """ Decrypt the boot code, returns it along with whether its CRC is correct """
+    code = bytearray(data[hdr.bootoff : hdr.bootoff + hdr.bootsize])
+
+    ab_lfsr_cipher_multi(code, 0,
+        [MAGICKEY_LVMG ^ (0x00010001 * hdr.bootcrc) ^ (((hdr.bootoff + off) >> 9) - 1) for off in range(0, len(code), 512)])
+
+    return code, ab_crc16(code) == hdr.bootcrc
+
+def decrypt_region(data, rhdr, dataend, key):
+    """ Decrypt the region's data area (up to `dataend`) with the key obtained by region_key(),
+        returns the data along with the list of blocks that have a CRC mismatch """
+    dataoff = rhdr.offset + rhdr.hsize
+    rdata = bytearray(data[dataoff : dataend])
+
+    crcs = region_block_crcs(data, rhdr, dataend)
+
+    actual, _ = ab_lfsr_descramble_blocks(rdata, 0, crcs, key)
+
+    bad = [block for block, (crc, blockcrc) in enumerate(zip(actual, crcs))
+           if block * 512 < rhdr.dsize and crc != blockcrc]
+
+    return rdata, bad
+
+class RegionReader:
+    """ Random access to the region's data, only the blocks that are being read get decrypted """
+
+    def __init__(self, data, rhdr, dataend, key):
+        self.data = data
+        self.rhdr = rhdr
+        self.key = key
+        self.dataoff = rhdr.offset + rhdr.hsize
+        self.crcs = region_block_crcs(data, rhdr, dataend)
+        self.cache = {}
+
+    def block(self, index):
+        """ Get the decrypted contents of a data block """
+        blk = self.cache.get(index)
+
+        if blk is None:
+            off = self.dataoff + index * 512
+            blk = bytearray(self.data[off : off+512])
+
+            if self.key is not None:
+                ab_lfsr_cipher_in(blk, 0, len(blk), self.key ^ self.crcs[index])
+
+            self.cache[index] = blk
+
+        return blk
+
+    def load(self, first, last):
+        """ Decrypt the blocks `first`...`last` (those that haven't been already) in one go """
+        missing = [i for i in range(first, min(last + 1, len(self.crcs))) if i not in self.cache]
+        if len(missing) == 0:
+            return
+
+        start, end = missing[0], missing[-1] + 1
+
+        off = self.dataoff + start * 512
+        buf = bytearray(self.data[off : off + (end - start) * 512])
+
+        if self.key is not None:
+            ab_lfsr_cipher_multi(buf, 0, [self.key ^ crc for crc in self.crcs[start:end]])
+
+        for i in missing:
+            self.cache[i] = buf[(i - start) * 512 : (i - start + 1) * 512]
+
+    def block_ok(self, index):
+        """ Check the block's CRC """
+        return ab_crc16(self.block(index), index + 1) == self.crcs[index]
+
+    def read(self, offset, size, check=False):
+        """ Read the data at `offset` within the region data area, checking the CRCs of the blocks involved if `check` is set """
+        if size > 0:
+            self.load(offset // 512, (offset + size - 1) // 512)
+
+            if check:
+                for i in range(offset // 512, (offset + size - 1) // 512 + 1):
+                    if i < len(self.crcs) and not self.block_ok(i):
+                        raise ValueError(f'Block #{i} CRC mismatch')
+
+        out = bytearray()
+
+        while size > 0:
+            blk = self.block(offset // 512)
+            part = blk[offset % 512 : offset % 512 + size]
+            if len(part) == 0:
+                raise ValueError('Read goes beyond the region')
+
+            out += part
+            offset += len(part)
+            size -= len(part)
+
+        return out
+
+    def res_table(self, base=0x11000000):
+        """ Parse the resource entry table (see parse_res_table) of the region """
+        entcnt, = struct.unpack('<I', self.read(28, 4))
+        if 32 + entcnt * 32 >= self.rhdr.dsize:
+            raise ValueError('Entries go over the res region')
+
+        return parse_res_table(self.read(0, 32 + entcnt * 32), base, self.rhdr.dsize)
+
+#---------------------------------------
+
+class FirmwareImage:
+    """ A firmware image opened for random access to its regions and resources,
+        only the blocks that are actually being read get decrypted.
+
+        The `data` can be anything that can be sliced, e.g. a mmap (see FirmwareImage.open). """
+
+    def __init__(self, data, codekey=0):
+        self.data = data
+        self.codekey = codekey
+        self.hdr = parse_boot_header(data)
+
+        entries, self.rtcrc_ok = parse_region_table(data)
+
+        self.regions = {}   # type -> (entry, header, reader)
+
+        for ri, entry in enumerate(entries):
+            rhdr = parse_region_header(data, entry.offset)
+            if not rhdr.crc_ok:
+                raise ValueError(f'Region header CRC mismatch at @{entry.offset:x}')
+
+            dataend = min(region_data_end(rhdr, (ri+1) == len(entries)), len(data))
+            reader = RegionReader(data, rhdr, dataend, region_key(entry, self.hdr.bootcrc, codekey))
+
+            self.regions[rhdr.type] = (entry, rhdr, reader)
+
+        self._resources = None
+        self._file = None
+        self._write_through = False
+
+    @classmethod
+    def open(cls, path, codekey=0, use_mmap=True, writable=False):
+        """ Open the image file, it's mapped into memory (unless `use_mmap` is False, or it can't be done) instead of being read whole.
+            If it's `writable`, the changes (see replace_resource) go right into the file. """
+        f = open(path, 'r+b' if writable else 'rb')
+
+        try:
+            data = None
+            write_through = False
+
+            if use_mmap:
+                try:
+                    import mmap
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+                except (ImportError, OSError, ValueError):
+                    # (e.g. an empty file, or something that can't be mapped)
+                    pass
+
+            if data is None:
+                if writable:
+                    # the changed parts have to be written into the file then
+                    data = bytearray(f.read())
+                    write_through = True
+                else:
+                    data = f.read()
+
+            image = cls(data, codekey)
+
+        except BaseException:
+            f.close()
+            raise
+
+        image._file = f
+        image._write_through = write_through
+        return image
+
+    def close(self):
+        if hasattr(self.data, 'flush') and hasattr(self.data, 'close'):
+            # (a mmap, which may have been written into)
+            self.data.flush()
+        if hasattr(self.data, 'close'):
+            self.data.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def region(self, rtype):
+        """ Get the RegionReader of the region (e.g. 'XRES') """
+        if rtype not in self.regions:
+            raise KeyError(f'No {rtype} region in the image')
+        return self.regions[rtype][2]
+
+    def resources(self):
+        """ List the resource entries (ResEntry) of the resource region """
+        if self._resources is None:
+            self._resources = self.region('XRES').res_table()
+        return self._resources
+
+    def find_resource(self, name):
+        """ Find the resource entry by its name """
+        for res in self.resources():
+            if res.name == name:
+                return res
+        raise KeyError(f'No resource named "{name}"')
+
+    def read_resource(self, res, check=True):
+        """ Read the resource (given by its entry or name), checking the CRCs of the blocks it covers if `check` is set """
+        if isinstance(res, str):
+            res = self.find_resource(res)
+        return bytes(self.region('XRES').read(res.offset, res.size, check))
+
+    #---------------------------------------
+
+    def _store(self, offset, chunk):
+        self.data[offset : offset + len(chunk)] = chunk
+
+        if self._write_through:
+            self._file.seek(offset)
+            self._file.write(chunk)
+
+    def resource_slot(self, res):
+        """ How much space the resource can take up, that is up to the next resource (or the end of the region) """
+        if isinstance(res, str):
+            res = self.find_resource(res)
+
+        end = self.regions['XRES'][1].dsize
+
+        for other in self.resources():
+            if other.index == res.index or other.size == 0:
+                continue
+
+            if other.offset < res.offset + max(res.size, 1) and res.offset < other.offset + other.size:
+                raise ValueError(f'"{res.name}" shares its data with "{other.name}"')
+
+            if other.offset >= res.offset:
+                end = min(end, other.offset)
+
+        return end - res.offset
+
+    def replace_resource(self, res, newdata):
+        """ Put the new data in place of the resource (given by its entry or name), if it fits into its slot (see resource_slot).
+
+            Only the data blocks it touches get decrypted and scrambled again, their CRCs in the block CRC table are updated,
+            and the region CRC is adjusted by the difference they make (the CRC being linear), so the rest of the region stays as it is.
+            The unused part of the old data gets zeroed, like the alignment padding between the resources.
+
+            The data has to be writable (e.g. a bytearray, or an image opened with FirmwareImage.open(..., writable=True)).
+            Returns the updated resource entry. """
+        if isinstance(res, str):
+            res = self.find_resource(res)
+
+        entry, rhdr, reader = self.regions['XRES']
+
+        slot = self.resource_slot(res)
+        if len(newdata) > slot:
+            raise ValueError(f'"{res.name}" does not fit into its slot ({len(newdata)} > {slot} bytes)')
+
+        if not self.rtcrc_ok:
+            raise ValueError('Region table CRC mismatch')
+
+        # what changes in the region data: the resource data and the size in its entry
+        changes = [(res.offset, bytes(newdata) + bytes(max(res.size - len(newdata), 0)))]
+        if len(newdata) != res.size:
+            changes.append((32 + res.index * 32 + 28, struct.pack('<I', len(newdata))))
+
+        touched = sorted({blk for off, chunk in changes for blk in range(off // 512, (off + len(chunk) - 1) // 512 + 1)})
+
+        dataoff = rhdr.offset + rhdr.hsize
+        datalen = len(reader.crcs) * 512
+        nblocks = (rhdr.dsize + 511) // 512
+
+        crcs = list(reader.crcs)
+        rcrc = entry.crc
+
+        # the runs of the touched blocks
+        runs = []
+        for blk in touched:
+            if len(runs) > 0 and runs[-1][1] == blk:
+                runs[-1][1] += 1
+            else:
+                runs.append([blk, blk + 1])
+
+        for first, last in runs:
+            reader.load(first, last - 1)
+
+            for blk in range(first, last):
+                if not reader.block_ok(blk):
+                    raise ValueError(f'Block #{blk} CRC mismatch')
+
+            old = b''.join(reader.block(blk) for blk in range(first, last))
+            new = bytearray(old)
+
+            for off, chunk in changes:
+                start, end = max(off, first * 512), min(off + len(chunk), last * 512)
+                if start < end:
+                    new[start - first * 512 : end - first * 512] = chunk[start - off : end - off]
+
+            # the new block CRCs, and the difference the new data makes to the region CRC
+            _, oldcrc = ab_crc16_blocks(old, 0, last - first, crc=0)
+            crcs[first:last], newcrc = ab_crc16_blocks(new, 0, last - first, crc=0, index=first)
+            rcrc ^= ab_crc16_shift(oldcrc ^ newcrc, datalen - last * 512)
+
+            for blk in range(first, last):
+                reader.cache[blk] = new[(blk - first) * 512 : (blk - first + 1) * 512]
+
+            if reader.key is not None:
+                ab_lfsr_cipher_multi(new, 0, [reader.key ^ crc for crc in crcs[first:last]])
+
+            self._store(dataoff + first * 512, new)
+
+        # the block CRC table, and the filler after it (if it's the CRCs of what precedes each of the words, like fwmake1.py makes it),
+        # which also serves as the CRCs of the padding blocks after the last region
+        crcoff = rhdr.offset + rhdr.crcoff
+        table = bytearray(self.data[rhdr.offset : dataoff])
+
+        filled = all(struct.unpack_from('<H', table, off - rhdr.offset)[0] == ab_crc16(table[: off - rhdr.offset], off)
+                     for off in range(crcoff + 2 * nblocks, dataoff, 2))
+
+        struct.pack_into(f'<{nblocks}H', table, rhdr.crcoff, *crcs[:nblocks])
+
+        if filled:
+            for off in range(crcoff + 2 * nblocks, dataoff, 2):
+                struct.pack_into('<H', table, off - rhdr.offset, ab_crc16(table[: off - rhdr.offset], off))
+
+            padcrcs = list(struct.unpack_from(f'<{len(crcs) - nblocks}H', table, rhdr.crcoff + 2 * nblocks))
+
+            if reader.key is not None and padcrcs != crcs[nblocks:]:
+                # the padding blocks are scrambled with those, so they're scrambled anew
+                pad = bytearray(self.data[dataoff + nblocks * 512 : dataoff + datalen])
+                ab_lfsr_cipher_multi(pad, 0, [reader.key ^ crc for crc in crcs[nblocks:]])
+                ab_lfsr_cipher_multi(pad, 0, [reader.key ^ crc for crc in padcrcs])
+                self._store(dataoff + nblocks * 512, pad)
+
+            crcs[nblocks:] = padcrcs
+
+        self._store(rhdr.offset, table)
+        reader.crcs = tuple(crcs)
+
+        # and the region table with the new region CRC
+        rtcrc, = struct.unpack_from('<H', self.data, 0x80)
+        rtable = bytearray(ab_lfsr_cipher(bytes(self.data[0x40:0x80]), MAGICKEY_XAPP ^ (0x00010001 * rtcrc)))
+
+        for off in range(0x00, 0x20, 0x10):
+            if struct.unpack_from('<I', rtable, off)[0] == entry.offset:
+                struct.pack_into('<H', rtable, off + 12, rcrc)
+
+        rtcrc = ab_crc16(rtable)
+        self._store(0x40, ab_lfsr_cipher(bytes(rtable), MAGICKEY_XAPP ^ (0x00010001 * rtcrc)))
+        self._store(0x80, struct.pack('<H', rtcrc))
+
+        self.regions['XRES'] = (entry._replace(crc=rcrc), rhdr, reader)
+        self._resources = None
+
+        return res._replace(size=len(newdata))
+
+#---------------------------------------
+
+def parse_res_table(data, base=0x11000000, size=None):
+    """ Parse the resource blob's entry table, the parsing stops at the first entry that goes out of bounds.
+        `data` is either the whole blob, or just its table with the blob's size passed in `size`. """
+    if size is None:
+        size = len(data)
+
+    magic, _, entcnt = struct.unpack_from('<4s24sI', data, 0)
+
+    if magic != MAGICSIGN_ENTR:
+        raise ValueError('Res header magic mismatch')
+
+    if 32 + entcnt * 32 >= size:
+        raise ValueError('Entries go over the res region')
+
+    entries = []
+
+    for i in range(entcnt):
+        ename, eaddr, esize = struct.unpack_from('<24sII', data, 32 + i * 32)
+
+        eoff = eaddr - base
+        if eoff < 0 or eoff + esize > size:
+            break
+
+        # null-terminated filename
+        zeroidx = ename.find(b'\0')
+        if zeroidx < 0: zeroidx = len(ename)
+
+        entries.append(ResEntry(i, ename[:zeroidx].decode(errors='replace'), eoff, esize))
+
+    return entries
+
+#---------------------------------------
+
+def _trim_blank(data, start, end, align=512):
+    # strip the erased (0xFF) bytes off the end of the area
+    while end > start and data[end-1] == 0xFF:
+        end -= 1
+    return start, min(end + (-(end - start) % align), len(data))
+
+def image_extents(data):
+    """ Get the (start, end) areas of the image that actually carry something.
+
+    That is, the header area (boot header, region table, boot code and whatever
+    else resides there), each region with its header, block CRC table and data,
+    and anything that follows the regions, all with the trailing erased bytes stripped.
+    """
+    parse_boot_header(data)
+    regions, _ = parse_region_table(data)
+
+    areas = []
+    pos = 0
+
+    for i, entry in enumerate(sorted(regions, key=lambda e: e.offset)):
+        rhdr = parse_region_header(data, entry.offset)
+        if not rhdr.crc_ok:
+            raise ValueError(f'Region header CRC mismatch at @{entry.offset:x}')
+
+        # whatever goes before the region (e.g. the header area)
+        if entry.offset > pos:
+            areas.append((pos, entry.offset))
+
+        pos = min(region_data_end(rhdr, (i+1) == len(regions)), len(data))
+        areas.append((entry.offset, pos))
+
+    # and whatever goes after all of them
+    if len(data) > pos:
+        areas.append((pos, len(data)))
+
+    extents = []
+
+    for start, end in areas:
+        start, end = _trim_blank(data, start, end)
+        if end > start:
+            extents.append((start, end))
+
+    return extents
+
+#---------------------------------------
+
+def verify_image(data, codekey=0):
+    """ Check all the CRCs of the image (header, boot code, region table, region headers,
+        region data blocks and whole regions), returns the list of the problems found. """
+    try:
+        hdr = parse_boot_header(data)
+    except ValueError as e:
+        return [str(e)]
+
+    problems = []
+
+    if not hdr.crc_ok:
+        problems.append('header CRC mismatch')
+
+    if hdr.bootoff + hdr.bootsize > len(data):
+        problems.append('boot code goes beyond the image')
+    elif not decrypt_boot_code(data, hdr)[1]:
+        problems.append('boot code CRC mismatch')
+
+    regions, regtab_ok = parse_region_table(data)
+
+    if not regtab_ok:
+        problems.append('region table CRC mismatch')
+
+    for ri, entry in enumerate(regions):
+        if entry.offset + 16 > len(data):
+            problems.append(f'region {ri} goes beyond the image')
+            continue
+
+        rhdr = parse_region_header(data, entry.offset)
+        what = f'region {ri} ({rhdr.type})'
+
+        if not rhdr.crc_ok:
+            problems.append(f'region {ri}: header CRC mismatch')
+            continue
+
+        if rhdr.dsize != entry.size:
+            problems.append(f'{what}: data size mismatch')
+            continue
+
+        dataend = region_data_end(rhdr, (ri+1) == len(regions))
+        if dataend > len(data):
+            problems.append(f'{what}: goes beyond the image')
+            continue
+
+        rdata, bad = decrypt_region(data, rhdr, dataend, region_key(entry, hdr.bootcrc, codekey))
+
+        if len(bad) > 0:
+            problems.append(f'{what}: {len(bad)} blocks with CRC mismatch (first one is #{bad[0]})')
+
+        if ab_crc16(rdata) != entry.crc:
+            problems.append(f'{what}: data CRC mismatch')
+
+    return problems
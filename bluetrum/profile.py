@@ -0,0 +1,147 @@
+""" Per-stage profiling of the tools (the "--profile" option) """
+
+__all__ = ['Profiler', 'add_profile_args']
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+class _Stage:
+    """ A single timed run of a named stage """
+
+    def __init__(self, prof, name, nbytes):
+        self.prof = prof
+        self.name = name
+        self.bytes = nbytes
+
+    def add(self, nbytes):
+        """ Account some more bytes processed by the stage """
+        self.bytes += nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.prof._record(self.name, self.start, time.perf_counter() - self.start, self.bytes)
+
+class _NullStage:
+    """ What the stages are when the profiling is disabled """
+
+    def add(self, nbytes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_null_stage = _NullStage()
+
+#------------------------------------------------------------------------------
+
+class Profiler:
+    """ Collects the time spent in the named stages (along with the amount of bytes they went through).
+
+    The stages are timed with the `with prof.stage('name'):` blocks, which do nothing
+    when the profiler is disabled, so they can be left in the code unconditionally.
+    The stages may nest and may run in multiple threads.
+    """
+
+    FORMATS = ('table', 'json', 'trace')
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.t0 = time.perf_counter()
+        self.events = []   # name, start, duration, bytes, thread
+        self.lock = threading.Lock()
+
+    def stage(self, name, nbytes=0):
+        if not self.enabled:
+            return _null_stage
+        return _Stage(self, name, nbytes)
+
+    def _record(self, name, start, duration, nbytes):
+        with self.lock:
+            self.events.append((name, start - self.t0, duration, nbytes, threading.get_ident()))
+
+    #------------------------------------------------
+
+    def summary(self):
+        """ Totals of each stage, in the order they have first been entered """
+        stages = {}
+
+        for name, start, duration, nbytes, _ in self.events:
+            st = stages.setdefault(name, {'stage': name, 'first': start, 'calls': 0, 'seconds': 0.0, 'bytes': 0})
+            st['first'] = min(st['first'], start)
+            st['calls'] += 1
+            st['seconds'] += duration
+            st['bytes'] += nbytes
+
+        result = []
+
+        for st in sorted(stages.values(), key=lambda st: st['first']):
+            del st['first']
+            st['mb_per_sec'] = st['bytes'] / st['seconds'] / 1e6 if st['bytes'] > 0 and st['seconds'] > 0 else None
+            result.append(st)
+
+        return result
+
+    def write_table(self, f):
+        f.write(f'{"Stage":<24} {"Calls":>7} {"Total, s":>10} {"Avg, ms":>10} {"Bytes":>12} {"MB/s":>9}\n')
+
+        for st in self.summary():
+            rate = f'{st["mb_per_sec"]:9.2f}' if st['mb_per_sec'] is not None else f'{"-":>9}'
+            f.write(f'{st["stage"]:<24} {st["calls"]:7d} {st["seconds"]:10.4f} {st["seconds"] * 1e3 / st["calls"]:10.3f}'
+                    f' {st["bytes"]:12d} {rate}\n')
+
+        f.write(f'{"(wall time)":<24} {"":7} {time.perf_counter() - self.t0:10.4f}\n')
+
+    def write_json(self, f):
+        json.dump({'wall_seconds': time.perf_counter() - self.t0, 'stages': self.summary()}, f, indent=2)
+        f.write('\n')
+
+    def write_trace(self, f):
+        # Chrome's trace event format (chrome://tracing, Perfetto)
+        events = [{'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                   'ts': round(start * 1e6, 1), 'dur': round(duration * 1e6, 1), 'args': {'bytes': nbytes}}
+                  for name, start, duration, nbytes, tid in self.events]
+
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        f.write('\n')
+
+    def write(self, fmt, path='-'):
+        """ Write out the results in the specified format into the file (or to stderr if it's '-') """
+        writer = getattr(self, f'write_{fmt}')
+
+        if path == '-':
+            writer(sys.stderr)
+        else:
+            with open(path, 'w') as f:
+                writer(f)
+
+    #------------------------------------------------
+
+    @classmethod
+    def from_args(cls, args):
+        """ Make a profiler according to the options added with add_profile_args();
+            the results are written out when the program exits. """
+        prof = cls(args.profile is not None)
+
+        if prof.enabled:
+            atexit.register(prof.write, args.profile, args.profile_output)
+
+        return prof
+
+def add_profile_args(ap):
+    """ Add the "--profile" options to the argument parser """
+    ap.add_argument('--profile', choices=Profiler.FORMATS, metavar='FORMAT',
+                    help='Measure the time spent in each stage of the work and output it'
+                         ' as a summary "table", "json" or a Chrome "trace" (see chrome://tracing)')
+
+    ap.add_argument('--profile-output', metavar='FILE', default='-',
+                    help='Where to write the profiling results into (default: stderr)')
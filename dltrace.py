@@ -0,0 +1,182 @@
+from bluetrum.dl.standin import StandinSerial
+from bluetrum.dl.trace import *
+from bluetrum.dl.trace import TR_WRITE, TR_READ, TR_BAUD, TR_FLUSH, TR_TOKEN, NO_RESPONSE
+from bluetrum.dl.uart import UARTDownload
+
+import argparse
+import struct
+import time
+from collections import Counter
+
+###############################################################################
+
+ap = argparse.ArgumentParser(description='Look into the UART session traces recorded by download.py ("--trace"),'
+                                         ' or play them back against the chip stand-in.',
+                             epilog='To play the chip\'s side back to download.py instead, use its "--port replay:TRACE" option.')
+
+actsp = ap.add_subparsers(dest='action', required=True)
+
+asp_show = actsp.add_parser('show', help='Print out the trace records')
+asp_show.add_argument('--tokens', action='store_true',
+                      help='Show only the token exchanges')
+asp_show.add_argument('trace',
+                      help='Trace file')
+
+asp_stats = actsp.add_parser('stats', help='Summarize the trace: the token exchanges, retries, timeouts and the longest stalls')
+asp_stats.add_argument('trace',
+                       help='Trace file')
+
+asp_standin = actsp.add_parser('standin', help='Feed what the host has sent in the trace into the chip stand-in, with the same timing,'
+                                               ' and compare what it responds with to what the real chip did')
+asp_standin.add_argument('--speed', type=float, default=1,
+                         help='Scale the time (e.g. 2 goes twice as fast, 0 doesn\'t wait at all; default: %(default)g)')
+asp_standin.add_argument('trace',
+                         help='Trace file')
+asp_standin.add_argument('flash',
+                         help='Stand-in\'s flash contents file, with its options (see download.py "--port standin:")')
+
+args = ap.parse_args()
+
+###############################################################################
+
+def token_name(token):
+    return UARTDownload.TOKEN_NAMES.get(token, f'{token:02X}')
+
+def byte_name(data, pos):
+    if pos >= len(data):
+        return '(nothing)'
+    return token_name(data[pos])
+
+def describe(rec):
+    if rec.kind == TR_TOKEN:
+        req, counter, resp = rec.data
+        return f'{token_name(req)}#{counter} -> {"(nothing)" if resp == NO_RESPONSE else token_name(resp)}'
+    elif rec.kind == TR_BAUD:
+        return f'baudrate {struct.unpack("<I", rec.data)[0]}'
+    elif rec.kind == TR_FLUSH:
+        return 'flush'
+    else:
+        what = 'write' if rec.kind == TR_WRITE else 'read'
+        if len(rec.data) == 0:
+            return f'{what} (nothing)'
+        return f'{what} {len(rec.data):5d}: {rec.data[:24].hex(" ")}{" ..." if len(rec.data) > 24 else ""}'
+
+def load(path):
+    with open(path, 'rb') as f:
+        start, records = read_trace(f)
+
+    print(f'Trace "{path}": recorded at {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start))},'
+          f' {len(records)} records over {records[-1].time if len(records) > 0 else 0:.3f} s')
+
+    return records
+
+#------------------------------------------------------------------------------
+
+def show(records):
+    for rec in records:
+        if args.tokens and rec.kind != TR_TOKEN:
+            continue
+        print(f'{rec.time:12.6f}  {describe(rec)}')
+
+def stats(records):
+    sizes = Counter()
+    exchanges = Counter()
+    empty_reads = 0
+
+    for rec in records:
+        if rec.kind in (TR_WRITE, TR_READ):
+            sizes[rec.kind] += len(rec.data)
+            if rec.kind == TR_READ and len(rec.data) == 0:
+                empty_reads += 1
+        elif rec.kind == TR_TOKEN:
+            req, _, resp = rec.data
+            exchanges[token_name(req), '(nothing)' if resp == NO_RESPONSE else token_name(resp)] += 1
+
+    print(f'Written: {sizes[TR_WRITE]} bytes, read: {sizes[TR_READ]} bytes (including the echo), reads that timed out: {empty_reads}')
+
+    print('Token exchanges:')
+    for (req, resp), n in sorted(exchanges.items()):
+        print(f'  {req:>14} -> {resp:<10} {n:8d}')
+
+    # the longest stalls: the time between a token exchange and the next thing the host does
+    gaps = []
+    for prev, rec in zip(records, records[1:]):
+        if prev.kind == TR_TOKEN:
+            gaps.append((rec.time - prev.time, prev))
+
+    gaps.sort(key=lambda g: g[0], reverse=True)
+
+    print('Longest stalls:')
+    for gap, rec in gaps[:10]:
+        print(f'  {gap * 1e3:10.3f} ms at {rec.time:.6f}s after {describe(rec)}')
+
+def standin(records):
+    port = StandinSerial(args.flash)
+
+    mismatches = Counter()
+    shown = 0
+    t0 = time.monotonic()
+
+    with port:
+        port.timeout = .1
+
+        for rec in records:
+            if args.speed > 0:
+                delay = t0 + rec.time / args.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            if rec.kind == TR_WRITE:
+                try:
+                    port.write(rec.data)
+                except (ValueError, RuntimeError) as e:
+                    # it got so far off (e.g. it took a data packet the chip has refused, and then the retransmission of it) that it can't go on
+                    print(f'{rec.time:12.6f}  the stand-in could not follow the trace any further: {e}')
+                    break
+
+            elif rec.kind == TR_BAUD:
+                port.baudrate, = struct.unpack('<I', rec.data)
+
+            elif rec.kind == TR_FLUSH:
+                port.reset_input_buffer()
+
+            elif rec.kind == TR_READ:
+                # what would the stand-in have given in this read
+                got = port.read(len(rec.data))
+
+                if got != rec.data:
+                    # (the echo comes first, so where they differ is most likely the response token, e.g. ACK vs NYET/NAK)
+                    pos = next(i for i in range(len(rec.data) + 1) if i >= len(got) or i >= len(rec.data) or got[i] != rec.data[i])
+                    mismatches[byte_name(rec.data, pos), byte_name(got, pos)] += 1
+
+                    if shown < 20:
+                        print(f'{rec.time:12.6f}  chip: {rec.data[:16].hex(" ") or "(nothing)"}'
+                              f'  stand-in: {got[:16].hex(" ") or "(nothing)"}')
+                        shown += 1
+
+                    # (go on from what comes after it)
+                    port.reset_input_buffer()
+
+    print(f'Played back in {time.monotonic() - t0:.3f} s (recorded: {records[-1].time if len(records) > 0 else 0:.3f} s),'
+          f' {sum(mismatches.values())} reads differ')
+
+    for (chip, stand), n in sorted(mismatches.items()):
+        print(f'  chip: {chip:>12}  stand-in: {stand:<12} {n:8d}')
+
+    return len(mismatches) == 0
+
+###############################################################################
+
+try:
+    records = load(args.trace)
+
+    if args.action == 'show':
+        show(records)
+    elif args.action == 'stats':
+        stats(records)
+    elif args.action == 'standin':
+        exit(0 if standin(records) else 1)
+
+except (OSError, ValueError, RuntimeError) as e:
+    print('failed:', e)
+    exit(2)
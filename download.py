@@ -1,17 +1,28 @@
 from bluetrum.cipher import ab_calckey
+from bluetrum.dl.job import load_job, plan_job
+from bluetrum.dl.mirror import SECTOR_SIZE, FlashMirror, default_mirror_dir
+from bluetrum.dl.proto import *
+from bluetrum.fwimage import image_extents
+from bluetrum.profile import Profiler, add_profile_args
 from bluetrum.utils import *
 
 import struct
 import argparse
+import json
+import sys
 
 from base64 import b64decode
+from pathlib import Path
 from tqdm import tqdm
 
 ###############################################################################
 
 try:
     from serial import Serial
-    from bluetrum.dl.uart import UARTDownload
+    from bluetrum.dl.uart import UARTDownload, PollPolicy
+    from bluetrum.dl.metrics import DlMetrics
+    from bluetrum.dl.rle import rle_encode_packets, rle_decode
+    from bluetrum.dl.trace import TraceWriter
     have_uart = True
 except ImportError:
     have_uart = False
@@ -37,7 +48,21 @@ if have_uart:
     ap.add_argument('--baud', type=int, default=921600,
                     help='Baudrate to use (default: %(default)d baud)')
     ap.add_argument('--port',
-                    help='Serial port to use for UART bootloader')
+                    help='Serial port to use for UART bootloader'
+                         ' ("standin:FILE" talks to a stand-in of the chip instead, with its flash contents kept in FILE,'
+                         ' "replay:TRACE" plays back the chip\'s side of a session recorded with "--trace")')
+    ap.add_argument('--timeout', type=float, default=5, metavar='SEC',
+                    help='How long to wait for the chip to complete a command (default: %(default)g seconds)')
+    ap.add_argument('--erase-timeout', type=float, default=10, metavar='SEC',
+                    help='How long to wait for the chip to complete an erase (default: %(default)g seconds)')
+    ap.add_argument('--metrics', metavar='FILE',
+                    help='Collect the UART protocol metrics (token counts, retries, latencies) and dump them as JSON into FILE')
+    ap.add_argument('--trace', metavar='FILE',
+                    help='Record everything that goes through the port (with timestamps) into FILE, see dltrace.py')
+    ap.add_argument('--no-compress', action='store_false', dest='compress',
+                    help='Do not run-length encode the flash data being transferred, even if the blob supports that')
+    ap.add_argument('--no-overlap', action='store_false', dest='overlap',
+                    help='Erase everything before writing, even if the blob can erase while the data is being transferred')
 
 if have_scsi:
     ap.add_argument('--mscdev',
@@ -46,6 +71,20 @@ if have_scsi:
 ap.add_argument('-r', '--reboot', action='store_true',
                 help='Reboot the chip after completion')
 
+ap.add_argument('--mirror', action='store_true',
+                help='Keep a local copy of the flash contents of each device (told apart by the flash unique ID),'
+                     ' read from it what is still there and skip writing what is already there'
+                     ' (the copy is checked against the device first, if the blob can do that)')
+
+ap.add_argument('--mirror-dir', type=Path, default=default_mirror_dir(), metavar='DIR',
+                help='Where to keep the local copies (default: %(default)s)')
+
+ap.add_argument('--daemon', metavar='SOCKET',
+                help='Pass the operation to the download.py daemon (see the "serve" action) listening at SOCKET'
+                     ' instead of talking to the chip directly')
+
+add_profile_args(ap)
+
 actsp = ap.add_subparsers(dest='action')
 
 asp_erase = actsp.add_parser('erase', help='Erase one or more flash areas')
@@ -56,14 +95,47 @@ asp_erase.add_argument('areas', metavar='address size', nargs='+',
 asp_read = actsp.add_parser('read', help='Read the flash into the file')
 asp_read.add_argument('areas', metavar='address size file', nargs='+',
                       help='Read <size> bytes from <address> into <file>.'
-                           ' If <size> is 0, then it\'s assumed to be \'whole flash\'.')
+                           ' If <size> is 0, then it\'s assumed to be \'whole flash\'.'
+                           ' The <file> can be "-" to stream the data to stdout as it is being read'
+                           ' (e.g. into "fwunpack.py -"), then everything else goes to stderr.')
 
 asp_write = actsp.add_parser('write', help='Write the file into flash')
 asp_write.add_argument('areas', metavar='address file', nargs='+',
                        help='Write <file> starting at <address>')
 
+asp_verify = actsp.add_parser('verify', help='Compare the flash contents with the file')
+asp_verify.add_argument('areas', metavar='address file', nargs='+',
+                        help='Compare <file> with the flash contents starting at <address>')
+
+asp_flash = actsp.add_parser('flash', help='Write a firmware image into flash, skipping the unused areas')
+asp_flash.add_argument('--addr', type=anyint, default=0,
+                       help='Address to put the image at (default: $%(default)06X)')
+asp_flash.add_argument('file',
+                       help='Firmware image file (e.g. made with fwmake1.py)')
+
+asp_job = actsp.add_parser('job', help='Do the erase/write/read/verify steps listed in the job file, all in one go')
+asp_job.add_argument('file',
+                     help='Job file, one step per line (see bluetrum/dl/job.py)')
+
+asp_serve = actsp.add_parser('serve', help='Keep the session open and take the operations from the clients (see "--daemon")')
+asp_serve.add_argument('socket',
+                       help='Unix socket path to listen at')
+
 args = ap.parse_args()
 
+prof = Profiler.from_args(args)
+
+# the data read into "-" goes to stdout as it arrives, so everything else that's normally printed there goes to stderr then
+stream_out = None
+
+if args.action == 'read' and '-' in args.areas[2::3]:
+    if args.areas[2::3].count('-') > 1:
+        ap.error('only one area can be read into stdout')
+
+    sys.stdout.flush()
+    stream_out = open(sys.stdout.fileno(), 'wb', buffering=0, closefd=False)   # (unbuffered, to pass on each piece right away)
+    sys.stdout = sys.stderr
+
 ###############################################################################
 
 dl_blob = b64decode(
@@ -100,72 +172,118 @@ dl_blob = b64decode(
 
 #------------------------------------------------------------------------------
 
-class BlCmd:
-    IFACE_PARAM         = 0x50
-    MEM_READ            = 0x52
-    AUTHORIZE           = 0x55
-    MEM_WRITE           = 0x57
-    SET_CMD_HANDLER     = 0x58
-    GET_INFO            = 0x5A
-    REBOOT              = 0x5E
-
-class NitDlCmd:
-    INIT                = 0x00
-    DEV_READ            = 0x01
-    DEV_WRITE           = 0x02
-    DEV_ERASE           = 0x03
-
-
-
-def make_cb(cmd, arg1=0, arg2=0, arg3=0):
-    # just the unscrambled CB is fine for now
-    return struct.pack('>BIBH', cmd, arg1, arg2, arg3)
-
-def do_the_stuff(execcmd, blocksize, iface):
-    # Query the information
-    resp = execcmd(make_cb(BlCmd.GET_INFO, arg1=0x5259414E, arg3=0x67ca), recv=24)
-    chipid, loadaddr, commskey, _ = struct.unpack('>12sIII', resp)
-    print(f' Chip ID:       {chipid}')
-    print(f' Load address:  ${loadaddr:08X}')
-    print(f' Init. commkey: ${commskey:08X}')
-
-    # Authorize
-    resp = execcmd(make_cb(BlCmd.AUTHORIZE, arg1=ab_calckey(commskey)), recv=4)
-    commskey, = struct.unpack('>I', resp)
-    print(f' New commkey:   ${commskey:08X}')
-
-    # Change baudrate (if it's UART)
-    if iface == 'uart' and args.baud != args.init_baud:
-        print(f'Changing baudrate to {args.baud} baud...')
-        # switch to a faster clock reference
-        execcmd(make_cb(BlCmd.IFACE_PARAM, arg2=0xf0), recv=2)
-        # change the baud rate
-        execcmd(make_cb(BlCmd.IFACE_PARAM, arg1=args.baud, arg2=0x02), recv=2, switch_baud=args.baud)
-
-    # Load blob
-    data = bytearray(dl_blob) + b'\x00' * align_by(len(dl_blob), blocksize)
-    struct.pack_into('<12s4sI', data, 4,
-                     chipid, iface.encode(), blocksize)
-
-    execcmd(make_cb(BlCmd.MEM_WRITE, arg1=loadaddr, arg3=(len(data) // blocksize)),send=data)
-    execcmd(make_cb(BlCmd.SET_CMD_HANDLER, arg1=loadaddr))
-
-    # start!
-    codekey, flashid, flashuid = struct.unpack('II16s', execcmd(make_cb(NitDlCmd.INIT), recv=48))
-    print(f'- Code key: >>>> {codekey:08X} <<<<')
-    print(f'- Flash device ID: {flashid:06X}')
-    print(f'- Flash unique ID: {flashuid.hex()}')
-
-    # quick and dirty way of determining the flash size from its ID
-    density = flashid & 0xff
-    if density >= 0x10 and density <= 0x18:
-        fsize = 1 << density
-        print(f'- Flash size: {fsize} bytes')
-    else:
-        fsize = None
-        print(' - Unknown flash size')
+class DlSession:
+    """ The code blob running on the chip, and the flash operations done with it """
+
+    def __init__(self, execcmd, blocksize, iface, io_size):
+        self.execcmd = execcmd
+        self.blocksize = blocksize
+        self.iface = iface
+        self.io_size = io_size
+        self.quiet = False      # no progress bars
+        self.mirror = None
+
+    def progress(self, desc, total):
+        return tqdm(desc=desc, total=total, unit='B', unit_divisor=1024, unit_scale=True, disable=self.quiet)
+
+    def start(self):
+        """ Authorize, upload the blob and start it """
+        execcmd = self.execcmd
+
+        with prof.stage('handshake'):
+            # Query the information
+            resp = execcmd(make_cb(BlCmd.GET_INFO, arg1=0x5259414E, arg3=0x67ca), recv=24)
+            chipid, loadaddr, commskey, _ = struct.unpack('>12sIII', resp)
+            print(f' Chip ID:       {chipid}')
+            print(f' Load address:  ${loadaddr:08X}')
+            print(f' Init. commkey: ${commskey:08X}')
+
+            # Authorize
+            resp = execcmd(make_cb(BlCmd.AUTHORIZE, arg1=ab_calckey(commskey)), recv=4)
+            commskey, = struct.unpack('>I', resp)
+            print(f' New commkey:   ${commskey:08X}')
+
+            # Change baudrate (if it's UART)
+            if self.iface == 'uart' and args.baud != args.init_baud:
+                print(f'Changing baudrate to {args.baud} baud...')
+                # switch to a faster clock reference
+                execcmd(make_cb(BlCmd.IFACE_PARAM, arg2=0xf0), recv=2)
+                # change the baud rate
+                execcmd(make_cb(BlCmd.IFACE_PARAM, arg1=args.baud, arg2=0x02), recv=2, switch_baud=args.baud)
+
+        with prof.stage('blob upload'):
+            # Load blob
+            data = bytearray(dl_blob) + b'\x00' * align_by(len(dl_blob), self.blocksize)
+            struct.pack_into('<12s4sI', data, 4,
+                             chipid, self.iface.encode(), self.blocksize)
+
+            execcmd(make_cb(BlCmd.MEM_WRITE, arg1=loadaddr, arg3=(len(data) // self.blocksize)),send=data)
+            execcmd(make_cb(BlCmd.SET_CMD_HANDLER, arg1=loadaddr))
+
+        # start!
+        with prof.stage('init'):
+            codekey, flashid, flashuid, caps = parse_init_resp(execcmd(make_cb(NitDlCmd.INIT), recv=48))
+        print(f'- Code key: >>>> {codekey:08X} <<<<')
+        print(f'- Flash device ID: {flashid:06X}')
+        print(f'- Flash unique ID: {flashuid.hex()}')
+        print(f'- Blob capabilities: {caps:04X}')
+
+        self.chipid, self.codekey, self.flashid, self.flashuid, self.caps = chipid, codekey, flashid, flashuid, caps
+
+        # run-length encoding is only worth it over UART (and only if the blob knows how to do that, of course)
+        self.rle = self.iface == 'uart' and args.compress and (caps & NitDlCap.RLE) != 0
+        self.xfer_flags = NitDlFlag.RLE if self.rle else 0
+
+        # the same goes for erasing the sectors one by one while the data for them is being transferred
+        self.overlap = self.iface == 'uart' and args.overlap and (caps & NitDlCap.QUEUED_ERASE) != 0
+
+        self.checksum = (caps & NitDlCap.CHECKSUM) != 0
+
+        if self.mirror is not None:
+            self.mirror.close()
+            self.mirror = None
+
+        if args.mirror:
+            if flashuid in (bytes(16), b'\xff' * 16):
+                print('- No flash unique ID to tell the device by, the mirror is not used')
+            else:
+                self.mirror = FlashMirror(args.mirror_dir, flashid, flashuid)
+                print(f'- Mirror: {len(self.mirror.sectors)} sectors known' +
+                      ('' if self.checksum else ' (the blob can not do checksums to check them, so it is only being kept up to date)'))
+
+        # quick and dirty way of determining the flash size from its ID
+        density = flashid & 0xff
+        if density >= 0x10 and density <= 0x18:
+            self.fsize = 1 << density
+            print(f'- Flash size: {self.fsize} bytes')
+        else:
+            self.fsize = None
+            print(' - Unknown flash size')
+
+    def info(self):
+        return {
+            'chipid':   self.chipid.hex(),
+            'codekey':  self.codekey,
+            'flashid':  self.flashid,
+            'flashuid': self.flashuid.hex(),
+            'caps':     self.caps,
+            'fsize':    self.fsize,
+        }
+
+    #--------------------------------------------------
+
+    def area_size(self, addr, size):
+        """ The size of an area, where zero means 'up to the end of flash' """
+        if size <= 0:
+            if self.fsize is None:
+                raise ValueError('Unknown flash size')
+            size = self.fsize - addr
+            if size <= 0:
+                raise ValueError('Address is out of range')
+
+        return size
 
-    def do_dev_erase(addr, size):
+    def erase(self, addr, size):
         saddr = addr & ~0xFFF
         eaddr = (addr + size + 0xFFF) & ~0xFFF
 
@@ -174,7 +292,7 @@ def do_the_stuff(execcmd, blocksize, iface):
         if eaddr > (addr+size):
             print(f'Warning: end address has been adjusted: ${eaddr:06X} > ${addr+size:06X}')
 
-        tq = tqdm(desc='Erasing', total=(eaddr-saddr), unit='B', unit_divisor=1024, unit_scale=1)
+        tq = self.progress('Erasing', eaddr-saddr)
 
         try:
             addr = saddr
@@ -186,102 +304,625 @@ def do_the_stuff(execcmd, blocksize, iface):
                 else:
                     # small eraseblock (4k)
                     blksize = 0x1000
-                    flags = 0x02
+                    flags = NitDlFlag.ERASE_4K
 
-                execcmd(make_cb(NitDlCmd.DEV_ERASE, arg1=addr, arg2=flags))
+                with prof.stage('erase', blksize):
+                    self.execcmd(make_cb(NitDlCmd.DEV_ERASE, arg1=addr, arg2=flags), busy=f'erase{blksize >> 10}k')
+
+                if self.mirror is not None:
+                    self.mirror.erase(addr, blksize)
 
                 tq.update(blksize)
                 addr += blksize
 
         finally:
             tq.close()
+            self.save_mirror()
+
+    def write(self, addr, data, tq=None):
+        data = memoryview(data)
+
+        own_tq = tq is None
+        if own_tq:
+            tq = self.progress('Writing', len(data))
+
+        try:
+            done = 0
+            while done < len(data):
+                block = data[done : done+self.io_size]
+
+                with prof.stage('write', len(block)):
+                    self.execcmd(make_cb(NitDlCmd.DEV_WRITE, arg1=addr+done, arg2=self.xfer_flags, arg3=len(block)),
+                                 send=block, busy='program', progress=tq.update, rle=self.rle)
+
+                if self.mirror is not None:
+                    self.mirror.program(addr+done, block)
+
+                done += len(block)
+
+        finally:
+            if own_tq:
+                tq.close()
+                self.save_mirror()
+
+    def program(self, erases, writes):
+        """ Erase the (addr, size) areas and write the (addr, data) into flash, the erased areas have to cover the written ones.
+
+            If the blob can queue the erases, each 4k sector is erased right before its data is sent,
+            so the flash erases one sector while the data for it is being transferred (and the erase of
+            the next one gets queued while that data is being programmed), instead of sitting idle
+            during the transfers after having erased everything first.
+
+            With the mirror, the sectors that already have what they're supposed to have in the end are skipped. """
+        if self.mirror is not None:
+            erases, writes = self.skip_unchanged(erases, writes)
+            if len(erases) == 0 and len(writes) == 0:
+                return
+
+        if not self.overlap:
+            for addr, size in erases:
+                self.erase(addr, size)
+            for addr, data in writes:
+                self.write(addr, data)
+            return
+
+        erased = {sect for addr, size in erases
+                  for sect in range(addr & ~0xFFF, addr + size, 0x1000)}
+
+        # only the sectors that get data are worth erasing along with it, the rest are erased
+        # the usual way beforehand (so that the aligned 64k blocks still go in a single erase)
+        sectors = sorted({sect for addr, data in writes
+                          for sect in range(addr & ~0xFFF, addr + len(data), 0x1000)} & erased)
+
+        runs = []
+        for sect in sorted(erased.difference(sectors)):
+            if len(runs) > 0 and runs[-1][1] == sect:
+                runs[-1][1] += 0x1000
+            else:
+                runs.append([sect, sect + 0x1000])
+
+        for saddr, eaddr in runs:
+            self.erase(saddr, eaddr - saddr)
+
+        pending = 0
+
+        def erase_upto(addr):
+            # queue the erases of all the sectors up to (and including) the one at `addr`
+            nonlocal pending
+            while pending < len(sectors) and sectors[pending] <= addr:
+                with prof.stage('erase', 0x1000):
+                    self.execcmd(make_cb(NitDlCmd.DEV_ERASE, arg1=sectors[pending], arg2=NitDlFlag.ERASE_4K | NitDlFlag.ERASE_QUEUED),
+                                 busy='erase4k')
+                if self.mirror is not None:
+                    self.mirror.erase(sectors[pending], 0x1000)
+                pending += 1
+
+        tq = self.progress('Programming', sum(len(data) for _, data in writes))
+
+        try:
+            for addr, data in sorted(writes, key=lambda w: w[0]):
+                data = memoryview(data)
+
+                done = 0
+                while done < len(data):
+                    # one sector at a time
+                    n = min(len(data) - done, 0x1000 - ((addr + done) & 0xFFF))
+
+                    erase_upto(addr + done)
+                    self.write(addr + done, data[done : done+n], tq)
+
+                    done += n
+
+        finally:
+            tq.close()
+            self.save_mirror()
 
     #--------------------------------------------------
 
-    try:
-        if args.action == 'erase':
-            for i in range(0, len(args.areas), 2):
-                addr = int(args.areas[i+0], 0)
-                size = int(args.areas[i+1], 0)
-
-                if size <= 0:
-                    if fsize is None:
-                        raise RuntimeError('Unknown flash size')
-                    size = fsize - addr
-                    if size <= 0:
-                        raise ValueError('Address is out of range')
-
-                do_dev_erase(addr, size)
-
-        elif args.action == 'read':
-            for i in range(0, len(args.areas), 3):
-                addr = int(args.areas[i+0], 0)
-                size = int(args.areas[i+1], 0)
-                path = args.areas[i+2]
-
-                if size <= 0:
-                    if fsize is None:
-                        raise RuntimeError('Unknown flash size')
-                    size = fsize - addr
-                    if size <= 0:
-                        raise ValueError('Address is out of range')
-
-                # we wouldn't have needed that if we just supported the UART bootloader
-                # and simply updated the progress on each transferred block, but since
-                # we need to support the USB bootloader as well, there is no possibility
-                # to the same thing except by doing short bursts at a time.
-                io_size = min(0x8000, max(blocksize, align_to(size // 100, blocksize)))
-
-                print(f'Reading {size} bytes from @{addr:06X} into "{path}"...')
-
-                tq = tqdm(desc='Reading', total=size, unit='B', unit_divisor=1024, unit_scale=True)
+    def save_mirror(self):
+        if self.mirror is not None:
+            self.mirror.save()
 
-                try:
-                    with open(path, 'wb') as f:
-                        done = 0
-                        while done < size:
-                            n = min(io_size, size-done)
+    def checksums(self, addr, count):
+        """ Get the CRC32s of `count` sectors starting at `addr` from the device """
+        crcs = []
+
+        while count > 0:
+            n = min(count, 256)
+
+            with prof.stage('checksum', n * SECTOR_SIZE):
+                resp = self.execcmd(make_cb(NitDlCmd.DEV_CHECKSUM, arg1=addr, arg3=n), recv=4 * n, busy='read')
+
+            crcs += struct.unpack(f'<{n}I', resp)
+            addr += n * SECTOR_SIZE
+            count -= n
+
+        return crcs
+
+    def trusted_sectors(self, indices):
+        """ Which ones of the sectors can be taken from the mirror, that is the known ones that still have the same checksum on the device
+            (the ones that don't are forgotten) """
+        if self.mirror is None or not self.checksum:
+            return set()
+
+        known = sorted(i for i in indices if self.mirror.known(i))
+        trusted = set()
+
+        # the runs of the sectors, one checksum request for each
+        pos = 0
+        while pos < len(known):
+            end = pos + 1
+            while end < len(known) and known[end] == known[end-1] + 1:
+                end += 1
+
+            for index, crc in zip(known[pos:end], self.checksums(known[pos] * SECTOR_SIZE, end - pos)):
+                if crc == self.mirror.crc(index):
+                    trusted.add(index)
+                else:
+                    self.mirror.forget(index)
+
+            pos = end
+
+        return trusted
+
+    def skip_unchanged(self, erases, writes):
+        """ Drop the sectors that already have on the device what they'd end up with from the erases and writes """
+        touched = sorted({index for addr, size in erases for index in FlashMirror.span(addr, size)})
+
+        # what the sectors are going to be
+        targets = {index: bytearray(b'\xff' * SECTOR_SIZE) for index in self.trusted_sectors(touched)}
+
+        for addr, data in writes:
+            for index in FlashMirror.span(addr, len(data)):
+                if index in targets:
+                    soff = index * SECTOR_SIZE
+                    start, end = max(addr, soff), min(addr + len(data), soff + SECTOR_SIZE)
+                    targets[index][start - soff : end - soff] = data[start - addr : end - addr]
+
+        skip = {index for index, target in targets.items() if self.mirror.sector(index) == target}
+        if len(skip) == 0:
+            return erases, writes
+
+        print(f'Skipping {len(skip)} out of {len(touched)} sectors that are the same already')
+
+        def keep(addr, size):
+            # the runs of the area that are not skipped
+            runs = []
+            for index in FlashMirror.span(addr, size):
+                if index in skip:
+                    continue
+                start, end = max(addr, index * SECTOR_SIZE), min(addr + size, (index + 1) * SECTOR_SIZE)
+                if len(runs) > 0 and runs[-1][1] == start:
+                    runs[-1][1] = end
+                else:
+                    runs.append([start, end])
+            return runs
+
+        erases = [(start, end - start) for addr, size in erases for start, end in keep(addr, size)]
+        writes = [(start, memoryview(data)[start - addr : end - addr]) for addr, data in writes for start, end in keep(addr, len(data))]
+
+        return erases, writes
+
+    def read(self, addr, size, f=None, cached=True):
+        """ Read the flash into the file `f`, or return the data if there's none.
+            Unless `cached` is false, what the mirror has (and what is still the same on the device) is taken from there. """
+        chunks = []
+
+        # the runs of the area, each either from the mirror or from the device
+        runs = [(addr, size, False)]
+
+        if self.mirror is not None and size > 0:
+            trusted = self.trusted_sectors(FlashMirror.span(addr, size)) if cached else set()
+            runs = []
+
+            for index in FlashMirror.span(addr, size):
+                start, end = max(addr, index * SECTOR_SIZE), min(addr + size, (index + 1) * SECTOR_SIZE)
+                if index not in trusted:
+                    # (the device is read by the whole sectors, to get them into the mirror)
+                    start, end = index * SECTOR_SIZE, (index + 1) * SECTOR_SIZE
+                if len(runs) > 0 and runs[-1][2] == (index in trusted) and runs[-1][0] + runs[-1][1] == start:
+                    runs[-1][1] += end - start
+                else:
+                    runs.append([start, end - start, index in trusted])
+
+            cachesize = sum(rsize for _, rsize, cached in runs if cached)
+            if cachesize > 0:
+                print(f'Taking {cachesize} bytes from the mirror')
+
+        def output(raddr, data):
+            # just the part that's been asked for
+            start, end = max(raddr, addr), min(raddr + len(data), addr + size)
+            data = data[start - raddr : end - raddr]
+
+            if f is not None:
+                with prof.stage('file write', len(data)):
+                    f.write(data)
+            else:
+                chunks.append(bytes(data))
+
+        tq = self.progress('Reading', sum(rsize for _, rsize, _ in runs))
+
+        try:
+            for raddr, rsize, cached in runs:
+                if cached:
+                    output(raddr, self.mirror.read(raddr, rsize))
+                    tq.update(rsize)
+                    continue
+
+                done = 0
+                while done < rsize:
+                    n = min(self.io_size, rsize-done)
+
+                    with prof.stage('read', n):
+                        data = self.execcmd(make_cb(NitDlCmd.DEV_READ, arg1=raddr+done, arg2=self.xfer_flags, arg3=n), recv=n,
+                                            busy='read', progress=tq.update, rle=self.rle)
+
+                    if self.mirror is not None:
+                        self.mirror.update(raddr+done, data)
+
+                    output(raddr+done, data)
+                    done += n
+
+        finally:
+            tq.close()
+            self.save_mirror()
+
+        if f is None:
+            return b''.join(chunks)
+
+    def verify(self, addr, data):
+        """ Compare the flash contents with the data, returns the address of the first mismatch (or None) """
+        flash = self.read(addr, len(data), cached=False)
+
+        if flash == data:
+            return None
+
+        return addr + next(i for i in range(len(data)) if i >= len(flash) or flash[i] != data[i])
+
+    def flash_image(self, image, base):
+        """ Write a firmware image, only the areas that actually carry something """
+        extents = image_extents(image)
+
+        print(f'Flashing the image to @{base:06X}:'
+              f' {sum(end - start for start, end in extents)} out of {len(image)} bytes in {len(extents)} areas')
+
+        # plan the erase around the areas that are going to be written
+        erases = []
+        for start, end in extents:
+            saddr = (base + start) & ~0xFFF
+            eaddr = (base + end + 0xFFF) & ~0xFFF
+
+            if len(erases) > 0 and saddr <= erases[-1][1]:
+                erases[-1][1] = max(erases[-1][1], eaddr)
+            else:
+                erases.append([saddr, eaddr])
+
+        for saddr, eaddr in erases:
+            print(f'Erasing @{saddr:06X}...{eaddr-1:06X}')
+        for start, end in extents:
+            print(f'Writing @{base+start:06X}...{base+end-1:06X}')
+
+        self.program([(saddr, eaddr - saddr) for saddr, eaddr in erases],
+                     [(base + start, memoryview(image)[start:end]) for start, end in extents])
+
+    def reboot(self):
+        self.execcmd(make_cb(BlCmd.REBOOT))
+
+    def probe(self):
+        """ Check if the blob is still there, with a cheap command (a tiny read) """
+        try:
+            self.execcmd(make_cb(NitDlCmd.DEV_READ, arg1=0, arg3=16), recv=16, busy='read')
+        except (TimeoutError, RuntimeError, ConnectionError):
+            return False
+
+        return True
+
+#------------------------------------------------------------------------------
+
+def read_file(path):
+    with open(path, 'rb') as f, prof.stage('file read') as st:
+        data = f.read()
+        st.add(len(data))
+    return data
+
+def run_actions(session):
+    """ Do the action, returns whether it has all gone fine (i.e. nothing has failed to verify) """
+    ok = True
+
+    if args.action == 'erase':
+        for i in range(0, len(args.areas), 2):
+            addr = int(args.areas[i+0], 0)
+            size = int(args.areas[i+1], 0)
 
-                            f.write(execcmd(make_cb(NitDlCmd.DEV_READ, arg1=addr+done, arg3=n), recv=n))
+            session.erase(addr, session.area_size(addr, size))
 
-                            tq.update(n)
-                            done += n
+    elif args.action == 'read':
+        for i in range(0, len(args.areas), 3):
+            addr = int(args.areas[i+0], 0)
+            size = int(args.areas[i+1], 0)
+            path = args.areas[i+2]
 
-                finally:
-                    tq.close()
+            size = session.area_size(addr, size)
 
-        elif args.action == 'write':
-            for i in range(0, len(args.areas), 2):
-                addr = int(args.areas[i+0], 0)
-                path = args.areas[i+1]
+            if path == '-':
+                print(f'Reading {size} bytes from @{addr:06X} into stdout...')
+                session.read(addr, size, stream_out)
+                continue
 
-                with open(path, 'rb') as f:
-                    size = f.seek(0, 2)
-                    f.seek(0)
+            print(f'Reading {size} bytes from @{addr:06X} into "{path}"...')
 
-                    print(f'Writing {size} bytes to @{addr:06X} from "{path}"...')
+            with open(path, 'wb') as f:
+                session.read(addr, size, f)
 
-                    # Erase
-                    do_dev_erase(addr, size)
+    elif args.action == 'write':
+        for i in range(0, len(args.areas), 2):
+            addr = int(args.areas[i+0], 0)
+            path = args.areas[i+1]
 
-                    # Write
-                    io_size = min(0x8000, max(blocksize, align_to(size // 100, blocksize)))
+            data = read_file(path)
 
-                    tq = tqdm(desc='Writing', total=size, unit='B', unit_divisor=1024, unit_scale=True)
+            print(f'Writing {len(data)} bytes to @{addr:06X} from "{path}"...')
+
+            session.program([(addr, len(data))], [(addr, data)])
+
+    elif args.action == 'verify':
+        for i in range(0, len(args.areas), 2):
+            addr = int(args.areas[i+0], 0)
+            path = args.areas[i+1]
+
+            mismatch = session.verify(addr, read_file(path))
+
+            if mismatch is None:
+                print(f'@{addr:06X} "{path}": OK')
+            else:
+                print(f'@{addr:06X} "{path}": mismatch at @{mismatch:06X}')
+                ok = False
+
+    elif args.action == 'flash':
+        print(f'Flashing "{args.file}"...')
+        session.flash_image(read_file(args.file), args.addr)
+
+    elif args.action == 'job':
+        if not run_job(session, args.file):
+            print('Verification failed')
+            ok = False
+
+    return ok
+
+def run_job(session, path):
+    """ Do the job file, returns whether all the verify steps have passed """
+    steps = load_job(path)
+    ops = plan_job(steps, session.fsize)
+
+    print(f'Job "{path}": {len(steps)} steps, planned as {len(ops)} operations')
+
+    ok = True
+    erases, writes = [], []
+
+    for op in ops + [None]:
+        if op is not None and op.op == 'erase':
+            print(f'Erasing @{op.addr:06X}...{op.addr+op.size-1:06X}')
+            erases.append((op.addr, op.size))
+            continue
+
+        elif op is not None and op.op == 'write':
+            print(f'Writing @{op.addr:06X}...{op.addr+op.size-1:06X}')
+            writes.append((op.addr, op.data))
+            continue
+
+        # everything up to here has to be done
+        if len(erases) > 0 or len(writes) > 0:
+            session.program(erases, writes)
+            erases, writes = [], []
+
+        if op is None:
+            break
+
+        elif op.op == 'read':
+            print(f'Reading @{op.addr:06X}...{op.addr+op.size-1:06X} into "{op.path}"')
+            with open(op.path, 'wb') as f:
+                session.read(op.addr, op.size, f)
+
+        elif op.op == 'verify':
+            mismatch = session.verify(op.addr, op.data)
+
+            if mismatch is None:
+                print(f'@{op.addr:06X} "{op.path}": OK')
+            else:
+                print(f'@{op.addr:06X} "{op.path}": mismatch at @{mismatch:06X}')
+                ok = False
+
+    return ok
+
+#------------------------------------------------------------------------------
+
+#
+# The daemon mode: the session is kept open, and the operations come from the clients
+# over a Unix socket, one JSON object per line for both the requests and the responses.
+#
+
+def check_request(req):
+    """ Make sure the request is an object with the fields of the right types, before anything is done about it """
+    if not isinstance(req, dict):
+        raise ValueError('The request is not an object')
+
+    for field, ftype in (('op', str), ('addr', int), ('size', int), ('file', str)):
+        if field in req and (not isinstance(req[field], ftype) or isinstance(req[field], bool)):
+            raise ValueError(f'"{field}" has to be {"an integer" if ftype is int else "a string"}')
+
+def serve_request(session, req):
+    op = req.get('op')
+
+    if op == 'info':
+        return session.info()
+
+    elif op == 'erase':
+        session.erase(req['addr'], session.area_size(req['addr'], req['size']))
+
+    elif op == 'read':
+        size = session.area_size(req['addr'], req['size'])
+        with open(req['file'], 'wb') as f:
+            session.read(req['addr'], size, f)
+        return {'size': size}
+
+    elif op == 'write':
+        data = read_file(req['file'])
+        session.program([(req['addr'], len(data))], [(req['addr'], data)])
+        return {'size': len(data)}
+
+    elif op == 'verify':
+        return {'mismatch': session.verify(req['addr'], read_file(req['file']))}
+
+    elif op == 'flash':
+        session.flash_image(read_file(req['file']), req['addr'])
+
+    elif op == 'job':
+        return {'passed': run_job(session, req['file'])}
+
+    else:
+        raise ValueError(f'Unknown operation "{op}"')
+
+def serve(session, restart, resync):
+    """ Serve the requests until the 'quit' one comes, `restart` re-establishes the session if the chip has been reset,
+        `resync` gets the link back in order after a failed transfer """
+    import socketserver
+
+    session.quiet = True
+    done = False
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            nonlocal done
+
+            for ln in self.rfile:
+                try:
+                    req = json.loads(ln)
+                    check_request(req)
+                except ValueError as e:
+                    resp = {'ok': False, 'error': f'Bad request: {e}'}
+                else:
+                    if req.get('op') == 'quit':
+                        done = True
+                        resp = {'ok': True}
+                    else:
+                        resp = self.process(req)
+
+                self.wfile.write(json.dumps(resp).encode() + b'\n')
+
+        def process(self, req):
+            print(f'<< {req}')
+
+            for attempt in range(2):
+                try:
+                    return {'ok': True, **(serve_request(session, req) or {})}
+
+                except (TimeoutError, RuntimeError, ConnectionError) as e:
+                    # something went wrong on the link, or the chip has stopped responding
+                    error = {'ok': False, 'error': f'{e}'}
+
+                    resync()
+                    if session.probe():
+                        # the blob is still there, so it was just the link
+                        print(f'failed: {e}, trying again...')
+                        continue
+
+                    # the chip has probably been reset; start it all over again
+                    print(f'failed: {e}, the chip does not respond, restarting the session...')
 
                     try:
-                        with open(path, 'rb') as f:
-                            done = 0
-                            while done < size:
-                                block = f.read(io_size)
+                        restart()
+                    except Exception as e:
+                        return {'ok': False, 'error': f'Could not restart the session: {e}'}
+
+                except (KeyError, ValueError, TypeError, AttributeError, OSError) as e:
+                    # the request itself is bad
+                    return {'ok': False, 'error': f'{type(e).__name__}: {e}'}
 
-                                execcmd(make_cb(NitDlCmd.DEV_WRITE, arg1=addr+done, arg3=len(block)), send=block)
+            return error
 
-                                tq.update(len(block))
-                                done += len(block)
+    Path(args.socket).unlink(missing_ok=True)
 
-                    finally:
-                        tq.close()
+    with socketserver.UnixStreamServer(args.socket, Handler) as server:
+        print(f'Serving at "{args.socket}"')
+
+        try:
+            while not done:
+                server.handle_request()
+        finally:
+            Path(args.socket).unlink(missing_ok=True)
+
+def run_client():
+    """ Pass the operation to the daemon """
+    import socket
+
+    reqs = []
+
+    if args.action == 'erase':
+        reqs = [{'op': 'erase', 'addr': int(args.areas[i], 0), 'size': int(args.areas[i+1], 0)}
+                for i in range(0, len(args.areas), 2)]
+    elif args.action == 'read':
+        reqs = [{'op': 'read', 'addr': int(args.areas[i], 0), 'size': int(args.areas[i+1], 0),
+                 'file': str(Path(args.areas[i+2]).resolve())} for i in range(0, len(args.areas), 3)]
+    elif args.action in ('write', 'verify'):
+        reqs = [{'op': args.action, 'addr': int(args.areas[i], 0), 'file': str(Path(args.areas[i+1]).resolve())}
+                for i in range(0, len(args.areas), 2)]
+    elif args.action == 'flash':
+        reqs = [{'op': 'flash', 'addr': args.addr, 'file': str(Path(args.file).resolve())}]
+    elif args.action == 'job':
+        reqs = [{'op': 'job', 'file': str(Path(args.file).resolve())}]
+    elif args.action == 'serve':
+        raise ValueError('The daemon can not serve another daemon')
+    else:
+        reqs = [{'op': 'info'}]
+
+    if args.reboot:
+        raise ValueError('The daemon keeps the chip running, it can not be rebooted through it')
+
+    if stream_out is not None:
+        raise ValueError('The daemon can not read into stdout (but it can read into a named pipe)')
+
+    ok = True
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(args.daemon)
+        f = sock.makefile('rwb')
+
+        for req in reqs:
+            f.write(json.dumps(req).encode() + b'\n')
+            f.flush()
+
+            resp = json.loads(f.readline())
+            print(req['op'], '->', resp)
+
+            if not resp.get('ok') or resp.get('mismatch') is not None or resp.get('passed') is False:
+                ok = False
+
+    return ok
+
+###############################################################################
+
+def run(execcmd, blocksize, iface, io_size, restart_link=None, resync_link=None):
+    """ Start the session and do the action in it, returns whether it has all gone fine """
+    session = DlSession(execcmd, blocksize, iface, io_size)
+    session.start()
+
+    def restart():
+        if restart_link is not None:
+            restart_link()
+        session.start()
+
+    def resync():
+        if resync_link is not None:
+            resync_link()
+
+    ok = False
+
+    try:
+        if args.action == 'serve':
+            serve(session, restart, resync)
+            ok = True
+        else:
+            ok = run_actions(session)
 
     except Exception as e:
         print('failed:', e)
@@ -291,101 +932,179 @@ def do_the_stuff(execcmd, blocksize, iface):
 
     if args.reboot:
         # finally, reboot the chip
-        execcmd(make_cb(BlCmd.REBOOT))
+        session.reboot()
 
-###############################################################################
+    if session.mirror is not None:
+        session.mirror.close()
+
+    return ok
+
+if args.daemon is not None:
+    try:
+        exit(0 if run_client() else 1)
+    except (OSError, ValueError) as e:
+        print('failed:', e)
+        exit(1)
 
 if have_uart and args.port is not None:
-    with Serial(args.port) as port:
-        udl = UARTDownload(port)
+    if args.port.startswith('standin:'):
+        from bluetrum.dl.standin import StandinSerial
+        port = StandinSerial(args.port[8:])
+    elif args.port.startswith('replay:'):
+        from bluetrum.dl.trace import ReplaySerial
+        port = ReplaySerial(args.port[7:])
+    else:
+        port = Serial(args.port)
 
-        print('Trying to synchronize.', end='')
+    with port:
+        metrics = DlMetrics() if args.metrics is not None else None
 
-        port.timeout = .01
+        # what the chip is busy with after each kind of command: how long it is expected to take, and the deadline
+        busy_policies = {
+            'read':     PollPolicy('read',     0.0005, args.timeout),
+            'program':  PollPolicy('program',  0.002,  args.timeout),
+            'erase4k':  PollPolicy('erase4k',  0.05,   args.erase_timeout),
+            'erase64k': PollPolicy('erase64k', 0.3,    args.erase_timeout),
+        }
 
-        try:
-            done = False
+        trace = TraceWriter(open(args.trace, 'wb')) if args.trace is not None else None
 
-            num = 0
-            turn = 0
+        udl = UARTDownload(port, metrics, PollPolicy('command', 0.001, args.timeout), trace)
+
+        def sync():
+            print('Trying to synchronize.', end='')
+
+            udl.port.baudrate = args.init_baud
+            udl.port.timeout = .01
+
+            try:
+                with prof.stage('sync'):
+                    done = False
+
+                    num = 0
+                    turn = 0
 
-            while not done:
-                if num < 10:
-                    # send a sync pattern
-                    udl.port.reset_input_buffer()
-                    udl.port.write(UARTDownload.SYNC_TOKEN)
                     while not done:
-                        recv = udl.port.read(4)
-                        if recv == b'': break
-                        if recv == UARTDownload.SYNC_RESP:
-                            done = True
+                        if num < 10:
+                            # send a sync pattern
+                            udl.reset_input_buffer()
+                            udl.port.write(UARTDownload.SYNC_TOKEN)
+                            while not done:
+                                recv = udl.port.read(4)
+                                if recv == b'': break
+                                if recv == UARTDownload.SYNC_RESP:
+                                    done = True
 
-                    num += 1
+                            num += 1
 
-                else:
-                    print('.', end='', flush=True)
+                        else:
+                            print('.', end='', flush=True)
 
-                    if turn == 0:
-                        # send reset packet in initial baud rate
-                        udl.port.baudrate = args.init_baud
-                        udl.send_reset(True)
-                        turn = 1
+                            if turn == 0:
+                                # send reset packet in initial baud rate
+                                udl.port.baudrate = args.init_baud
+                                udl.send_reset(True)
+                                turn = 1
 
-                    elif turn == 1:
-                        # send reset packet in target baud rate
-                        udl.port.baudrate = args.baud
-                        udl.send_reset(True)
-                        udl.port.baudrate = args.init_baud
-                        turn = 0
+                            elif turn == 1:
+                                # send reset packet in target baud rate
+                                udl.port.baudrate = args.baud
+                                udl.send_reset(True)
+                                udl.port.baudrate = args.init_baud
+                                turn = 0
 
-                    num = 0
+                            num = 0
 
-        except Exception as e:
-            print(' failed:')
-            raise e
+            except Exception as e:
+                print(' failed:')
+                raise e
 
-        else:
-            print(' done.')
+            else:
+                print(' done.')
 
-        port.timeout = .1
+            udl.port.timeout = .1
+            udl.comms_reset()
+
+        def execcmd(cb, send=None, recv=None, busy=None, progress=None, max_io=512, switch_baud=None, rle=False):
+            busy = busy_policies.get(busy)
 
-        def execcmd(cb, send=None, recv=None, max_io=512, switch_baud=None):
             # first goes the command block
-            udl.send_packet(cb)
+            udl.send_packet(cb, busy)
 
             # switch baudrate at that point
             if switch_baud is not None:
-                port.baudrate = switch_baud
+                udl.port.baudrate = switch_baud
 
             # transfer data
             if send is not None:
                 # send data blocks
-                sent = 0
-                while sent < len(send):
-                    num = min(len(send) - sent, max_io)
+                if rle:
+                    packets = rle_encode_packets(send, max_io)
+                else:
+                    packets = ((send[off : off+max_io], min(len(send) - off, max_io)) for off in range(0, len(send), max_io))
+
+                for packet, num in packets:
+                    with prof.stage('transfer', num):
+                        udl.send_packet(packet, busy)
 
-                    udl.send_packet(send[sent : sent+num])
-                    sent += num
+                    if progress is not None:
+                        progress(num)
 
             elif recv is not None:
-                # receive data blocks
-                data = b''
-                while len(data) < recv:
-                    num = min(recv - len(data), max_io)
+                # receive data blocks right into a preallocated buffer
+                data = memoryview(bytearray(recv))
+                got = 0
+                while got < recv:
+                    num = min(recv - got, max_io)
+
+                    with prof.stage('transfer') as st:
+                        if rle:
+                            # each packet decodes into however much data it holds
+                            try:
+                                chunk = rle_decode(udl.recv_packet())
+                            except ValueError as e:
+                                raise ConnectionError(f'Received a broken data packet: {e}')
+                            if len(chunk) > recv - got:
+                                raise ConnectionError(f'Received more data than requested ({got + len(chunk)} > {recv} bytes)')
+                            n = len(chunk)
+                            data[got : got+n] = chunk
+                        else:
+                            n = udl.recv_packet(data[got:])
+                        st.add(n)
+                    got += n
+
+                    if progress is not None:
+                        progress(n)
+
+                    if n == 0 or (n != num and not rle):
+                        break
 
-                    block = udl.recv_packet()
-                    data += block
+                return data[:got]
 
-                    if len(block) != num:
-                        break
+        try:
+            sync()
 
-                return data
+            def resync():
+                # drop whatever's left of the failed exchange, and start the token counting over
+                udl.reset_input_buffer()
+                udl.send_reset()
 
-        do_the_stuff(execcmd, 512, 'uart')
+            # the progress is reported on each packet, so the command size only matters for the
+            # command overhead; half of what the 16-bit length field can take is plenty for that.
+            if not run(execcmd, 512, 'uart', 0x8000, sync, resync):
+                exit(1)
+        finally:
+            if metrics is not None:
+                with open(args.metrics, 'w') as f:
+                    metrics.dump(f)
+            if trace is not None:
+                trace.close()
 
 elif have_scsi and args.mscdev is not None:
     with SCSIDev(args.mscdev) as dev:
-        def execcmd(cb, send=None, recv=None):
+        def execcmd(cb, send=None, recv=None, busy=None, progress=None, rle=False):
+            # (the USB commands are completed synchronously, so there is no polling to do;
+            #  and the data is never run-length encoded over USB)
             if recv is not None:
                 recv = bytearray(recv)
 
@@ -394,9 +1113,14 @@ elif have_scsi and args.mscdev is not None:
 
             dev.execute(b'\xfc' + cb, send, recv)
 
+            if progress is not None:
+                progress(len(send if send is not None else recv or b''))
+
             return recv
 
-        do_the_stuff(execcmd, 512, 'usb')
+        # the largest block-aligned size that fits into the 16-bit length field of a command
+        if not run(execcmd, 512, 'usb', 0xFE00):
+            exit(1)
 
 else:
     print('No device specified:')
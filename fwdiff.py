@@ -0,0 +1,211 @@
+from bluetrum.cipher import *
+from bluetrum.fwimage import *
+from bluetrum.utils import *
+
+import argparse, struct
+
+###############################################################################
+
+ap = argparse.ArgumentParser(description='Compare two Bluetrum firmware images',
+                             epilog='Exits with 0 if the images are the same, 1 if they differ, 2 on errors.')
+
+ap.add_argument('-u', '--userkey', metavar='KEY', type=anyint,
+                help='User key which is used to encrypt the main application blob (of both images)')
+
+ap.add_argument('-U', '--codekey', metavar='KEY', type=anyint,
+                help='Direct assignment of the code key (instead of it being derived from the user key passed with the "-u" option above)')
+
+ap.add_argument('image1',
+                help='First (old) firmware image')
+
+ap.add_argument('image2',
+                help='Second (new) firmware image')
+
+args = ap.parse_args()
+
+###############################################################################
+
+def byte_ranges(a, b, base=0):
+    """ Get the (start, end) ranges of bytes that differ between `a` and `b` """
+    ranges = []
+
+    for i in range(max(len(a), len(b))):
+        if i < len(a) and i < len(b) and a[i] == b[i]:
+            continue
+
+        if len(ranges) > 0 and ranges[-1][1] == base + i:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([base + i, base + i + 1])
+
+    return ranges
+
+def span_ranges(values):
+    """ Group a sorted list of integers into the (first, last) spans """
+    spans = []
+
+    for v in values:
+        if len(spans) > 0 and spans[-1][1] + 1 == v:
+            spans[-1][1] = v
+        else:
+            spans.append([v, v])
+
+    return spans
+
+#------------------------------------------------------------------------------
+
+class Image:
+    def __init__(self, path, codekey):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+
+        self.hdr = parse_boot_header(self.data)
+        entries, _ = parse_region_table(self.data)
+
+        self.regions = {}
+
+        for ri, entry in enumerate(entries):
+            rhdr = parse_region_header(self.data, entry.offset)
+            if not rhdr.crc_ok:
+                raise ValueError(f'Region header CRC mismatch at @{entry.offset:x}')
+
+            dataend = min(region_data_end(rhdr, (ri+1) == len(entries)), len(self.data))
+            key = region_key(entry, self.hdr.bootcrc, codekey or 0)
+
+            reader = RegionReader(self.data, rhdr, dataend, key)
+
+            # without the key we can't tell a thing about the code contents
+            if rhdr.type == 'XCOD' and codekey is None:
+                reader = None
+
+            # (the blocks past the data size are just padding, with junk in their CRC table entries)
+            crcs = region_block_crcs(self.data, rhdr, dataend)[:align_to(rhdr.dsize, 512) // 512]
+
+            self.regions[rhdr.type] = (entry, rhdr, crcs, reader)
+
+differs = False
+
+def report(msg):
+    global differs
+    differs = True
+    print(msg)
+
+#------------------------------------------------------------------------------
+
+def diff_header(img1, img2):
+    for field in ('chipid', 'bootload', 'bootentry', 'bootoff', 'bootsize', 'bootcrc'):
+        v1, v2 = getattr(img1.hdr, field), getattr(img2.hdr, field)
+        if v1 != v2:
+            report(f'header: {field} {v1!r} -> {v2!r}')
+
+    if img1.hdr.bootcrc != img2.hdr.bootcrc or img1.hdr.bootsize != img2.hdr.bootsize:
+        code1, _ = decrypt_boot_code(img1.data, img1.hdr)
+        code2, _ = decrypt_boot_code(img2.data, img2.hdr)
+
+        ranges = byte_ranges(code1, code2)
+        if len(ranges) > 0:
+            report(f'boot code: {sum(e - s for s, e in ranges)} bytes differ in {len(ranges)} ranges')
+
+def diff_region(rtype, reg1, reg2):
+    entry1, rhdr1, crcs1, reader1 = reg1
+    entry2, rhdr2, crcs2, reader2 = reg2
+
+    if rhdr1.dsize != rhdr2.dsize:
+        report(f'region {rtype}: size {rhdr1.dsize} -> {rhdr2.dsize}')
+
+    if entry1.crc == entry2.crc and crcs1 == crcs2:
+        # nothing to see here
+        return []
+
+    # compare the block CRC tables first, only the blocks that differ there get decrypted
+    changed = [i for i in range(max(len(crcs1), len(crcs2)))
+               if i >= len(crcs1) or i >= len(crcs2) or crcs1[i] != crcs2[i]]
+
+    report(f'region {rtype}: CRC {entry1.crc:04X} -> {entry2.crc:04X}, {len(changed)} of {len(crcs2)} blocks differ')
+
+    ranges = []
+
+    for first, last in span_ranges(changed):
+        if reader1 is None or reader2 is None:
+            print(f'  blocks {first}..{last} (data @{first * 512:06X}..{(last + 1) * 512 - 1:06X})')
+            continue
+
+        spanranges = []
+
+        for i in range(first, last + 1):
+            blk1 = reader1.block(i) if i < len(crcs1) else b''
+            blk2 = reader2.block(i) if i < len(crcs2) else b''
+
+            spanranges += byte_ranges(blk1, blk2, i * 512)
+
+        print(f'  blocks {first}..{last} (data @{first * 512:06X}..{(last + 1) * 512 - 1:06X}):'
+              f' {sum(e - s for s, e in spanranges)} bytes differ')
+
+        ranges += spanranges
+
+    return ranges
+
+def diff_resources(reg1, reg2, ranges):
+    reader1, reader2 = reg1[3], reg2[3]
+    res1, res2 = reader1.res_table(), reader2.res_table()
+
+    def touched(res):
+        return any(s < res.offset + res.size and e > res.offset for s, e in ranges)
+
+    for i in range(max(len(res1), len(res2))):
+        if i >= len(res2):
+            print(f'  resource #{i} "{res1[i].name}": removed')
+            continue
+        if i >= len(res1):
+            print(f'  resource #{i} "{res2[i].name}": added ({res2[i].size} bytes)')
+            continue
+
+        r1, r2 = res1[i], res2[i]
+
+        if r1.name != r2.name:
+            print(f'  resource #{i}: renamed "{r1.name}" -> "{r2.name}"')
+
+        if (r1.offset, r1.size) != (r2.offset, r2.size):
+            # it's moved, so it has to be compared as a whole
+            same = reader1.read(r1.offset, r1.size) == reader2.read(r2.offset, r2.size)
+            print(f'  resource #{i} "{r2.name}": @{r1.offset:x} ({r1.size} bytes) -> @{r2.offset:x} ({r2.size} bytes)'
+                  f'{", same contents" if same else ", contents changed"}')
+
+        elif touched(r2):
+            print(f'  resource #{i} "{r2.name}": contents changed')
+
+################################################################################
+
+codekey = None
+if args.codekey is not None:
+    codekey = args.codekey
+if args.userkey is not None:
+    codekey = ab_calcuserkey(args.userkey)
+
+try:
+    img1 = Image(args.image1, codekey)
+    img2 = Image(args.image2, codekey)
+
+    diff_header(img1, img2)
+
+    for rtype in list(img1.regions) + [rtype for rtype in img2.regions if rtype not in img1.regions]:
+        if rtype not in img2.regions:
+            report(f'region {rtype}: removed')
+            continue
+        if rtype not in img1.regions:
+            report(f'region {rtype}: added')
+            continue
+
+        ranges = diff_region(rtype, img1.regions[rtype], img2.regions[rtype])
+
+        if rtype == 'XRES' and len(ranges) > 0:
+            diff_resources(img1.regions[rtype], img2.regions[rtype], ranges)
+
+except (OSError, ValueError, struct.error) as e:
+    print('[!]', e)
+    exit(2)
+
+if not differs:
+    print('The images are the same')
+
+exit(1 if differs else 0)
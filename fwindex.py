@@ -0,0 +1,322 @@
+from bluetrum.cipher import *
+from bluetrum.crc import *
+from bluetrum.fwimage import *
+from bluetrum.utils import *
+
+import argparse
+import hashlib
+import sqlite3
+import struct
+from pathlib import Path
+
+###############################################################################
+
+ap = argparse.ArgumentParser(description='Index a collection of Bluetrum firmware images and look things up in it')
+
+ap.add_argument('-d', '--db', type=Path, default=Path('fwindex.db'),
+                help='Index database file (default: %(default)s)')
+
+actsp = ap.add_subparsers(dest='action', required=True)
+
+asp_add = actsp.add_parser('add', help='Add images (or directories full of them) to the index')
+asp_add.add_argument('-u', '--userkey', metavar='KEY', type=anyint,
+                     help='User key used to encrypt the main application blob (to index its contents too)')
+asp_add.add_argument('-U', '--codekey', metavar='KEY', type=anyint,
+                     help='Direct assignment of the code key (instead of it being derived from the user key)')
+asp_add.add_argument('-f', '--force', action='store_true',
+                     help='Index the images again, even if they haven\'t changed since the last time')
+asp_add.add_argument('--prune', action='store_true',
+                     help='Remove the images that no longer exist from the index')
+asp_add.add_argument('paths', type=Path, nargs='+',
+                     help='Image files or directories to scan for them')
+
+asp_query = actsp.add_parser('query', help='Find the images matching all of the given criteria')
+asp_query.add_argument('--chipid',
+                       help='Chip ID or the start of it, either as the name (e.g. "PRAO") or in hex (e.g. "5052414F01000000")')
+asp_query.add_argument('--bootcrc', type=anyint,
+                       help='Boot code CRC16')
+asp_query.add_argument('--boot-sha1',
+                       help='SHA-1 hash of the boot code')
+asp_query.add_argument('--boot-file', type=Path,
+                       help='Boot code file (e.g. boot-code.bin from fwunpack.py)')
+asp_query.add_argument('--region-crc', type=anyint,
+                       help='Region CRC16')
+asp_query.add_argument('--res-name',
+                       help='Resource entry name')
+asp_query.add_argument('--res-sha1',
+                       help='SHA-1 hash of the resource data')
+asp_query.add_argument('--res-file', type=Path,
+                       help='Resource file')
+
+asp_show = actsp.add_parser('show', help='Show what is known about the indexed images')
+asp_show.add_argument('paths', type=Path, nargs='+',
+                      help='Image files')
+
+args = ap.parse_args()
+
+###############################################################################
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id          INTEGER PRIMARY KEY,
+    path        TEXT UNIQUE NOT NULL,
+    size        INTEGER,
+    mtime       INTEGER,
+    sha1        TEXT,
+    error       TEXT,
+    chipid      TEXT,
+    bootload    INTEGER,
+    bootentry   INTEGER,
+    bootoff     INTEGER,
+    bootsize    INTEGER,
+    bootcrc     INTEGER,
+    boot_sha1   TEXT,
+    header_ok   INTEGER,
+    boot_ok     INTEGER,
+    regtab_ok   INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS regions (
+    image_id    INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    idx         INTEGER,
+    type        TEXT,
+    offset      INTEGER,
+    size        INTEGER,
+    crc         INTEGER,
+    scrambled   INTEGER,
+    header_ok   INTEGER,
+    data_ok     INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS blocks (
+    image_id    INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    region      INTEGER,
+    block       INTEGER,
+    crc         INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS resources (
+    image_id    INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    idx         INTEGER,
+    name        TEXT,
+    offset      INTEGER,
+    size        INTEGER,
+    sha1        TEXT
+);
+
+CREATE INDEX IF NOT EXISTS images_chipid    ON images(chipid);
+CREATE INDEX IF NOT EXISTS images_bootcrc   ON images(bootcrc);
+CREATE INDEX IF NOT EXISTS images_boot_sha1 ON images(boot_sha1);
+CREATE INDEX IF NOT EXISTS regions_image    ON regions(image_id);
+CREATE INDEX IF NOT EXISTS regions_crc      ON regions(crc);
+CREATE INDEX IF NOT EXISTS blocks_image     ON blocks(image_id);
+CREATE INDEX IF NOT EXISTS resources_image  ON resources(image_id);
+CREATE INDEX IF NOT EXISTS resources_name   ON resources(name);
+CREATE INDEX IF NOT EXISTS resources_sha1   ON resources(sha1);
+"""
+
+SCHEMA_VERSION = 1     # 1: the whole chip ID (with the version) in hex
+
+db = sqlite3.connect(args.db)
+db.execute('PRAGMA foreign_keys = ON')
+db.executescript(SCHEMA)
+
+if db.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+    # the images indexed the old way only had the name of the chip, they get indexed again on the next 'add'
+    db.execute('UPDATE images SET mtime = NULL, chipid = lower(hex(chipid)) WHERE chipid IS NOT NULL')
+    db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    db.commit()
+
+def chip_name(chipid):
+    """ The chip ID (as stored, in hex) shown as the name and the version, e.g. "PRAO/01000000" """
+    chipid = bytes.fromhex(chipid)
+    return f'{chipid[:4].decode(errors="replace")}/{chipid[4:].hex()}'
+
+def chipid_prefix(s):
+    """ The chip ID to query for (in hex, as stored), which can be given as the name or in hex """
+    if len(s) > 4:
+        try:
+            return bytes.fromhex(s).hex()
+        except ValueError:
+            pass
+    return s.encode().hex()
+
+#------------------------------------------------------------------------------
+
+def index_image(image_id, data, codekey):
+    """ Parse the image and put everything there is to know about it into the index """
+    hdr = parse_boot_header(data)
+    bootcode, boot_ok = decrypt_boot_code(data, hdr)
+
+    regions, regtab_ok = parse_region_table(data)
+
+    db.execute('UPDATE images SET chipid=?, bootload=?, bootentry=?, bootoff=?, bootsize=?, bootcrc=?,'
+               ' boot_sha1=?, header_ok=?, boot_ok=?, regtab_ok=? WHERE id=?',
+               (hdr.chipid.hex(), hdr.bootload, hdr.bootentry, hdr.bootoff, hdr.bootsize,
+                hdr.bootcrc, hashlib.sha1(bootcode).hexdigest(), hdr.crc_ok, boot_ok, regtab_ok, image_id))
+
+    for ri, entry in enumerate(regions):
+        rhdr = parse_region_header(data, entry.offset)
+
+        if not rhdr.crc_ok:
+            db.execute('INSERT INTO regions (image_id, idx, offset, size, crc, scrambled, header_ok)'
+                       ' VALUES (?, ?, ?, ?, ?, ?, 0)',
+                       (image_id, entry.index, entry.offset, entry.size, entry.crc, entry.scrambled))
+            continue
+
+        dataend = min(region_data_end(rhdr, (ri+1) == len(regions)), len(data))
+
+        db.executemany('INSERT INTO blocks VALUES (?, ?, ?, ?)',
+                       [(image_id, entry.index, block, crc)
+                        for block, crc in enumerate(region_block_crcs(data, rhdr, dataend))])
+
+        data_ok = None
+
+        # the code can be only checked with the right key at hand, the resources don't need one
+        if rhdr.type == 'XRES' or codekey is not None:
+            rdata, bad = decrypt_region(data, rhdr, dataend, region_key(entry, hdr.bootcrc, codekey or 0))
+            data_ok = len(bad) == 0 and ab_crc16(rdata) == entry.crc
+
+            if rhdr.type == 'XRES':
+                rdata = rdata[:rhdr.dsize]
+
+                db.executemany('INSERT INTO resources VALUES (?, ?, ?, ?, ?, ?)',
+                               [(image_id, res.index, res.name, res.offset, res.size,
+                                 hashlib.sha1(rdata[res.offset : res.offset+res.size]).hexdigest())
+                                for res in parse_res_table(rdata)])
+
+        db.execute('INSERT INTO regions VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?)',
+                   (image_id, entry.index, rhdr.type, entry.offset, entry.size, entry.crc, entry.scrambled, data_ok))
+
+def scan_images(paths):
+    for path in paths:
+        if path.is_dir():
+            yield from sorted(p for p in path.rglob('*') if p.is_file())
+        else:
+            yield path
+
+def file_sha1(path):
+    return hashlib.sha1(path.read_bytes()).hexdigest()
+
+#------------------------------------------------------------------------------
+
+if args.action == 'add':
+    codekey = None
+    if args.codekey is not None:
+        codekey = args.codekey
+    elif args.userkey is not None:
+        codekey = ab_calcuserkey(args.userkey)
+
+    nindexed = nfailed = nskipped = 0
+
+    for path in scan_images(args.paths):
+        path = path.resolve()
+        if path == args.db.resolve():
+            continue
+
+        stat = path.stat()
+
+        row = db.execute('SELECT id, size, mtime FROM images WHERE path=?', (str(path),)).fetchone()
+
+        if row is not None:
+            if not args.force and row[1:] == (stat.st_size, stat.st_mtime_ns):
+                nskipped += 1
+                continue
+
+            # start over
+            db.execute('DELETE FROM images WHERE id=?', (row[0],))
+
+        data = path.read_bytes()
+
+        image_id = db.execute('INSERT INTO images (path, size, mtime, sha1) VALUES (?, ?, ?, ?)',
+                              (str(path), stat.st_size, stat.st_mtime_ns, hashlib.sha1(data).hexdigest())).lastrowid
+
+        try:
+            index_image(image_id, data, codekey)
+        except (ValueError, struct.error) as e:
+            # not an image, perhaps (still keep it to not parse it over and over again)
+            db.execute('UPDATE images SET error=? WHERE id=?', (str(e), image_id))
+            print(f'{path}: {e}')
+            nfailed += 1
+        else:
+            print(f'{path}: indexed')
+            nindexed += 1
+
+        db.commit()
+
+    if args.prune:
+        for image_id, path in db.execute('SELECT id, path FROM images').fetchall():
+            if not Path(path).exists():
+                print(f'{path}: gone')
+                db.execute('DELETE FROM images WHERE id=?', (image_id,))
+        db.commit()
+
+    print(f'Indexed {nindexed} images, {nfailed} failed to parse, {nskipped} unchanged')
+
+elif args.action == 'query':
+    conds, params = [], []
+
+    def where(cond, *values):
+        conds.append(cond)
+        params.extend(values)
+
+    if args.chipid is not None:
+        where("images.chipid LIKE ? || '%'", chipid_prefix(args.chipid))
+    if args.bootcrc is not None:
+        where('images.bootcrc = ?', args.bootcrc)
+    if args.boot_sha1 is not None:
+        where('images.boot_sha1 = ?', args.boot_sha1.lower())
+    if args.boot_file is not None:
+        where('images.boot_sha1 = ?', file_sha1(args.boot_file))
+    if args.region_crc is not None:
+        where('images.id IN (SELECT image_id FROM regions WHERE crc = ?)', args.region_crc)
+    if args.res_name is not None:
+        where('images.id IN (SELECT image_id FROM resources WHERE name = ?)', args.res_name)
+    if args.res_sha1 is not None:
+        where('images.id IN (SELECT image_id FROM resources WHERE sha1 = ?)', args.res_sha1.lower())
+    if args.res_file is not None:
+        where('images.id IN (SELECT image_id FROM resources WHERE sha1 = ?)', file_sha1(args.res_file))
+
+    query = 'SELECT path, chipid, bootcrc FROM images WHERE error IS NULL'
+    if len(conds) > 0:
+        query += ' AND ' + ' AND '.join(conds)
+
+    for path, chipid, bootcrc in db.execute(query + ' ORDER BY path', params):
+        print(f'{chip_name(chipid)}  boot {bootcrc:04X}  {path}')
+
+elif args.action == 'show':
+    for path in args.paths:
+        row = db.execute('SELECT id, sha1, error, chipid, bootload, bootentry, bootoff, bootsize, bootcrc,'
+                         ' boot_sha1, header_ok, boot_ok, regtab_ok FROM images WHERE path=?',
+                         (str(path.resolve()),)).fetchone()
+
+        print(f'\n# {path}')
+
+        if row is None:
+            print('Not indexed')
+            continue
+
+        image_id, sha1, error, chipid, bootload, bootentry, bootoff, bootsize, bootcrc, \
+            boot_sha1, header_ok, boot_ok, regtab_ok = row
+
+        print(f'SHA-1: {sha1}')
+
+        if error is not None:
+            print(f'Error: {error}')
+            continue
+
+        print(f'Chip ID: {chip_name(chipid)} (header CRC ok: {bool(header_ok)})')
+        print(f'Boot code: load @{bootload:x}, entry @{bootentry:x} - offset @{bootoff:x}, {bootsize} bytes'
+              f' - CRC {bootcrc:04x} (ok: {bool(boot_ok)}) - SHA-1 {boot_sha1}')
+        print(f'Region table CRC ok: {bool(regtab_ok)}')
+
+        for idx, rtype, offset, size, crc, header_ok, data_ok, nblocks in db.execute(
+                'SELECT idx, type, offset, size, crc, header_ok, data_ok,'
+                ' (SELECT COUNT(*) FROM blocks WHERE image_id=regions.image_id AND region=regions.idx)'
+                ' FROM regions WHERE image_id=? ORDER BY idx', (image_id,)):
+            print(f'region {idx} :: "{rtype}" @{offset:x} ({size} bytes) | CRC {crc:04x} | {nblocks} blocks'
+                  f' | header ok: {bool(header_ok)}, data ok: {"unknown" if data_ok is None else bool(data_ok)}')
+
+        for idx, name, offset, size, sha1 in db.execute(
+                'SELECT idx, name, offset, size, sha1 FROM resources WHERE image_id=? ORDER BY idx', (image_id,)):
+            print(f'#{idx} [{name:24s}] @{offset:08x}, {size} bytes - {sha1}')
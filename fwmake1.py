@@ -2,15 +2,23 @@ from bluetrum.cipher import *
 from bluetrum.crc import *
 from bluetrum.magic import *
 from bluetrum.utils import *
+from bluetrum.profile import Profiler, add_profile_args
 
 import struct
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 ###############################################################################
 
 ap = argparse.ArgumentParser(description='Bluetrum Firmware Maker 1.0')
 
+def key_list(s):
+    """ Comma separated keys, or "@FILE" with one key per line (and the '#' comments) """
+    if s.startswith('@'):
+        s = ','.join(ln.split('#')[0] for ln in Path(s[1:]).read_text().splitlines())
+    return [anyint(k) for k in s.split(',') if k.strip() != '']
+
 ap.add_argument('-u', '--userkey', metavar='KEY', type=anyint,
                 help='The "user key" (term may change in the future) to use for scrambling the code area'
                      ' (by default none is applied, code is scrambled using the generic way.)')
@@ -18,11 +26,23 @@ ap.add_argument('-u', '--userkey', metavar='KEY', type=anyint,
 ap.add_argument('-U', '--codekey', metavar='KEY', type=anyint,
                 help='Direct assignment of the code key (instead of it being derived from the user key passed with the "-u" option above)')
 
+ap.add_argument('--userkeys', metavar='LIST', type=key_list,
+                help='Make an image for each of the user keys in the list at once (comma separated, or "@FILE" with one per line).'
+                     ' The output file name then has to have "{key}" in it, which is replaced with the key (e.g. "fw_{key}.bin")')
+
+ap.add_argument('--codekeys', metavar='LIST', type=key_list,
+                help='Same as above, but with the code keys')
+
+ap.add_argument('-j', '--jobs', type=int, default=4,
+                help='Amount of images to scramble concurrently when making them for several keys (default: %(default)d)')
+
 ap.add_argument('--no-res-scramble', action='store_false', dest='scramble_res',
                 help='Do not scramble the resource region data')
 
+add_profile_args(ap)
+
 ap.add_argument('output', type=Path,
-                help='The output file')
+                help='The output file (with "{key}" in it when making the images for several keys)')
 
 ap.add_argument('header', type=Path,
                 help='The "header.bin" file that contains the boot code and some bits of the header')
@@ -35,26 +55,59 @@ ap.add_argument('resbin', type=Path, nargs='?',
 
 args = ap.parse_args()
 
+prof = Profiler.from_args(args)
+
 ###############################################################################
 
 blocksize = 512
 
+def scramble_padding(image, padoff, npad, pcrcoff, key):
+    """ Scramble the padding blocks after the last region, with the words following the block CRC table as their CRCs.
+
+        When the table fills up all the space before the data (e.g. with 248 blocks, modulo 256), those words spill into
+        the first data block, so this has to be done once that one is scrambled, as it's the scrambled words that count. """
+    pcrcs = struct.unpack_from(f'<{npad}H', image, pcrcoff)
+    ab_lfsr_cipher_multi(image, padoff, [key ^ crc for crc in pcrcs], blocksize)
+
 #
-# Code scrambling key
+# Code scrambling key(s), along with the output file for each
 #
-codekey = 0
-if args.codekey is not None:
-    codekey = args.codekey
-    print(f'Using the key ${codekey:08x} (directly obtained)')
-if args.userkey is not None:
-    codekey = ab_calcuserkey(args.userkey)
-    print(f'Using the key ${codekey:08x} (obtained from ${args.userkey:08x})')
+outputs = []
+
+if args.userkeys is not None or args.codekeys is not None:
+    if args.userkey is not None or args.codekey is not None:
+        ap.error('a single key can not be given together with the key lists')
+    if '{key}' not in str(args.output):
+        ap.error('the output file name has to have "{key}" in it to make the images for several keys')
+
+    for ukey in args.userkeys or []:
+        outputs.append((ab_calcuserkey(ukey), Path(str(args.output).replace('{key}', f'{ukey:08x}'))))
+    for ckey in args.codekeys or []:
+        outputs.append((ckey, Path(str(args.output).replace('{key}', f'{ckey:08x}'))))
+
+    print(f'Making {len(outputs)} images, one for each key')
+
+else:
+    codekey = 0
+    if args.codekey is not None:
+        codekey = args.codekey
+        print(f'Using the key ${codekey:08x} (directly obtained)')
+    if args.userkey is not None:
+        codekey = ab_calcuserkey(args.userkey)
+        print(f'Using the key ${codekey:08x} (obtained from ${args.userkey:08x})')
+
+    outputs.append((codekey, args.output))
 
 #
 # Load the header.bin file
 #
 with open(args.header, 'rb') as f:
-    header = ab_lfsr_cipher(f.read(), MAGICKEY_XFIL)
+    with prof.stage('file read') as st:
+        header = f.read()
+        st.add(len(header))
+
+    with prof.stage('header decrypt', len(header)):
+        header = ab_lfsr_cipher(header, MAGICKEY_XFIL)
 
     hmagic, hchipid, bootload, bootentry, bootoffset, bootsize = struct.unpack_from('<4s8sIIII', header, 0)
 
@@ -84,7 +137,8 @@ with open(args.header, 'rb') as f:
         print(f'** Boot code is bigger than what the header file actually has ({bootsize} > {len(header) - bootoffset})')
         exit(2)
 
-    bootcrc = ab_crc16(header[bootoffset : bootoffset+bootsize])
+    with prof.stage('boot CRC', bootsize):
+        bootcrc = ab_crc16(header[bootoffset : bootoffset+bootsize])
 
     print(f'Boot code CRC16:        ${bootcrc:04X}')
 
@@ -95,12 +149,15 @@ with open(args.header, 'rb') as f:
 #
 regions = []
 
-with open(args.appbin, 'rb') as f:
-    regions.append((MAGICSIGN_XCOD, f.read(), codekey ^ (0x00010001 * bootcrc) ^ MAGICKEY_XAPP))
+with open(args.appbin, 'rb') as f, prof.stage('file read') as st:
+    # (the code key is applied later on, see below)
+    regions.append((MAGICSIGN_XCOD, f.read(), (0x00010001 * bootcrc) ^ MAGICKEY_XAPP))
+    st.add(len(regions[-1][1]))
 
 if args.resbin is not None:
-    with open(args.resbin, 'rb') as f:
+    with open(args.resbin, 'rb') as f, prof.stage('file read') as st:
         regions.append((MAGICSIGN_XRES, f.read(), 0 if args.scramble_res else None))
+        st.add(len(regions[-1][1]))
 
 #
 # Start building the contents
@@ -127,13 +184,21 @@ if hflag_scramble:
     ab_lfsr_cipher_in(contents, 0, 0x40, MAGICKEY_LVMG)
 
     # and the boot code
-    for off in range(bootoffset, bootoffset+bootsize, blocksize):
-        key = MAGICKEY_LVMG ^ (0x00010001 * bootcrc) ^ ((off // blocksize) - 1)
-        ab_lfsr_cipher_in(contents, off, blocksize, key)
+    with prof.stage('boot scramble', bootsize):
+        ab_lfsr_cipher_multi(contents, bootoffset,
+            [MAGICKEY_LVMG ^ (0x00010001 * bootcrc) ^ ((off // blocksize) - 1)
+                for off in range(bootoffset, bootoffset+bootsize, blocksize)],
+            blocksize)
 
 #
 # Put the app/res regions
 #
+# Everything but the scrambled code data is the same whatever the code key is (all the CRCs are of the plain data),
+# so the code data is left as it is here, and gets scrambled for each of the code keys in the end.
+#
+
+codeoff, codecrcs, codekeybase = None, None, None
+codepadding = None      # the padding after the code region, if it's the last one (padoff, number of blocks, offset of their CRCs)
 
 for i, (rmagic, rdata, rkey) in enumerate(regions):
     # pad to a block boundary
@@ -144,9 +209,9 @@ for i, (rmagic, rdata, rkey) in enumerate(regions):
     # region header
     regoff = len(contents)
     contents += bytes(16) # stub
-    # data block CRC's (padded to a block boundary)
+    # data block CRC's (padded to a block boundary, together with the header)
     crcoff = len(contents)
-    contents += bytes(align_to(2 * nblocks, blocksize) - (crcoff-regoff))
+    contents += bytes(align_to((crcoff-regoff) + 2 * nblocks, blocksize) - (crcoff-regoff))
     # region data (data is already padded to a block boundary above)
     dataoff = len(contents)
     contents += rdata
@@ -154,9 +219,18 @@ for i, (rmagic, rdata, rkey) in enumerate(regions):
     if (i+1) == len(regions):
         contents += bytes(align_by(len(contents), 4096))
 
+    # CRC the data blocks and scramble them (if neccessary), getting the CRC of the whole data along the way
+    keyed = rmagic == MAGICSIGN_XCOD
+
+    with prof.stage('region CRC' if keyed else 'region scramble', len(rdata)):
+        crcs, rcrc = ab_lfsr_scramble_blocks(contents, dataoff, nblocks, None if keyed else rkey, blocksize)
+
+    # (the padding after the last region is all zeroes)
+    rcrc = ab_crc16_shift(rcrc, len(contents) - dataoff - len(rdata))
+
     # fill in region table entry
     struct.pack_into('<IIIHBB', contents, 0x40 + 0x10 * i,
-        regoff, len(rdata), 0, ab_crc16(contents[dataoff:]), i, rkey is not None
+        regoff, len(rdata), 0, rcrc, i, rkey is not None
     )
 
     # fill in region header
@@ -168,26 +242,25 @@ for i, (rmagic, rdata, rkey) in enumerate(regions):
     )
 
     # fill in the block CRC's
-    for coff in range(crcoff, dataoff, 2):
-        blki = (coff - crcoff) // 2  # corresponding block index
-        rboff = blki * blocksize     # block data offset within `rdata`
-        boff = rboff + dataoff       # block data offset within `contents`
-
-        if rboff < len(rdata):
-            # CRC of the block
-            crc = ab_crc16(contents[boff : boff+blocksize], blki + 1)
-        else:
-            # Fill the rest to obscure the gap (I'm doing that just to have byte-exact output)
-            crc = ab_crc16(contents[regoff : coff], coff)
-
-        struct.pack_into('<H', contents, coff, crc)
-
-    # scramble blocks, if neccessary
-    if rkey is not None:
-        for boff in range(dataoff, len(contents), blocksize):
-            blki = (boff - dataoff) // blocksize
-            crc, = struct.unpack_from('<H', contents, crcoff + blki * 2)
-            ab_lfsr_cipher_in(contents, boff, blocksize, rkey ^ crc)
+    struct.pack_into(f'<{nblocks}H', contents, crcoff, *crcs)
+
+    for coff in range(crcoff + 2 * nblocks, dataoff, 2):
+        # Fill the rest to obscure the gap (I'm doing that just to have byte-exact output)
+        struct.pack_into('<H', contents, coff, ab_crc16(contents[regoff : coff], coff))
+
+    # the padding after the last region gets scrambled as well (the data blocks are scrambled by now, see scramble_padding)
+    pcrcs = []
+    if rkey is not None and len(contents) > dataoff + len(rdata):
+        padoff = dataoff + len(rdata)
+        pcrcs = struct.unpack_from(f'<{(len(contents) - padoff) // blocksize}H', contents, crcoff + 2 * nblocks)
+        if not keyed:
+            scramble_padding(contents, padoff, len(pcrcs), crcoff + 2 * nblocks, rkey)
+
+    if keyed:
+        codeoff, codecrcs, codekeybase = dataoff, list(crcs), rkey
+        if len(pcrcs) > 0:
+            # (the CRCs of the padding blocks may be in the first data block, so they differ with each key)
+            codepadding = (padoff, len(pcrcs), crcoff + 2 * nblocks)
 
     print(f'{rmagic.hex()} -- @{regoff:08X} / {len(rdata)} bytes')
 
@@ -199,7 +272,26 @@ struct.pack_into('<H', contents, 0x80, rtcrc)
 ab_lfsr_cipher_in(contents, 0x40, 0x40, MAGICKEY_XAPP ^ (rtcrc * 0x00010001))
 
 #
-# Write the resulting image out
+# Scramble the code data with each of the keys, and write the resulting images out
 #
-with open(args.output, 'wb') as f:
-    f.write(contents)
+def make_image(codekey, path):
+    image = bytearray(contents)
+
+    with prof.stage('code scramble', len(codecrcs) * blocksize):
+        ab_lfsr_cipher_multi(image, codeoff, [codekey ^ codekeybase ^ crc for crc in codecrcs], blocksize)
+
+        if codepadding is not None:
+            scramble_padding(image, *codepadding, codekey ^ codekeybase)
+
+    with open(path, 'wb') as f, prof.stage('file write', len(image)):
+        f.write(image)
+
+    return path
+
+if len(outputs) == 1:
+    make_image(*outputs[0])
+else:
+    # (the scrambling runs in numpy for the most part, which lets the other threads go on meanwhile)
+    with ThreadPoolExecutor(args.jobs) as pool:
+        for (codekey, _), path in zip(outputs, pool.map(lambda o: make_image(*o), outputs)):
+            print(f'${codekey:08x} -> {path}')
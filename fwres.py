@@ -0,0 +1,129 @@
+from bluetrum.cipher import *
+from bluetrum.fwimage import *
+from bluetrum.utils import *
+
+import argparse
+import fnmatch
+import shutil
+import sys
+from pathlib import Path
+
+###############################################################################
+
+ap = argparse.ArgumentParser(description='List, extract and replace the resources of a Bluetrum firmware image, without unpacking all of it')
+
+ap.add_argument('-u', '--userkey', metavar='KEY', type=anyint,
+                help='User key which is used to encrypt the main application blob')
+
+ap.add_argument('-U', '--codekey', metavar='KEY', type=anyint,
+                help='Direct assignment of the code key (instead of it being derived from the user key passed with the "-u" option above)')
+
+ap.add_argument('--no-mmap', action='store_false', dest='mmap',
+                help='Read the whole image into memory instead of mapping it')
+
+actsp = ap.add_subparsers(dest='action', required=True)
+
+asp_list = actsp.add_parser('list', help='List the resources')
+asp_list.add_argument('image',
+                      help='Firmware image file')
+
+asp_extract = actsp.add_parser('extract', help='Extract the resources')
+asp_extract.add_argument('-o', '--output', type=Path, default=Path('.'),
+                         help='Directory to put the resources into (default: the current one),'
+                              ' or "-" to write the resource to stdout')
+asp_extract.add_argument('--no-check', action='store_false', dest='check',
+                         help='Do not check the CRCs of the blocks the resources are in')
+asp_extract.add_argument('image',
+                         help='Firmware image file')
+asp_extract.add_argument('names', nargs='+',
+                         help='Names of the resources to extract (may be wildcards, e.g. "*.mp3")')
+
+asp_replace = actsp.add_parser('replace', help='Replace the resource in the image (in place), if the new data fits into its slot')
+asp_replace.add_argument('-o', '--output', type=Path,
+                         help='Write the patched image into this file instead of changing the original one')
+asp_replace.add_argument('image',
+                         help='Firmware image file')
+asp_replace.add_argument('name',
+                         help='Name of the resource to replace')
+asp_replace.add_argument('file', type=Path,
+                         help='File with the new contents of the resource')
+
+args = ap.parse_args()
+
+###############################################################################
+
+codekey = 0
+if args.codekey is not None:
+    codekey = args.codekey
+elif args.userkey is not None:
+    codekey = ab_calcuserkey(args.userkey)
+
+def select(resources, patterns):
+    """ Pick the resources matching any of the patterns, complaining about the patterns that match nothing """
+    picked = []
+
+    for pattern in patterns:
+        matched = [res for res in resources if fnmatch.fnmatchcase(res.name, pattern)]
+        if len(matched) == 0:
+            raise KeyError(f'No resource matches "{pattern}"')
+
+        picked += [res for res in matched if res not in picked]
+
+    return picked
+
+try:
+    if args.action == 'replace':
+        newdata = args.file.read_bytes()
+
+        path = args.image
+        if args.output is not None:
+            shutil.copyfile(args.image, args.output)
+            path = args.output
+
+        try:
+            with FirmwareImage.open(path, codekey, args.mmap, writable=True) as image:
+                res = image.find_resource(args.name)
+                slot = image.resource_slot(res)
+
+                image.replace_resource(res, newdata)
+
+                print(f'{res.name}: {res.size} -> {len(newdata)} bytes (slot: {slot} bytes) in "{path}"')
+
+        except BaseException:
+            # (don't leave the unpatched copy behind)
+            if args.output is not None:
+                args.output.unlink()
+            raise
+
+        exit(0)
+
+    with FirmwareImage.open(args.image, codekey, args.mmap) as image:
+        resources = image.resources()
+
+        if args.action == 'list':
+            for res in resources:
+                print(f'#{res.index:<4} {res.name:24s} @{res.offset:08x} {res.size:10d}')
+
+            print(f'{len(resources)} resources, {sum(res.size for res in resources)} bytes')
+
+        elif args.action == 'extract':
+            picked = select(resources, args.names)
+
+            if str(args.output) == '-':
+                if len(picked) != 1:
+                    raise ValueError(f'Only a single resource can be written to stdout ({len(picked)} are selected)')
+
+                sys.stdout.buffer.write(image.read_resource(picked[0], args.check))
+
+            else:
+                for res in picked:
+                    # (the names are flat, but just in case)
+                    path = args.output / Path(res.name).name
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    path.write_bytes(image.read_resource(res, args.check))
+
+                    print(f'{res.name} -> {path} ({res.size} bytes)')
+
+except (OSError, KeyError, ValueError) as e:
+    print('failed:', e.args[0] if isinstance(e, KeyError) else e, file=sys.stderr)
+    exit(1)
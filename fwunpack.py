@@ -1,8 +1,10 @@
-import argparse, struct
+import argparse, struct, hashlib, json, sys, threading
 from pathlib import Path
 from bluetrum.cipher import *
 from bluetrum.crc import *
+from bluetrum.fwimage import verify_image
 from bluetrum.magic import *
+from bluetrum.profile import Profiler, add_profile_args
 
 ################################################################################
 
@@ -17,14 +19,146 @@ ap.add_argument('-u', '--userkey', metavar='KEY', type=anyint,
 ap.add_argument('-U', '--codekey', metavar='KEY', type=anyint,
                 help='Direct assignment of the code key (instead of it being derived from the user key passed with the "-u" option above)')
 
+ap.add_argument('--verify-only', action='store_true',
+                help='Only check the integrity of the image(s) without writing anything out.'
+                     ' Exits with a nonzero status if any of them turns out to be corrupted.')
+
+add_profile_args(ap)
+
 ap.add_argument('file', nargs='+',
-                help='Firmware file(s) to parse')
+                help='Firmware file(s) to parse, "-" reads the image from stdin as it comes'
+                     ' (e.g. from "download.py read 0 0 -") and unpacks it into "stdin_unpack"')
 
 args = ap.parse_args()
 
+prof = Profiler.from_args(args)
+
 ################################################################################
 
-def parse_res(data, outdir, base=0x11000000):
+class UnpackDir:
+    """ The output directory, which remembers what has been written into it
+        so that the unchanged files don't have to be written over again. """
+
+    MANIFEST = '.unpack-manifest.json'
+
+    def __init__(self, path):
+        self.path = path
+
+        try:
+            self.manifest = json.loads((path/UnpackDir.MANIFEST).read_text())
+        except (OSError, ValueError):
+            self.manifest = {'input': None, 'key': None, 'outputs': {}}
+
+        self.outputs = {}
+
+    def _intact(self, name, size, fhash):
+        # whether the file is still the same as it was written, returns its mtime if so.
+        # the files touched since (e.g. rewritten in place with the same size) get hashed over again
+        entry = self.manifest['outputs'].get(name)
+        if entry is None or entry[:2] != [size, fhash]:
+            return None
+
+        try:
+            st = (self.path/name).stat()
+            if st.st_size != size:
+                return None
+
+            if len(entry) < 3 or st.st_mtime_ns != entry[2]:
+                with prof.stage('hash', size):
+                    if hashlib.sha1((self.path/name).read_bytes()).hexdigest() != fhash:
+                        return None
+
+            return st.st_mtime_ns
+        except OSError:
+            return None
+
+    def is_current(self, ihash, key):
+        """ Check if everything has been already unpacked from the same input with the same key """
+        if self.manifest['input'] != ihash or self.manifest['key'] != key:
+            return False
+
+        return all(self._intact(name, entry[0], entry[1]) is not None for name, entry in self.manifest['outputs'].items())
+
+    def write(self, name, data):
+        """ Write the file, unless it already has the very same contents """
+        name = str(name)
+
+        with prof.stage('hash', len(data)):
+            fhash = hashlib.sha1(data).hexdigest()
+
+        mtime = self._intact(name, len(data), fhash)
+        if mtime is None:
+            with prof.stage('file write', len(data)):
+                (self.path/name).parent.mkdir(parents=True, exist_ok=True)
+                (self.path/name).write_bytes(data)
+                mtime = (self.path/name).stat().st_mtime_ns
+
+        self.outputs[name] = [len(data), fhash, mtime]
+
+    def finish(self, ihash, key):
+        self.manifest = {'input': ihash, 'key': key, 'outputs': self.outputs}
+        (self.path/UnpackDir.MANIFEST).write_text(json.dumps(self.manifest))
+
+class StreamInput:
+    """ The image coming in through a stream (e.g. a pipe), which gets parsed as far as it has arrived.
+
+        The stream is read in the background, so that whatever is coming in keeps flowing
+        while the parts that have already arrived are being decrypted and written out. """
+
+    CHUNK = 0x10000
+
+    def __init__(self, f):
+        self.f = f
+        self.data = bytearray()
+        self.hash = hashlib.sha1()
+
+        self.chunks = []
+        self.eof = False
+        self.error = None
+        self.cond = threading.Condition()
+
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def _reader(self):
+        try:
+            while True:
+                chunk = self.f.read1(StreamInput.CHUNK)
+                with self.cond:
+                    if len(chunk) == 0:
+                        break
+                    self.chunks.append(chunk)
+                    self.cond.notify()
+
+        except Exception as e:
+            self.error = e
+
+        with self.cond:
+            self.eof = True
+            self.cond.notify()
+
+    def need(self, end=None):
+        """ Wait until the data up to `end` (or the whole of it, if it's None) has arrived """
+        with self.cond, prof.stage('stream wait'):
+            while end is None or len(self.data) + sum(len(c) for c in self.chunks) < end:
+                if self.eof:
+                    break
+                self.cond.wait()
+
+            chunks, self.chunks = self.chunks, []
+
+        for chunk in chunks:
+            self.hash.update(chunk)
+            self.data += chunk
+
+        if self.error is not None:
+            raise self.error
+
+        if end is not None and len(self.data) < end:
+            raise ValueError(f'The image ends at @{len(self.data):x}, before @{end:x}')
+
+#---------------------------------------------------------------#
+
+def parse_res(data, out, subdir='res', base=0x11000000):
     magic, hwtw, entcnt = struct.unpack_from('<4s24sI', data, 0)
 
     if magic != b'\xC5\xCE\xD4\xD2':   # 'ENTR' with MSBs set
@@ -35,49 +169,50 @@ def parse_res(data, outdir, base=0x11000000):
         print('Entries go over the res region!')
         return
 
-    outdir.mkdir(exist_ok=True)
+    outdir = Path(subdir)
 
     entries = []
 
-    for i in range(entcnt):
-        ename, eaddr, esize = struct.unpack_from('<24sII', data, 32 + i * 32)
+    # (the stage only covers the table itself, the files count into the hash/file write stages)
+    with prof.stage('resource parse'):
+        for i in range(entcnt):
+            ename, eaddr, esize = struct.unpack_from('<24sII', data, 32 + i * 32)
 
-        # address sanity check no.1
-        if eaddr < base:
-            print(f'Entry #{i} base address (%{eaddr:x}) goes under the map base (%{base:x})')
-            break
+            # address sanity check no.1
+            if eaddr < base:
+                print(f'Entry #{i} base address (%{eaddr:x}) goes under the map base (%{base:x})')
+                break
 
-        eoff = eaddr - base
+            eoff = eaddr - base
 
-        # address sanity check no. 2
-        if eoff + esize > len(data):
-            print(f'Entry #{i} goes over the region by {eoff + esize - len(data)} bytes')
-            break
+            # address sanity check no. 2
+            if eoff + esize > len(data):
+                print(f'Entry #{i} goes over the region by {eoff + esize - len(data)} bytes')
+                break
 
-        # null-terminated filename
-        zeroidx = ename.find(b'\0')
-        if zeroidx < 0: zeroidx = len(ename)
-        ename = ename[:zeroidx].decode()
+            # null-terminated filename
+            zeroidx = ename.find(b'\0')
+            if zeroidx < 0: zeroidx = len(ename)
+            ename = ename[:zeroidx].decode()
 
-        print(f'#{i} [{ename:24s}] @{eoff:08x}, {esize} bytes')
+            print(f'#{i} [{ename:24s}] @{eoff:08x}, {esize} bytes')
 
-        # just in case
-        if len(ename) == 0:
-            print(f'Entry #{i} has no name')
-            continue
+            # just in case
+            if len(ename) == 0:
+                print(f'Entry #{i} has no name')
+                continue
 
-        entries.append((ename, eoff, esize))
+            entries.append((ename, eoff, esize))
 
     for ename, eoff, esize in entries:
         if esize == 0:  # if it's feasible
             continue
 
         # dump it to file
-        (outdir/ename).write_bytes(data[eoff : eoff+esize])
+        out.write(outdir/ename, data[eoff : eoff+esize])
 
     # make an entry order file too
-    with open(outdir/'00__order__00.txt', 'w') as f:
-        f.write("""\
+    order = ["""\
 // NOTICE: You should not modify the order of the resource files below in any way.
 // The firmware refers to each resource by the means of hardcoded offsets to the
 // address and size fields of the entries themselve, meaning that if you change
@@ -87,24 +222,30 @@ def parse_res(data, outdir, base=0x11000000):
 // Also, the entries that are zero bytes in length are also listed there,
 // instead of being extracted like any other file.
 
-"""
-        )
+"""]
 
-        for ename, eoff, esize in entries:
-            f.write(f'{ename}\n')
+    for ename, eoff, esize in entries:
+        order.append(f'{ename}\n')
 
-        f.write('\n// Here is the end.\n')
+    order.append('\n// Here is the end.\n')
+
+    out.write(outdir/'00__order__00.txt', ''.join(order).encode())
 
 #---------------------------------------------------------------#
 
-def parse_flash_image(data, outdir, userkey=0):
-    data = bytearray(data)
-    outdir.mkdir(exist_ok=True)
+def parse_flash_image(data, out, userkey=0, need=None):
+    """ Unpack the image (which gets decrypted in place). If the image is still arriving,
+        `need(end)` is called to wait for the data up to `end` before it's looked at. """
+    if need is None:
+        need = lambda end=None: None
+
+    need(0x82)
 
     #
     # Parse the header
     #
-    ab_lfsr_cipher_in(data, 0, 0x40, MAGICKEY_LVMG)
+    with prof.stage('header decrypt', 0x40):
+        ab_lfsr_cipher_in(data, 0, 0x40, MAGICKEY_LVMG)
 
     # Check the header CRC
     hdr, hcrc = struct.unpack_from('<62sH', data, 0x00)
@@ -126,24 +267,26 @@ def parse_flash_image(data, outdir, userkey=0):
     #
     # Decrypt the boot code
     #
-    for off in range(bootoff, bootoff + bootsz, 512):
-        key = MAGICKEY_LVMG ^ (0x00010001 * bootcrc) ^ ((off >> 9) - 1)
-        ab_lfsr_cipher_in(data, off, 512, key)
+    need(bootoff + bootsz)
+
+    with prof.stage('boot decrypt', bootsz):
+        ab_lfsr_cipher_multi(data, bootoff,
+            [MAGICKEY_LVMG ^ (0x00010001 * bootcrc) ^ ((off >> 9) - 1) for off in range(bootoff, bootoff + bootsz, 512)])
 
     bootcode = data[bootoff:bootoff+bootsz]
 
     # Check the boot code CRC
-    if ab_crc16(bootcode) != bootcrc:
-        print('Boot code CRC mismatch')
+    with prof.stage('boot CRC', bootsz):
+        if ab_crc16(bootcode) != bootcrc:
+            print('Boot code CRC mismatch')
 
     # Dump the boot code into a file
-    (outdir/'boot-code.bin').write_bytes(bootcode)
+    out.write('boot-code.bin', bootcode)
 
     # Make a header.bin file from the portions of header data (that is, bare minimum main header contents and the boot code itself)
-    with open(outdir/'header.bin', 'wb') as f:
-        hdrbin = bytearray(bootoff) + bootcode
-        struct.pack_into('<4s8sIIII', hdrbin, 0, hmagic, chipid, bootload, bootentry, bootoff, bootsz)
-        f.write(ab_lfsr_cipher(hdrbin, MAGICKEY_XFIL))
+    hdrbin = bytearray(bootoff) + bootcode
+    struct.pack_into('<4s8sIIII', hdrbin, 0, hmagic, chipid, bootload, bootentry, bootoff, bootsz)
+    out.write('header.bin', ab_lfsr_cipher(hdrbin, MAGICKEY_XFIL))
 
 
     #
@@ -151,7 +294,8 @@ def parse_flash_image(data, outdir, userkey=0):
     #
     rtcrc, = struct.unpack_from('<H', data, 0x80)
 
-    ab_lfsr_cipher_in(data, 0x40, 0x40, MAGICKEY_XAPP ^ (0x00010001 * rtcrc))
+    with prof.stage('header decrypt', 0x40):
+        ab_lfsr_cipher_in(data, 0x40, 0x40, MAGICKEY_XAPP ^ (0x00010001 * rtcrc))
 
     if ab_crc16(data[0x40:0x80]) != rtcrc:
         print('Region table CRC error')
@@ -178,6 +322,8 @@ def parse_flash_image(data, outdir, userkey=0):
         #
         # Read the region header
         #
+        need(roffset + 16)
+
         rh_hdr, rh_hcrc = struct.unpack_from('<14sH', data, roffset)
         if ab_crc16(rh_hdr) != rh_hcrc:
             print('Region header CRC mismatch')
@@ -211,26 +357,30 @@ def parse_flash_image(data, outdir, userkey=0):
 
         print(f'  data spans :: @{dataoff:x}...{dataend-1:x}')
 
+        need(dataend)
+
         #
         # Deobfuscate the data!
         #
-        for off in range(dataoff, dataend, 512):
-            reloff = off - dataoff
-            block = reloff // 512
+        # the space between the header and the data is the CRCs of the blocks!!
+        blockcrcs = struct.unpack_from(f'<{(dataend - dataoff) // 512}H', data, roffset + 16)
 
-            # the space between the header and the data is the CRCs of the blocks!!
-            blockcrc, = struct.unpack_from('<H', data, roffset + 16 + block * 2)
+        # here we go! (that gets both the block CRCs and the whole region's CRC along the way)
+        with prof.stage('region decrypt', dataend - dataoff):
+            crcs, datacrc = ab_lfsr_descramble_blocks(data, dataoff, blockcrcs, key)
 
-            # here we go!
-            ab_lfsr_cipher_in(data, off, 512, key ^ blockcrc)
+        for block, (crc, blockcrc) in enumerate(zip(crcs, blockcrcs)):
+            reloff = block * 512
 
             # check the block CRC real quick
-            if ab_crc16(data[off:off+512], block + 1) != blockcrc and reloff < rh_dsize:
+            if crc != blockcrc and reloff < rh_dsize:
                 print(f'Block CRC error ({reloff:x} / {blockcrc:04X})')
                 break
 
         # Another CRC check
-        if ab_crc16(data[dataoff : dataend]) != rcrc:
+        rcrc_ok = datacrc == rcrc
+
+        if not rcrc_ok:
             print('Region data CRC mismatch')
             if rh_type == 'XCOD':
                 print("** That was the main code area. Perhaps you haven't supplied a correct userkey?")
@@ -242,19 +392,21 @@ def parse_flash_image(data, outdir, userkey=0):
         # Actually dealing with the data
         if rh_type == 'XCOD':
             # The Code
-            (outdir/'app.bin').write_bytes(regdata)
+            out.write('app.bin', regdata)
         elif rh_type == 'XRES':
             # The Resources
-            (outdir/'res.bin').write_bytes(regdata)
-            parse_res(regdata, outdir/'res')
+            out.write('res.bin', regdata)
+            parse_res(regdata, out)
         else:
             # Something else
-            (outdir/f'region_{rh_type}.bin').write_bytes(regdata)
+            out.write(f'region_{rh_type}.bin', regdata)
 
     #
     # Save the decrypted image
     #
-    (outdir/'decrypted.bin').write_bytes(data)
+    need()
+
+    out.write('decrypted.bin', data)
 
 
 ################################################################################
@@ -269,19 +421,71 @@ if args.userkey is not None:
 
 
 
+if args.verify_only:
+    nbad = 0
+
+    for fname in args.file:
+        try:
+            with open(fname, 'rb') as f, prof.stage('verify'):
+                problems = verify_image(f.read(), codekey)
+        except Exception as e:
+            problems = [str(e)]
+
+        if len(problems) > 0:
+            print(f'{fname}: FAIL - {"; ".join(problems)}')
+            nbad += 1
+        else:
+            print(f'{fname}: OK')
+
+    if len(args.file) > 1:
+        print(f'{len(args.file) - nbad} OK, {nbad} failed')
+
+    exit(1 if nbad > 0 else 0)
+
 for fname in args.file:
     print(f'\n#\n# {fname}\n#\n')
 
+    if fname == '-':
+        # (no way to tell if it's the same as last time before it has all arrived, so it's just unpacked;
+        #  the files that are still the same don't get written over anyway)
+        try:
+            out = UnpackDir(Path('stdin_unpack'))
+            out.path.mkdir(exist_ok=True)
+
+            stream = StreamInput(sys.stdin.buffer)
+            parse_flash_image(stream.data, out, codekey, stream.need)
+
+            # whatever's left after it
+            stream.need()
+            out.finish(stream.hash.hexdigest(), codekey)
+
+        except Exception as e:
+            print('[!]', e)
+
+        continue
+
     try:
-        outdir = Path(fname + '_unpack')
+        out = UnpackDir(Path(fname + '_unpack'))
 
         with open(fname, 'rb') as f:
             hdr = f.read(4) ; f.seek(0)
             if hdr == b'DCF\0':
                 raise NotImplementedError('DCF parsing is not implemented yet')
             else:
-                data = bytearray(f.read())
-                parse_flash_image(data, outdir, codekey)
+                with prof.stage('file read') as st:
+                    data = bytearray(f.read())
+                    st.add(len(data))
+
+                with prof.stage('hash', len(data)):
+                    ihash = hashlib.sha1(data).hexdigest()
+
+                if out.is_current(ihash, codekey):
+                    print('Already unpacked, nothing has changed.')
+                    continue
+
+                out.path.mkdir(exist_ok=True)
+                parse_flash_image(data, out, codekey)
+                out.finish(ihash, codekey)
 
     except Exception as e:
         print('[!]', e)
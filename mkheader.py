@@ -109,10 +109,10 @@ if args.bootable:
         ab_lfsr_cipher_in(contents, 0, 64, MAGICKEY_LVMG)
 
         # scramble data
-        for off in range(args.offset, len(contents), blocksize):
-            ab_lfsr_cipher_in(contents,
-                            off, min(blocksize, len(contents) - off),
-                            ((off // blocksize) - 1) ^ MAGICKEY_LVMG ^ (code_crc * 0x00010001))
+        ab_lfsr_cipher_multi(contents, args.offset,
+                            [((off // blocksize) - 1) ^ MAGICKEY_LVMG ^ (code_crc * 0x00010001)
+                                for off in range(args.offset, len(contents), blocksize)],
+                            blocksize)
 else:
     # just scramble the entire file
     ab_lfsr_cipher_in(contents, 0, len(contents), MAGICKEY_XFIL)
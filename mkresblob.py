@@ -1,10 +1,14 @@
 from bluetrum.utils import *
 from bluetrum.magic import MAGICSIGN_ENTR
+from bluetrum.profile import Profiler, add_profile_args
 
 import argparse
+import hashlib
+import json
 import struct
 
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 ##################################################
 
@@ -16,6 +20,18 @@ ap.add_argument('--align', type=anyint, default=32,
 ap.add_argument('--base', type=anyint, default=0x11000000,
                 help='Resource area base address (default: 0x%(default)x)')
 
+ap.add_argument('--no-dedup', action='store_false', dest='dedup',
+                help='Store each file\'s data separately, even if it is identical to some other file')
+
+ap.add_argument('--no-cache', action='store_false', dest='cache',
+                help='Do not use (or make) the "<output>.manifest" file, which allows to only update the entries'
+                     ' whose files have changed since the previous run, if they still fit the same layout.')
+
+ap.add_argument('-j', '--jobs', type=int, default=8,
+                help='Amount of files to read concurrently (default: %(default)d)')
+
+add_profile_args(ap)
+
 ap.add_argument('input', type=Path,
                 help='Input resource directory or resource layout file.')
 
@@ -24,6 +40,10 @@ ap.add_argument('output', type=Path,
 
 args = ap.parse_args()
 
+prof = Profiler.from_args(args)
+
+manifest_path = args.output.with_name(args.output.name + '.manifest')
+
 ##################################################
 
 def parse_orderfile(files, fpath):
@@ -74,10 +94,11 @@ def scan_dir(files, dpath, prefix=''):
 
 files = {}
 
-if args.input.is_dir():
-    scan_dir(files, args.input)
-else:
-    parse_orderfile(files, args.input)
+with prof.stage('scan'):
+    if args.input.is_dir():
+        scan_dir(files, args.input)
+    else:
+        parse_orderfile(files, args.input)
 
     # manually assign the file paths
     for ename in files:
@@ -89,37 +110,165 @@ else:
 
 #--------------------------------------------------------
 
-data = bytearray(32 + len(files) * 32)
-struct.pack_into('<4s24sI', data, 0, MAGICSIGN_ENTR, b'', len(files))
+#
+# Gather the file info
+#
 
-for i, ename in enumerate(files):
-    # get the data
-    fpath = files[ename]
-    if fpath is not None:
-        # read the file data
-        fdata = fpath.read_bytes()
-    else:
-        # empty file data
-        fdata = b''
+# the cached info of the previous run
+manifest = None
+if args.cache:
+    try:
+        manifest = json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        pass
 
+if manifest is None or manifest.get('options') != [args.align, args.base, args.dedup]:
+    manifest = {'files': {}, 'output': None, 'layout': None}
+
+entries = []
+
+for ename, fpath in files.items():
     # encode the file name
     bename = ename.encode()
     if len(bename) >= 24:
         print(f'Name "{ename}" is too long ({len(bename)} bytes), truncating..')
         bename = bename[:23]
 
-    # add the alignment padding
-    data += bytes(align_by(len(data), args.align))
+    stat = fpath.stat() if fpath is not None else None
+    entries.append([ename, bename, fpath, stat, None, None])  # name, encoded name, path, stat, size, hash
+
+fdatas = {}
+
+def read_file(fpath):
+    with prof.stage('file read') as st:
+        fdata = fpath.read_bytes() if fpath is not None else b''
+        st.add(len(fdata))
+    return fdata
+
+def read_files(wanted):
+    # read the files concurrently
+    wanted = [ent for ent in wanted if ent[2] not in fdatas]
+    with ThreadPoolExecutor(args.jobs) as pool:
+        for ent, fdata in zip(wanted, pool.map(read_file, [ent[2] for ent in wanted])):
+            fdatas[ent[2]] = fdata
+
+# the files that didn't change since the last run don't have to be read (yet)
+toread = []
+
+for ent in entries:
+    fpath, stat = ent[2], ent[3]
+
+    if fpath is None:
+        ent[4], ent[5] = 0, hashlib.sha1(b'').hexdigest()
+        continue
+
+    cached = manifest['files'].get(str(fpath))
+    if cached is not None and cached['mtime'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+        ent[4], ent[5] = cached['size'], cached['sha1']
+    else:
+        toread.append(ent)
+
+read_files(toread)
+
+for ent in toread:
+    fdata = fdatas[ent[2]]
+    with prof.stage('hash', len(fdata)):
+        ent[4], ent[5] = len(fdata), hashlib.sha1(fdata).hexdigest()
+
+#
+# Lay out the blob
+#
+
+# the entries only have the address and size, so the identical data can be stored just once
+stored = {}
+saved = 0
+
+layout = []     # name, address, size, hash, whether the data is stored there
+size = 32 + len(entries) * 32
+
+for i, (ename, bename, fpath, stat, fsize, fhash) in enumerate(entries):
+    if args.dedup and fsize > 0 and fhash in stored:
+        # the same data is already there
+        address, dupname = stored[fhash]
+        saved += fsize
+
+        print(f'[{i}]: @{address:X} ({fsize}) - "{ename}" (same as "{dupname}")')
+
+        layout.append([ename, address, fsize, fhash, False])
+
+    else:
+        # add the alignment padding
+        size += align_by(size, args.align)
+
+        address = args.base + size
+        stored.setdefault(fhash, (address, ename))
+
+        print(f'[{i}]: @{address:X} ({fsize}) - "{ename}"')
+
+        layout.append([ename, address, fsize, fhash, True])
+
+        size += fsize
+
+#
+# Produce the blob
+#
+
+def output_stamp():
+    stat = args.output.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+incremental = False
+
+if manifest['layout'] is not None and args.output.exists() and output_stamp() == manifest['output']:
+    # all the entries have to stay where they were, only their contents may differ
+    incremental = [ent[:3] for ent in layout] == [ent[:3] for ent in manifest['layout']]
+
+if incremental:
+    # patch the changed data in place
+    changed = [i for i, ent in enumerate(layout) if ent[4] and ent[3] != manifest['layout'][i][3]]
+
+    read_files([entries[i] for i in changed])
+
+    with open(args.output, 'r+b') as f, prof.stage('file write') as st:
+        for i in changed:
+            f.seek(layout[i][1] - args.base)
+            f.write(fdatas[entries[i][2]])
+            st.add(layout[i][2])
+
+    if len(changed) > 0:
+        print(f'Updated {len(changed)} entries in place ({sum(layout[i][2] for i in changed)} bytes)')
+    else:
+        print('Nothing has changed')
+
+else:
+    read_files(entries)
+
+    with prof.stage('build', size):
+        data = bytearray(size)
+        struct.pack_into('<4s24sI', data, 0, MAGICSIGN_ENTR, b'', len(entries))
+
+        for i, ((ename, bename, fpath, *_), (_, address, fsize, _, here)) in enumerate(zip(entries, layout)):
+            # populate the file entry info
+            struct.pack_into('<24sII', data, 32 + i*32,
+                                bename, address, fsize)
 
-    address = args.base + len(data)
+            # put the data
+            if here:
+                data[address - args.base : address - args.base + fsize] = fdatas[fpath]
 
-    print(f'[{i}]: @{address:X} ({len(fdata)}) - "{ename}"')
+    with prof.stage('file write', len(data)):
+        args.output.write_bytes(data)
 
-    # populate the file entry info
-    struct.pack_into('<24sII', data, 32 + i*32,
-                        bename, address, len(fdata))
+if saved > 0:
+    print(f'Deduplication saved {saved} bytes ({size} bytes total)')
 
-    # append the data
-    data += fdata
+if args.cache:
+    manifest = {
+        'options':  [args.align, args.base, args.dedup],
+        'files':    {str(ent[2]): {'mtime': ent[3].st_mtime_ns, 'size': ent[4], 'sha1': ent[5]}
+                        for ent in entries if ent[2] is not None},
+        'output':   output_stamp(),
+        'layout':   layout,
+    }
 
-args.output.write_bytes(data)
+    manifest_path.write_text(json.dumps(manifest))